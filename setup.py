@@ -43,6 +43,7 @@ setup(name='tilequeue',
           'Jinja2>=2.10.1',
           'mapbox-vector-tile',
           'ModestMaps',
+          'msgpack>=0.5.2',
           'protobuf',
           'psycopg2',
           'pyproj>=2.1.0',
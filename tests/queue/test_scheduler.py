@@ -0,0 +1,102 @@
+import unittest
+
+
+class _StubQueue(object):
+
+    def __init__(self, batches, timestamp=None):
+        self.batches = list(batches)
+        self.timestamp = timestamp
+
+    def read(self):
+        from tilequeue.queue import MessageHandle
+        if not self.batches:
+            return []
+        metadata = dict(timestamp=self.timestamp)
+        return [MessageHandle(None, payload, metadata)
+                for payload in self.batches.pop(0)]
+
+
+class _StubMapper(object):
+
+    def __init__(self, queues):
+        self.queues = queues
+
+    def queues_in_priority_order(self):
+        return enumerate(self.queues)
+
+
+class PriorityQueueSchedulerTest(unittest.TestCase):
+
+    def test_first_queue_with_messages(self):
+        from mock import Mock
+        from tilequeue.queue.scheduler import PriorityQueueScheduler
+        failing_queue = Mock()
+        failing_queue.read.side_effect = IOError('read failed')
+        tile_proc_logger = Mock()
+        scheduler = PriorityQueueScheduler(
+            _StubMapper([failing_queue, _StubQueue([]), _StubQueue([['a']])]),
+            tile_proc_logger)
+        queue_id, msg_handles = scheduler.read()
+        self.assertEquals(2, queue_id)
+        self.assertEquals(['a'], [m.payload for m in msg_handles])
+        self.assertEquals(1, tile_proc_logger.error.call_count)
+        self.assertEquals((None, ()), scheduler.read())
+
+
+class FairQueueSchedulerTest(unittest.TestCase):
+
+    def _wait_ready(self, scheduler):
+        import time
+        scheduler._start()
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            with scheduler.cond:
+                if all(s.msg_handles is not None for s in scheduler.states):
+                    return
+            time.sleep(0.01)
+
+    def test_shares_by_weight(self):
+        from mock import Mock
+        from tilequeue.queue.scheduler import FairQueueScheduler
+        from tilequeue.queue.scheduler import QueueShare
+        queues = [_StubQueue([['a']] * 20), _StubQueue([['b']] * 20)]
+        scheduler = FairQueueScheduler(
+            _StubMapper(queues), Mock(), [QueueShare(3), QueueShare(1)],
+            read_wait_seconds=5)
+        self._wait_ready(scheduler)
+        queue_ids = []
+        for i in range(8):
+            # keep both queues ready, so the choice is only by weight
+            self._wait_ready(scheduler)
+            queue_id, _ = scheduler.read()
+            queue_ids.append(queue_id)
+        scheduler.close()
+        # the busy high priority queue doesn't starve the other
+        self.assertEquals(6, queue_ids.count(0))
+        self.assertEquals(2, queue_ids.count(1))
+
+    def test_overdue_queue_read_first(self):
+        import time
+        from mock import Mock
+        from tilequeue.queue.scheduler import FairQueueScheduler
+        from tilequeue.queue.scheduler import QueueShare
+        sent_millis = (time.time() - 600) * 1000
+        queues = [_StubQueue([['a']] * 5),
+                  _StubQueue([['b']], timestamp=sent_millis)]
+        scheduler = FairQueueScheduler(
+            _StubMapper(queues), Mock(),
+            [QueueShare(100), QueueShare(1, latency_target=60)],
+            read_wait_seconds=5)
+        self._wait_ready(scheduler)
+        queue_id, msg_handles = scheduler.read()
+        scheduler.close()
+        self.assertEquals(1, queue_id)
+        self.assertEquals(['b'], [m.payload for m in msg_handles])
+
+    def test_nothing_to_read(self):
+        from mock import Mock
+        from tilequeue.queue.scheduler import FairQueueScheduler
+        scheduler = FairQueueScheduler(
+            _StubMapper([_StubQueue([])]), Mock(), read_wait_seconds=0.05)
+        self.assertEquals((None, ()), scheduler.read())
+        scheduler.close()
@@ -3,7 +3,7 @@ import unittest
 
 class QueueWriterTest(unittest.TestCase):
 
-    def make_queue_writer(self):
+    def make_queue_writer(self, order_fn=None):
         from mock import MagicMock
         from tilequeue.queue.inflight import NoopInFlightManager
         from tilequeue.queue.mapper import SingleQueueMapper
@@ -16,7 +16,8 @@ class QueueWriterTest(unittest.TestCase):
         inflight_mgr = NoopInFlightManager()
         enqueue_batch_size = 10
         queue_writer = QueueWriter(
-            queue_mapper, msg_marshaller, inflight_mgr, enqueue_batch_size)
+            queue_mapper, msg_marshaller, inflight_mgr, enqueue_batch_size,
+            order_fn)
         return queue_writer
 
     def test_write_coords(self):
@@ -26,3 +27,19 @@ class QueueWriterTest(unittest.TestCase):
         n_enqueued, n_inflight = queue_writer.enqueue_batch(coords)
         self.assertEquals(2, n_enqueued)
         self.assertEquals(0, n_inflight)
+
+    def test_write_coords_in_locality_order(self):
+        from tilequeue.locality import make_locality_order
+        from tilequeue.tile import deserialize_coord
+        from tilequeue.tile import serialize_coord
+        coords = [deserialize_coord(c) for c in ('2/3/0', '2/0/0', '2/1/1')]
+        queue_writer = self.make_queue_writer(
+            make_locality_order(dict(curve='zorder')))
+        n_enqueued, n_inflight = queue_writer.enqueue_batch(coords)
+        self.assertEquals(3, n_enqueued)
+        queue = queue_writer.queue_mapper.tile_queue
+        sent = [payload for call in queue.enqueue_batch.call_args_list
+                for payload in call[0][0]]
+        self.assertEquals(
+            ['2/0/0', '2/1/1', '2/3/0'],
+            [serialize_coord(deserialize_coord(p)) for p in sent])
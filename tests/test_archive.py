@@ -0,0 +1,185 @@
+"""
+Tests for `tilequeue.archive`.
+"""
+import unittest
+
+
+class TileIdTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        from tilequeue.archive import coord_to_tile_id
+        from tilequeue.archive import tile_id_to_coord
+        from tilequeue.tile import deserialize_coord
+        self.assertEqual(0, coord_to_tile_id(deserialize_coord('0/0/0')))
+        self.assertEqual(1, coord_to_tile_id(deserialize_coord('1/0/0')))
+        self.assertEqual(5, coord_to_tile_id(deserialize_coord('2/0/0')))
+        for coord_str in ('0/0/0', '3/5/2', '10/1023/0', '14/8000/9123'):
+            coord = deserialize_coord(coord_str)
+            self.assertEqual(
+                coord, tile_id_to_coord(coord_to_tile_id(coord)))
+
+
+class ArchiveStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.base_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.base_path)
+
+    def test_finalize_and_read(self):
+        import os
+        from tilequeue.archive import ArchiveReader
+        from tilequeue.archive import ArchiveStore
+        from tilequeue.archive import file_range_reader
+        from tilequeue.format import json_format
+        from tilequeue.tile import coord_children_range
+        from tilequeue.tile import deserialize_coord
+
+        # small runs and leaves, so that there are several of each
+        store = ArchiveStore(self.base_path, run_bytes=100, leaf_size=4)
+        coords = list(coord_children_range(deserialize_coord('0/0/0'), 3))
+        for coord in coords:
+            # the same content for all the tiles at zoom 3
+            tile_data = 'ocean' if coord.zoom == 3 else str(coord)
+            store.write_tile(tile_data, coord, json_format)
+        # replaced by a later write
+        store.write_tile('updated', deserialize_coord('1/1/1'), json_format)
+
+        headers = store.finalize()
+        self.assertEqual(1, len(headers))
+        header = headers[0]
+        self.assertEqual('json', header.extension)
+        self.assertEqual(len(coords), header.n_tiles)
+        # all of zoom 3 is stored once
+        self.assertEqual(4 + 16 + 1, header.n_contents)
+        self.assertEqual([], os.listdir(
+            os.path.join(self.base_path, 'runs', 'json')))
+
+        for coord in coords:
+            expected = 'ocean' if coord.zoom == 3 else str(coord)
+            if str(coord) == str(deserialize_coord('1/1/1')):
+                expected = 'updated'
+            self.assertEqual(expected, store.read_tile(coord, json_format))
+        self.assertIsNone(
+            store.read_tile(deserialize_coord('4/0/0'), json_format))
+        self.assertEqual(
+            sorted(coords), sorted(store.list_tiles(json_format)))
+
+        # counting the reads for a tile
+        reads = []
+        with open(os.path.join(self.base_path, 'json.archive'), 'rb') as fp:
+            read_range = file_range_reader(fp)
+
+            def _counting_read_range(offset, length):
+                reads.append((offset, length))
+                return read_range(offset, length)
+            reader = ArchiveReader(_counting_read_range)
+            self.assertEqual(
+                'ocean', reader.read_tile(deserialize_coord('3/7/7')))
+        self.assertEqual(3, len(reads))
+
+    def test_finalize_again(self):
+        from tilequeue.archive import ArchiveStore
+        from tilequeue.format import json_format
+        from tilequeue.tile import deserialize_coord
+
+        store = ArchiveStore(self.base_path)
+        store.write_tile('a', deserialize_coord('1/0/0'), json_format)
+        store.write_tile('b', deserialize_coord('1/0/1'), json_format)
+        store.finalize()
+
+        # tiles written later are merged with the existing archive
+        store.write_tile('c', deserialize_coord('1/0/1'), json_format)
+        header, = store.finalize()
+        self.assertEqual(2, header.n_tiles)
+        self.assertEqual(
+            'a', store.read_tile(deserialize_coord('1/0/0'), json_format))
+        self.assertEqual(
+            'c', store.read_tile(deserialize_coord('1/0/1'), json_format))
+
+    def test_read_after_finalized_elsewhere(self):
+        from tilequeue.archive import ArchiveStore
+        from tilequeue.format import json_format
+        from tilequeue.tile import deserialize_coord
+
+        store = ArchiveStore(self.base_path)
+        coords = [deserialize_coord(c) for c in ('1/0/0', '1/0/1')]
+        store.write_tile('a', coords[0], json_format)
+        store.write_tile('b', coords[1], json_format)
+        store.finalize()
+        self.assertEqual('a', store.read_tile(coords[0], json_format))
+
+        # another process replaces the archive with one laid out
+        # differently, which the store's reader has to notice.
+        other = ArchiveStore(self.base_path)
+        other.write_tile('longer data', coords[0], json_format)
+        other.delete_tiles([coords[1]], json_format)
+        other.finalize()
+        self.assertEqual(
+            'longer data', store.read_tile(coords[0], json_format))
+        self.assertIsNone(store.read_tile(coords[1], json_format))
+
+    def test_contents_spill_to_disk(self):
+        from tilequeue.archive import _ContentIndex
+        contents = _ContentIndex(max_memory=2)
+        for i in range(5):
+            contents.put(str(i), (i * 10, 10))
+        self.assertIsNotNone(contents.db)
+        self.assertEqual(5, contents.n_contents)
+        for i in range(5):
+            self.assertEqual((i * 10, 10), tuple(contents.get(str(i))))
+        self.assertIsNone(contents.get('missing'))
+        contents.close()
+
+    def test_written_tiles_survive_without_close(self):
+        import os
+        from tilequeue.archive import ArchiveStore
+        from tilequeue.format import json_format
+        from tilequeue.tile import deserialize_coord
+
+        store = ArchiveStore(self.base_path)
+        store.write_tile('a', deserialize_coord('1/0/0'), json_format)
+        store.write_tile('b', deserialize_coord('1/0/1'), json_format)
+        # the process dies part way through writing another tile
+        runs_path = os.path.join(self.base_path, 'runs', 'json')
+        log_name, = os.listdir(runs_path)
+        with open(os.path.join(runs_path, log_name), 'ab') as fp:
+            fp.write('\x01\x02')
+
+        # and the archive is finalized by another process
+        header, = ArchiveStore(self.base_path).finalize()
+        self.assertEqual(2, header.n_tiles)
+        self.assertEqual(
+            'a', store.read_tile(deserialize_coord('1/0/0'), json_format))
+        self.assertEqual(
+            'b', store.read_tile(deserialize_coord('1/0/1'), json_format))
+
+    def test_delete_tiles(self):
+        from tilequeue.archive import ArchiveStore
+        from tilequeue.format import json_format
+        from tilequeue.tile import deserialize_coord
+
+        store = ArchiveStore(self.base_path)
+        coords = [deserialize_coord(c) for c in ('1/0/0', '1/0/1', '1/1/1')]
+        for coord in coords:
+            store.write_tile(str(coord), coord, json_format)
+        store.finalize()
+
+        # deletes tiles in the archive, and tiles written since
+        store.write_tile('new', deserialize_coord('2/0/0'), json_format)
+        self.assertEqual(2, store.delete_tiles(
+            [coords[0], deserialize_coord('2/0/0')], json_format))
+        # a tile written after its deletion is kept
+        store.delete_tiles([coords[1]], json_format)
+        store.write_tile('again', coords[1], json_format)
+
+        header, = store.finalize()
+        self.assertEqual(2, header.n_tiles)
+        self.assertIsNone(store.read_tile(coords[0], json_format))
+        self.assertIsNone(
+            store.read_tile(deserialize_coord('2/0/0'), json_format))
+        self.assertEqual('again', store.read_tile(coords[1], json_format))
+        self.assertEqual(str(coords[2]), store.read_tile(coords[2], json_format))
@@ -0,0 +1,81 @@
+"""
+Tests for `tilequeue.budget`.
+"""
+import unittest
+
+
+class ByteBudgetTest(unittest.TestCase):
+
+    def test_acquire_within_budget(self):
+        from tilequeue.budget import ByteBudget
+        budget = ByteBudget(10)
+        self.assertTrue(budget.acquire(6, timeout=0))
+        self.assertFalse(budget.acquire(6, timeout=0.01))
+        self.assertTrue(budget.acquire(4, timeout=0))
+        self.assertEquals(1.0, budget.utilization())
+        budget.release(6)
+        self.assertTrue(budget.acquire(6, timeout=0))
+
+    def test_large_item_admitted_when_empty(self):
+        from tilequeue.budget import ByteBudget
+        budget = ByteBudget(10)
+        self.assertTrue(budget.acquire(100, timeout=0))
+        self.assertEquals(100, budget.used())
+
+
+class BudgetedQueueTest(unittest.TestCase):
+
+    def test_queue_held_to_budget(self):
+        import Queue
+        from tilequeue.budget import BudgetedQueue
+        from tilequeue.budget import ByteBudget
+        from tilequeue.budget import formatted_data_size
+
+        def _job(n_bytes):
+            return dict(formatted_tiles=[dict(tile='x' * n_bytes)])
+
+        q = BudgetedQueue(Queue.Queue(), ByteBudget(10), formatted_data_size)
+        q.put(_job(8))
+        with self.assertRaises(Queue.Full):
+            q.put(_job(8), timeout=0.01)
+        q.put(None)
+        self.assertEquals(8, q.budget.used())
+
+        self.assertEquals(_job(8), q.get())
+        self.assertEquals(0, q.budget.used())
+        self.assertIsNone(q.get())
+        q.put(_job(8), timeout=0.01)
+
+    def test_full_when_budget_used(self):
+        import Queue
+        import threading
+        from tilequeue.budget import BudgetedQueue
+        from tilequeue.budget import ByteBudget
+        from tilequeue.budget import formatted_data_size
+
+        def _job(n_bytes):
+            return dict(formatted_tiles=[dict(tile='x' * n_bytes)])
+
+        q = BudgetedQueue(Queue.Queue(16), ByteBudget(10), formatted_data_size)
+        q.put(_job(8))
+        self.assertFalse(q.full())
+
+        # a put waiting for the budget makes the queue full
+        thread = threading.Thread(target=q.put, args=(_job(8),))
+        thread.start()
+        while not q.budget.n_waiting.value:
+            thread.join(0.01)
+        self.assertTrue(q.full())
+        q.get()
+        thread.join()
+        self.assertFalse(q.full())
+
+        q.put(_job(2))
+        self.assertTrue(q.full())
+
+    def test_fetched_data_size(self):
+        from tilequeue.budget import fetched_data_size
+        rows = [{'__id__': 1, '__geometry__': 'x' * 100,
+                 '__properties__': {'name': 'abc'}}]
+        size = fetched_data_size(dict(source_rows=rows))
+        self.assertTrue(size > 100)
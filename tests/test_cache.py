@@ -0,0 +1,138 @@
+"""
+Tests for `tilequeue.cache`.
+"""
+import unittest
+
+
+class DiskCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.dir_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir_path)
+
+    def _make_cache(self, max_bytes=1024):
+        from tilequeue.cache import DiskCache
+        return DiskCache(self.dir_path, max_bytes)
+
+    def test_get_put(self):
+        cache = self._make_cache()
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', 'etag-a', 'payload')
+        self.assertEquals(('etag-a', 'payload'), cache.get('a'))
+        cache.delete('a')
+        self.assertIsNone(cache.get('a'))
+
+    def _index_bytes(self, etag):
+        # an index entry is the etag and the sha1 of the payload
+        return len(etag) + 1 + 40
+
+    def test_content_addressed(self):
+        cache = self._make_cache()
+        cache.put('a', 'etag', 'same payload')
+        cache.put('b', 'etag', 'same payload')
+        # one object, and an index entry for each key
+        self.assertEquals(3, len(cache.lru))
+        self.assertEquals(
+            len('same payload') + 2 * self._index_bytes('etag'),
+            cache.n_bytes)
+        self.assertEquals(('etag', 'same payload'), cache.get('b'))
+
+    def test_lru_eviction(self):
+        entry_bytes = 4 + self._index_bytes('etag-a')
+        cache = self._make_cache(max_bytes=2 * entry_bytes + 8)
+        cache.put('a', 'etag-a', 'a' * 4)
+        cache.put('b', 'etag-b', 'b' * 4)
+        # use a, so that b is the least recently used
+        cache.get('a')
+        cache.put('c', 'etag-c', 'c' * 4)
+        self.assertIsNone(cache.get('b'))
+        self.assertEquals(('etag-a', 'aaaa'), cache.get('a'))
+        self.assertEquals(('etag-c', 'cccc'), cache.get('c'))
+        self.assertEquals(2 * entry_bytes, cache.n_bytes)
+
+    def test_index_entries_evicted(self):
+        import os
+        max_bytes = 10 * self._index_bytes('etag')
+        cache = self._make_cache(max_bytes=max_bytes)
+        for i in range(100):
+            cache.put('key-%d' % i, 'etag', 'payload')
+        self.assertLessEqual(cache.n_bytes, max_bytes)
+        n_index_files = len(os.listdir(os.path.join(self.dir_path, 'index')))
+        self.assertLess(n_index_files, 10)
+        self.assertEquals(('etag', 'payload'), cache.get('key-99'))
+        self.assertIsNone(cache.get('key-0'))
+
+    def test_shared_between_processes(self):
+        import os
+        max_bytes = 3200
+        # each stands in for a processor using the same directory
+        caches = [self._make_cache(max_bytes), self._make_cache(max_bytes)]
+        for i in range(100):
+            for j, cache in enumerate(caches):
+                cache.put('key-%d-%d' % (i, j), 'etag', '%50d' % (i * 2 + j))
+
+        n_bytes = 0
+        for dir_name in ('objects', 'index'):
+            dir_path = os.path.join(self.dir_path, dir_name)
+            for name in os.listdir(dir_path):
+                n_bytes += os.path.getsize(os.path.join(dir_path, name))
+        self.assertLessEqual(n_bytes, max_bytes * 1.25)
+
+    def test_persistent(self):
+        cache = self._make_cache()
+        cache.put('a', 'etag-a', 'payload')
+        cache = self._make_cache()
+        self.assertEquals(('etag-a', 'payload'), cache.get('a'))
+        self.assertEquals(
+            len('payload') + self._index_bytes('etag-a'), cache.n_bytes)
+
+    def test_read_not_modified(self):
+        cache = self._make_cache()
+        cache.put('a', 'etag-a', 'payload')
+        etags = []
+
+        def read_if_changed(etag):
+            etags.append(etag)
+            return None
+
+        self.assertEquals('payload', cache.read('a', read_if_changed))
+        self.assertEquals(['etag-a'], etags)
+
+    def test_read_changed(self):
+        cache = self._make_cache()
+        cache.put('a', 'etag-a', 'old payload')
+
+        def read_if_changed(etag):
+            return 'new payload', 'etag-b'
+
+        self.assertEquals('new payload', cache.read('a', read_if_changed))
+        self.assertEquals(('etag-b', 'new payload'), cache.get('a'))
+
+    def test_read_missing(self):
+        cache = self._make_cache()
+        cache.put('a', 'etag-a', 'payload')
+
+        def read_if_changed(etag):
+            return None, None
+
+        self.assertIsNone(cache.read('a', read_if_changed))
+        self.assertIsNone(cache.get('a'))
+
+
+class MemoryCacheTest(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        from tilequeue.cache import MemoryCache
+        cache = MemoryCache(10)
+        cache.put('a', '1234')
+        cache.put('b', '5678')
+        self.assertEqual('1234', cache.get('a'))
+        cache.put('c', '9012')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual('1234', cache.get('a'))
+        self.assertEqual('9012', cache.get('c'))
+        self.assertEqual(8, cache.n_bytes)
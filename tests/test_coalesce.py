@@ -0,0 +1,35 @@
+import unittest
+
+
+class JobCoalescerTest(unittest.TestCase):
+
+    def test_duplicate_attached_until_fetching(self):
+        from tilequeue.coalesce import JobCoalescer
+        from tilequeue.tile import deserialize_coord
+        coalescer = JobCoalescer()
+        coord = deserialize_coord('10/1/2')
+        first_id = coalescer.add(coord, 'handle-1', 'timing-1')
+        self.assertIsNotNone(first_id)
+        self.assertIsNone(coalescer.add(coord, 'handle-2', 'timing-2'))
+
+        # once the first job is fetching, a duplicate is a new job
+        coalescer.fetching(first_id)
+        second_id = coalescer.add(coord, 'handle-3', 'timing-3')
+        self.assertIsNotNone(second_id)
+        self.assertNotEquals(first_id, second_id)
+
+        self.assertEquals(
+            [('handle-2', 'timing-2')], coalescer.done(first_id))
+        self.assertEquals([], coalescer.done(second_id))
+        self.assertEquals(0, len(coalescer))
+
+    def test_failed_jobs_forgotten(self):
+        from tilequeue.coalesce import JobCoalescer
+        from tilequeue.tile import deserialize_coord
+        coalescer = JobCoalescer(max_age_seconds=0)
+        coord = deserialize_coord('10/1/2')
+        failed_id = coalescer.add(coord, 'handle-1', 'timing-1')
+        coalescer.last_prune_time -= 1
+        # the failed job is pruned, so this isn't attached to it
+        self.assertIsNotNone(coalescer.add(coord, 'handle-2', 'timing-2'))
+        self.assertEquals([], coalescer.done(failed_id))
@@ -142,3 +142,29 @@ class ZoomToQueueNameMapTest(unittest.TestCase):
         zoom = long(7)
         queue_name = get_queue(zoom)
         self.assertEqual(queue_name, 'q1')
+
+
+class DeleteStuckTilesTest(unittest.TestCase):
+
+    def test_fingerprints_forgotten(self):
+        from cStringIO import StringIO
+        from mock import Mock
+        from mock import patch
+        from tilequeue.command import tilequeue_delete_stuck_tiles
+        from tilequeue.tile import coord_marshall_int
+        from tilequeue.tile import deserialize_coord
+
+        cfg = Mock(fingerprint_cfg={'config-version': 1})
+        peripherals = Mock()
+        store = Mock()
+        store.delete_tiles.return_value = 1
+        with patch('tilequeue.command._make_store', return_value=store), \
+                patch('tilequeue.command.make_logger'), \
+                patch('sys.stdin', StringIO('10/1/2\n')):
+            tilequeue_delete_stuck_tiles(cfg, peripherals)
+
+        # otherwise the tile would be skipped as unchanged if it came back
+        coord = deserialize_coord('10/1/2')
+        peripherals.redis_client.hdel.assert_called_once_with(
+            'tilequeue.fingerprints', coord_marshall_int(coord))
+        self.assertEquals([coord], store.delete_tiles.call_args[0][0])
@@ -0,0 +1,126 @@
+"""
+Tests for `tilequeue.fingerprint`.
+"""
+import unittest
+
+
+class _MemoryIndex(object):
+
+    def __init__(self):
+        self.fingerprints = {}
+
+    def get(self, coord):
+        return self.fingerprints.get(coord)
+
+    def put(self, coord, fingerprint):
+        self.fingerprints[coord] = fingerprint
+
+    def delete_many(self, coords):
+        for coord in coords:
+            self.fingerprints.pop(coord, None)
+
+
+class FingerprintSourceRowsTest(unittest.TestCase):
+
+    def _rows(self):
+        from decimal import Decimal
+        return [
+            {'__id__': 1, '__geometry__': buffer('\x01\x02'),
+             '__properties__': {'name': u'caf\xe9', 'height': Decimal('1.5')}},
+            {'__id__': 2, '__geometry__': '\x01\x03',
+             '__roads_properties__': {'min_zoom': 5, 'kind': 'major_road'}},
+        ]
+
+    def test_stable_over_row_order(self):
+        from tilequeue.fingerprint import fingerprint_source_rows
+        rows = self._rows()
+        fp1 = fingerprint_source_rows(rows, 'v1', 10, ['mvt', 'json'])
+        fp2 = fingerprint_source_rows(
+            list(reversed(rows)), 'v1', 10, ['json', 'mvt'])
+        self.assertIsNotNone(fp1)
+        self.assertEquals(fp1, fp2)
+
+    def test_changes_with_input(self):
+        from tilequeue.fingerprint import fingerprint_source_rows
+        rows = self._rows()
+        fp = fingerprint_source_rows(rows, 'v1', 10)
+        self.assertNotEquals(fp, fingerprint_source_rows(rows, 'v2', 10))
+        self.assertNotEquals(fp, fingerprint_source_rows(rows, 'v1', 11))
+        rows[1]['__roads_properties__']['min_zoom'] = '5'
+        self.assertNotEquals(fp, fingerprint_source_rows(rows, 'v1', 10))
+
+    def test_unknown_type(self):
+        from tilequeue.fingerprint import fingerprint_source_rows
+        rows = [{'__id__': 1, '__geometry__': object()}]
+        self.assertIsNone(fingerprint_source_rows(rows, 'v1', 10))
+
+
+class FingerprinterTest(unittest.TestCase):
+
+    def test_unchanged_after_record(self):
+        from tilequeue.fingerprint import Fingerprinter
+        from tilequeue.tile import deserialize_coord
+        fingerprinter = Fingerprinter(_MemoryIndex(), 'v1')
+        coord = deserialize_coord('10/1/2')
+        fingerprint = fingerprinter([{'__id__': 1}], 10)
+        self.assertFalse(fingerprinter.unchanged(coord, fingerprint))
+        fingerprinter.record(coord, fingerprint)
+        self.assertTrue(fingerprinter.unchanged(coord, fingerprint))
+        self.assertFalse(fingerprinter.unchanged(coord, None))
+
+    def test_forget(self):
+        from tilequeue.fingerprint import Fingerprinter
+        from tilequeue.tile import deserialize_coord
+        fingerprinter = Fingerprinter(_MemoryIndex(), 'v1')
+        coord = deserialize_coord('10/1/2')
+        fingerprint = fingerprinter([{'__id__': 1}], 10)
+        fingerprinter.record(coord, fingerprint)
+        fingerprinter.forget([coord])
+        self.assertFalse(fingerprinter.unchanged(coord, fingerprint))
+
+    def test_redis_delete_many(self):
+        from mock import Mock
+        from tilequeue.fingerprint import RedisFingerprintIndex
+        from tilequeue.tile import coord_marshall_int
+        from tilequeue.tile import deserialize_coord
+        redis_client = Mock()
+        index = RedisFingerprintIndex(redis_client, 'fingerprints')
+        coords = [deserialize_coord('10/1/2'), deserialize_coord('10/1/3')]
+        index.delete_many(coords)
+        redis_client.hdel.assert_called_once_with(
+            'fingerprints', *map(coord_marshall_int, coords))
+        index.delete_many([])
+        self.assertEquals(1, redis_client.hdel.call_count)
+
+    def test_processing_skipped_when_unchanged(self):
+        import Queue
+        import threading
+        from mock import Mock
+        from tilequeue.fingerprint import Fingerprinter
+        from tilequeue.tile import deserialize_coord
+        from tilequeue.worker import ProcessAndFormatData
+
+        coord = deserialize_coord('10/1/2')
+        source_rows = [{'__id__': 1, '__geometry__': '\x01'}]
+        fingerprinter = Fingerprinter(_MemoryIndex(), 'v1')
+        fingerprinter.record(coord, fingerprinter(source_rows, 10))
+
+        input_queue = Queue.Queue()
+        output_queue = Queue.Queue()
+        input_queue.put(dict(
+            coord=coord, unpadded_bounds=None, cut_coords=[],
+            nominal_zoom=10, source_rows=source_rows,
+            metadata=dict(timing={})))
+        input_queue.put(None)
+
+        # processing would fail on the missing layer data, and output
+        # nothing.
+        processor = ProcessAndFormatData(
+            None, [], input_queue, output_queue, None, None, None, Mock(),
+            Mock(), fingerprinter)
+        processor(threading.Event())
+
+        data = output_queue.get_nowait()
+        self.assertEquals(coord, data['coord'])
+        self.assertEquals([], data['formatted_tiles'])
+        self.assertTrue(data['unchanged'])
@@ -0,0 +1,61 @@
+"""
+Tests for `tilequeue.iopool`.
+"""
+import unittest
+
+
+class IoPoolTest(unittest.TestCase):
+
+    def test_pending_tasks_bounded(self):
+        import threading
+        from tilequeue.iopool import IoPool
+        pool = IoPool('test', 1, 2)
+        release = threading.Event()
+        results = [pool.apply_async(release.wait) for i in range(2)]
+
+        # a third task is held back until one of the others finishes
+        submitted = threading.Event()
+
+        def _submit():
+            results.append(pool.apply_async(sum, ([1, 2],)))
+            submitted.set()
+        submitter = threading.Thread(target=_submit)
+        submitter.start()
+        self.assertFalse(submitted.wait(0.05))
+        self.assertEquals(2, pool.sample().n_pending)
+
+        release.set()
+        submitter.join()
+        self.assertEquals(3, results[-1].get(timeout=1))
+        pool.close()
+        pool.join()
+
+    def test_sample(self):
+        import time
+        from tilequeue.iopool import IoPool
+        pool = IoPool('test', 2)
+        pool.sample()
+        for result in [pool.apply_async(time.sleep, (0.05,))
+                       for i in range(4)]:
+            result.get()
+        stats = pool.sample()
+        self.assertEquals(4, stats.n_tasks)
+        self.assertEquals(0, stats.n_pending)
+        self.assertTrue(stats.max_wait_seconds >= 0.04)
+        self.assertTrue(0 < stats.utilization <= 1.0)
+        # and the next sample starts again
+        self.assertEquals(0, pool.sample().n_tasks)
+        pool.close()
+        pool.join()
+
+    def test_exception_releases_slot(self):
+        from tilequeue.iopool import IoPool
+        pool = IoPool('test', 1, 1)
+
+        def _fail():
+            raise ValueError('failed')
+        with self.assertRaises(ValueError):
+            pool.apply_async(_fail).get(timeout=1)
+        self.assertEquals(3, pool.apply_async(sum, ([1, 2],)).get(timeout=1))
+        pool.close()
+        pool.join()
@@ -0,0 +1,73 @@
+import unittest
+
+
+class LocalityKeyTest(unittest.TestCase):
+
+    def test_parent_sorts_before_children(self):
+        from tilequeue.locality import locality_key_fn
+        from tilequeue.tile import coord_children_range
+        from tilequeue.tile import deserialize_coord
+        key = locality_key_fn('hilbert')
+        parent = deserialize_coord('3/2/5')
+        children_keys = [key(c) for c in coord_children_range(parent, 6)]
+        self.assertTrue(key(parent) < min(children_keys))
+
+        # and no tile outside the parent sorts among its children
+        lo, hi = min(children_keys), max(children_keys)
+        for other in ('3/2/4', '3/3/5', '6/0/0', '6/63/63'):
+            other_key = key(deserialize_coord(other))
+            self.assertFalse(lo <= other_key <= hi)
+
+    def test_unknown_curve(self):
+        from tilequeue.locality import locality_key_fn
+        with self.assertRaises(AssertionError):
+            locality_key_fn('peano')
+
+
+class SortedByLocalityTest(unittest.TestCase):
+
+    def _coords(self):
+        from tilequeue.tile import coord_children_range
+        from tilequeue.tile import deserialize_coord
+        coords = list(coord_children_range(deserialize_coord('2/1/1'), 5))
+        coords.reverse()
+        return coords
+
+    def test_external_sort_matches_in_memory(self):
+        from tilequeue.locality import locality_key_fn
+        from tilequeue.locality import sorted_by_locality
+        coords = self._coords()
+        expected = sorted(coords, key=locality_key_fn('hilbert'))
+        # spills to several runs on disk
+        self.assertEquals(
+            expected, list(sorted_by_locality(coords, 'hilbert', 7)))
+        self.assertEquals(
+            expected, list(sorted_by_locality(coords, 'hilbert')))
+
+    def test_consecutive_tiles_adjacent(self):
+        from tilequeue.locality import sorted_by_locality
+        from tilequeue.tile import coord_children_range
+        from tilequeue.tile import deserialize_coord
+        coords = list(coord_children_range(deserialize_coord('0/0/0'), 4))
+        coords = [c for c in coords if c.zoom == 4]
+        ordered = list(sorted_by_locality(coords, 'hilbert', 5))
+        for a, b in zip(ordered, ordered[1:]):
+            self.assertEquals(
+                1, abs(a.column - b.column) + abs(a.row - b.row))
+
+    def test_coord_groups(self):
+        from tilequeue.locality import coord_groups_by_locality
+        from tilequeue.queue.mapper import CoordGroup
+        from tilequeue.tile import deserialize_coord
+        groups = [
+            CoordGroup([deserialize_coord('2/3/3')], 'q'),
+            CoordGroup([deserialize_coord('2/2/2'),
+                        deserialize_coord('2/0/0')], 'q'),
+            CoordGroup([deserialize_coord('2/1/0')], 'q'),
+        ]
+        ordered = list(coord_groups_by_locality(groups, 'zorder', 2))
+        self.assertEquals([groups[1], groups[2], groups[0]], ordered)
+
+    def test_no_order_configured(self):
+        from tilequeue.locality import make_locality_order
+        self.assertIsNone(make_locality_order(None))
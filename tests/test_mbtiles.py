@@ -0,0 +1,74 @@
+"""
+Tests for `tilequeue.mbtiles`.
+"""
+import unittest
+
+
+class MBTilesStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.base_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.base_path)
+
+    def _make_store(self, **kwargs):
+        from tilequeue.mbtiles import MBTilesStore
+        store = MBTilesStore(self.base_path, **kwargs)
+        self.addCleanup(store.close)
+        return store
+
+    def test_write_read_delete(self):
+        from tilequeue.format import json_format
+        from tilequeue.format import zip_format
+        from tilequeue.tile import deserialize_coord
+        store = self._make_store()
+        coord = deserialize_coord('10/1/2')
+        self.assertIsNone(store.read_tile(coord, json_format))
+
+        store.write_tile('{}', coord, json_format)
+        store.write_tile('zipped', coord, zip_format)
+        self.assertEquals('{}', store.read_tile(coord, json_format))
+        self.assertEquals('zipped', store.read_tile(coord, zip_format))
+        self.assertEquals([coord], list(store.list_tiles(json_format)))
+
+        self.assertEquals(1, store.delete_tiles([coord], json_format))
+        self.assertIsNone(store.read_tile(coord, json_format))
+        self.assertEquals('zipped', store.read_tile(coord, zip_format))
+
+    def test_mbtiles_rows(self):
+        import os
+        import sqlite3
+        from tilequeue.format import json_format
+        from tilequeue.tile import deserialize_coord
+        store = self._make_store()
+        store.write_tile('{}', deserialize_coord('2/1/0'), json_format)
+        conn = sqlite3.connect(os.path.join(self.base_path, 'json.mbtiles'))
+        # rows are flipped, as in TMS
+        self.assertEquals(
+            [(2, 1, 3)],
+            conn.execute('SELECT zoom_level, tile_column, tile_row '
+                         'FROM tiles').fetchall())
+        conn.close()
+
+    def test_concurrent_writes_batched(self):
+        import threading
+        from tilequeue.format import json_format
+        from tilequeue.tile import deserialize_coord
+        store = self._make_store(batch_size=5)
+        coords = [deserialize_coord('10/%d/1' % x) for x in range(20)]
+        threads = [threading.Thread(target=store.write_tile,
+                                    args=('%d' % coord.column, coord,
+                                          json_format))
+                   for coord in coords]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for coord in coords:
+            self.assertEquals(
+                '%d' % coord.column, store.read_tile(coord, json_format))
+        self.assertEquals(
+            sorted(coords), sorted(store.list_tiles(json_format)))
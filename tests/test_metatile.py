@@ -161,3 +161,132 @@ class TestMetatile(unittest.TestCase):
         self.assertEqual(
             tile(1, 1, 1),
             common_parent(tile(5, 16, 16), tile(4, 15, 15)))
+
+
+class TestMetatileReader(unittest.TestCase):
+
+    class _RangeStore(object):
+        """in-memory store of metatiles, supporting ranged reads"""
+
+        def __init__(self):
+            self.tiles = {}
+            self.reads = []
+
+        def write_tile(self, tile_data, coord, format):
+            self.tiles[(coord.zoom, coord.column, coord.row)] = tile_data
+
+        def read_tile_range(self, coord, format, offset, length=None,
+                            etag=None, unless_etag=None):
+            from tilequeue.store import TileChangedError
+            from tilequeue.store import TileNotModifiedError
+            self.reads.append((offset, length))
+            data = self.tiles.get((coord.zoom, coord.column, coord.row))
+            if data is None:
+                return None
+            data_etag = str(hash(data))
+            if etag and etag != data_etag:
+                raise TileChangedError()
+            if unless_etag and unless_etag == data_etag:
+                raise TileNotModifiedError()
+            if offset < 0:
+                offset = max(0, len(data) + offset)
+                length = len(data) - offset
+            return data[offset:offset + length], data_etag, len(data)
+
+    def _write_metatile(self, store, parent, tile_fn, formats=(json_format,)):
+        from tilequeue.tile import coord_children_range
+        coords = [parent] + list(coord_children_range(parent, parent.zoom + 1))
+        tiles = [dict(tile=tile_fn(coord), coord=coord, format=fmt,
+                      layer='all')
+                 for coord in coords for fmt in formats]
+        metatile, = make_metatiles(2, tiles)
+        store.write_tile(metatile['tile'], metatile['coord'], zip_format)
+
+    def test_read_tiles_from_one_index(self):
+        from tilequeue.metatile import MetatileReader
+        from tilequeue.tile import deserialize_coord
+
+        store = self._RangeStore()
+        parent = deserialize_coord('10/4/6')
+        self._write_metatile(store, parent, lambda coord: str(coord) * 1000)
+        # small enough tail that the members aren't in it
+        reader = MetatileReader(store, 1, tail_bytes=512)
+
+        child = deserialize_coord('11/9/13')
+        self.assertEqual(str(child) * 1000, reader.read_tile(child, json_format))
+        n_reads = len(store.reads)
+
+        # other tiles from the same metatile only read their member
+        self.assertEqual(
+            str(parent) * 1000,
+            reader.read_metatile_member(
+                parent, Coordinate(zoom=0, column=0, row=0), json_format))
+        self.assertEqual(n_reads + 1, len(store.reads))
+        # and missing tiles only check the metatile hasn't changed
+        self.assertIsNone(reader.read_tile(child, topojson_format))
+        self.assertEqual(n_reads + 2, len(store.reads))
+        self.assertIsNone(
+            reader.read_tile(deserialize_coord('11/0/0'), json_format))
+
+    def test_reindex_when_changed(self):
+        from tilequeue.metatile import MetatileReader
+        from tilequeue.tile import deserialize_coord
+
+        store = self._RangeStore()
+        parent = deserialize_coord('10/4/6')
+        child = deserialize_coord('11/8/12')
+        self._write_metatile(store, parent, lambda coord: 'old')
+        reader = MetatileReader(store, 1)
+        self.assertEqual('old', reader.read_tile(child, json_format))
+
+        self._write_metatile(store, parent, lambda coord: 'newer')
+        self.assertEqual('newer', reader.read_tile(child, json_format))
+
+    def test_tile_added_by_rewrite(self):
+        from tilequeue.metatile import MetatileReader
+        from tilequeue.tile import deserialize_coord
+
+        store = self._RangeStore()
+        parent = deserialize_coord('10/4/6')
+        child = deserialize_coord('11/8/12')
+        self._write_metatile(store, parent, lambda coord: 'old')
+        reader = MetatileReader(store, 1)
+        self.assertIsNone(reader.read_tile(child, topojson_format))
+
+        # the directory is kept, but the metatile has changed since
+        self.assertIsNotNone(reader._cached_index((10, 4, 6)))
+        self._write_metatile(store, parent, lambda coord: 'new',
+                             (json_format, topojson_format))
+        self.assertEqual('new', reader.read_tile(child, topojson_format))
+
+    def test_deleted_metatile(self):
+        import shutil
+        import tempfile
+        from tilequeue.metatile import MetatileReader
+        from tilequeue.store import TileDirectory
+        from tilequeue.tile import deserialize_coord
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            store = TileDirectory(tmpdir)
+            parent = deserialize_coord('10/4/6')
+            child = deserialize_coord('11/8/12')
+            self._write_metatile(store, parent, lambda coord: 'data')
+            reader = MetatileReader(store, 1)
+            self.assertEqual('data', reader.read_tile(child, json_format))
+
+            store.delete_tiles([parent], zip_format)
+            self.assertIsNone(reader.read_tile(child, json_format))
+            self.assertIsNone(reader._cached_index((10, 4, 6)))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_metatile_offset(self):
+        from tilequeue.metatile import metatile_offset
+        from tilequeue.tile import deserialize_coord
+        meta, offset = metatile_offset(deserialize_coord('12/9/13'), 2)
+        self.assertEqual(deserialize_coord('10/2/3'), meta)
+        self.assertEqual(deserialize_coord('2/1/1'), offset)
+        meta, offset = metatile_offset(deserialize_coord('1/1/0'), 2)
+        self.assertEqual(deserialize_coord('0/0/0'), meta)
+        self.assertEqual(deserialize_coord('1/1/0'), offset)
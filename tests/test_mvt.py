@@ -102,3 +102,61 @@ class MapboxVectorTileTest(unittest.TestCase):
 
     def test_metatile_size_4(self):
         self._check_metatile(4)
+
+
+class MvtLayerCacheTest(unittest.TestCase):
+
+    def _feature_layers(self):
+        from shapely.geometry import LineString
+        from shapely.geometry import Point
+        return [
+            dict(name='a', features=[(Point(1, 1), {'x': 1}, 1)]),
+            dict(name='b', features=[
+                (LineString([(0, 0), (5, 5)]), {'y': 'z'}, 2)]),
+        ]
+
+    def _format(self, format_fn, feature_layers):
+        from cStringIO import StringIO
+        fp = StringIO()
+        format_fn(fp, feature_layers, 0, (0, 0, 10, 10), None, 4096)
+        return fp.getvalue()
+
+    def _layer_cache(self):
+        from tilequeue.cache import MemoryCache
+        from tilequeue.format import MvtLayerCache
+        return MvtLayerCache(MemoryCache(1024 * 1024))
+
+    def test_same_as_uncached(self):
+        from tilequeue.format import format_mvt
+        from tilequeue.format import make_format_mvt_cached
+        format_fn = make_format_mvt_cached(self._layer_cache())
+        expected = self._format(format_mvt, self._feature_layers())
+        # the second time is spliced together from the cache
+        for _ in range(2):
+            self.assertEqual(
+                expected, self._format(format_fn, self._feature_layers()))
+
+    def test_unchanged_layers_not_encoded(self):
+        from mock import patch
+        from tilequeue.format import make_format_mvt_cached
+        format_fn = make_format_mvt_cached(self._layer_cache())
+        self._format(format_fn, self._feature_layers())
+
+        feature_layers = self._feature_layers()
+        feature_layers[1]['features'][0][1]['y'] = 'changed'
+        name = 'tilequeue.format.mvt.mvt_encode'
+        with patch(name, return_value='') as encode:
+            self._format(format_fn, feature_layers)
+        self.assertEqual(1, encode.call_count)
+        self.assertEqual('b', encode.call_args[0][0][0]['name'])
+
+    def test_with_mvt_layer_cache(self):
+        from tilequeue.format import json_format
+        from tilequeue.format import mvt_format
+        from tilequeue.format import with_mvt_layer_cache
+        layer_cache = self._layer_cache()
+        self.assertIs(json_format, with_mvt_layer_cache(json_format,
+                                                        layer_cache))
+        cached_format = with_mvt_layer_cache(mvt_format, layer_cache)
+        self.assertEqual(mvt_format, cached_format)
+        self.assertIsNot(mvt_format.format_fn, cached_format.format_fn)
@@ -0,0 +1,170 @@
+"""
+Tests for `tilequeue.query.cache`.
+"""
+import unittest
+
+
+class _Version(object):
+
+    def __init__(self, version):
+        self.version = version
+
+    def __call__(self):
+        return self.version
+
+
+class QueryResultCacheTest(unittest.TestCase):
+
+    def _cache(self, version, **kwargs):
+        from tilequeue.query.cache import QueryResultCache
+        kwargs.setdefault('memory_max_bytes', 1024 * 1024)
+        return QueryResultCache(8, version, **kwargs)
+
+    def test_round_trip(self):
+        from decimal import Decimal
+        cache = self._cache(_Version('1'))
+        rows = [{'__id__': 1, '__geometry__': b'\x01\x02',
+                 'name': u'caf\xe9', 'area': Decimal('1.5')}]
+        cache.put(0, 'select 1', rows)
+
+        cached = cache.get(0, 'select 1')
+        self.assertEqual(rows, cached)
+        self.assertIsInstance(cached[0]['__geometry__'], bytes)
+        self.assertIsInstance(cached[0]['name'], unicode)
+        self.assertIsInstance(cached[0]['area'], Decimal)
+
+        # each get returns new rows, which can be changed by the caller.
+        cached[0]['name'] = 'changed'
+        self.assertEqual(rows, cache.get(0, 'select 1'))
+
+    def test_high_zoom_not_cached(self):
+        cache = self._cache(_Version('1'))
+        cache.put(9, 'select 1', [{'__id__': 1}])
+        self.assertIsNone(cache.get(9, 'select 1'))
+
+    def test_version_change_misses(self):
+        version = _Version('1')
+        cache = self._cache(version)
+        cache.put(0, 'select 1', [{'__id__': 1}])
+        version.version = '2'
+        self.assertIsNone(cache.get(0, 'select 1'))
+
+    def test_prepared_query_key(self):
+        from tilequeue.query.postgres import PreparedQuery
+        cache = self._cache(_Version('1'))
+        cache.put(0, PreparedQuery('a', 'select $1', (1.0,)), [{'x': 1}])
+        self.assertEqual(
+            [{'x': 1}], cache.get(0, PreparedQuery('a', 'select $1', (1.0,))))
+        self.assertIsNone(
+            cache.get(0, PreparedQuery('a', 'select $1', (2.0,))))
+
+    def test_memory_eviction(self):
+        cache = self._cache(_Version('1'), memory_max_bytes=40)
+        cache.put(0, 'a', [{'v': 'x' * 20}])
+        cache.put(0, 'b', [{'v': 'y' * 20}])
+        self.assertIsNone(cache.get(0, 'a'))
+        self.assertEqual([{'v': 'y' * 20}], cache.get(0, 'b'))
+
+    def test_disk_tier(self):
+        import shutil
+        import tempfile
+        from tilequeue.cache import DiskCache
+        tmpdir = tempfile.mkdtemp()
+        try:
+            version = _Version('1')
+            disk_cache = DiskCache(tmpdir, 1024 * 1024)
+            cache = self._cache(version, disk_cache=disk_cache)
+            cache.put(0, 'select 1', [{'__id__': 1}])
+
+            # a new cache, as after a restart, reads from disk
+            cache = self._cache(version, disk_cache=DiskCache(tmpdir, 1024))
+            self.assertEqual([{'__id__': 1}], cache.get(0, 'select 1'))
+
+            version.version = '2'
+            self.assertIsNone(cache.get(0, 'select 1'))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_unserializable_not_cached(self):
+        import datetime
+        cache = self._cache(_Version('1'))
+        cache.put(0, 'select 1', [{'d': datetime.date(2018, 1, 1)}])
+        self.assertIsNone(cache.get(0, 'select 1'))
+
+
+class DataVersionTest(unittest.TestCase):
+
+    def test_version_query_rate_limited(self):
+        from contextlib import contextmanager
+        from tilequeue.query.cache import DataVersion
+
+        class Cursor(object):
+            def __init__(self, pool):
+                self.pool = pool
+
+            def execute(self, query):
+                self.pool.n_queries += 1
+
+            def fetchone(self):
+                return (self.pool.n_queries,)
+
+            def close(self):
+                pass
+
+        class Conn(object):
+            def __init__(self, pool):
+                self.pool = pool
+
+            def cursor(self):
+                return Cursor(self.pool)
+
+        class Pool(object):
+            n_queries = 0
+
+            @contextmanager
+            def get_conns(self, n):
+                yield [Conn(self)]
+
+        pool = Pool()
+        data_version = DataVersion(
+            conn_pool=pool, version_query='select 1', check_interval=3600)
+        self.assertEqual('1', data_version())
+        self.assertEqual('1', data_version())
+        self.assertEqual(1, pool.n_queries)
+
+        data_version.check_interval = 0
+        self.assertEqual('2', data_version())
+
+
+class DataFetcherResultCacheTest(unittest.TestCase):
+
+    def test_cached_queries_skip_database(self):
+        from contextlib import contextmanager
+        from multiprocessing.pool import ThreadPool
+        from tilequeue.query.cache import QueryResultCache
+        from tilequeue.query.postgres import DataFetcher
+
+        class ConnPool(object):
+            requested = []
+
+            @contextmanager
+            def get_conns(self, n):
+                self.requested.append(n)
+                yield [object()] * n
+
+        cache = QueryResultCache(8, _Version('1'), 1024 * 1024)
+        io_pool = ThreadPool(2)
+        try:
+            fetcher = DataFetcher(
+                dict(dbnames=['db']), lambda zoom, bounds: ['q1', 'q2'],
+                io_pool, result_cache=cache)
+            fetcher.sql_conn_pool = ConnPool()
+            fetcher._execute = lambda conn, query, zoom: [{'q': query}]
+            cache.put(0, 'q1', [{'q': 'cached'}])
+
+            rows = fetcher(0, (0, 0, 1, 1))
+        finally:
+            io_pool.close()
+
+        self.assertEqual([{'q': 'cached'}, {'q': 'q2'}], rows)
+        self.assertEqual([1], ConnPool.requested)
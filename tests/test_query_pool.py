@@ -0,0 +1,168 @@
+"""
+Tests for `tilequeue.query.pool`.
+"""
+import unittest
+
+
+class _StubConn(object):
+
+    def __init__(self, dbname, host=None):
+        self.dbname = dbname
+        self.host = host
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class DBConnectionPoolTest(unittest.TestCase):
+
+    def _make_pool(self, reuse_conns, conn_info=None, host_tracker=None):
+        from tilequeue.query.pool import DBConnectionPool
+        pool = DBConnectionPool(
+            ['a', 'b'], conn_info or {}, reuse_conns=reuse_conns,
+            host_tracker=host_tracker)
+        pool._connect = lambda conn_info: _StubConn(
+            conn_info['dbname'], conn_info.get('host'))
+        return pool
+
+    def test_new_conns_closed(self):
+        pool = self._make_pool(False)
+        with pool.get_conns(2) as conns:
+            self.assertEquals(['a', 'b'], [c.dbname for c in conns])
+        self.assertTrue(all(c.closed for c in conns))
+
+    def test_reuse_conns(self):
+        pool = self._make_pool(True)
+        with pool.get_conns(2) as conns1:
+            pass
+        self.assertFalse(any(c.closed for c in conns1))
+        with pool.get_conns(2) as conns2:
+            pass
+        self.assertEquals(
+            sorted(map(id, conns1)), sorted(map(id, conns2)))
+
+    def test_closed_conn_replaced(self):
+        pool = self._make_pool(True)
+        with pool.get_conns(1) as conns1:
+            pool.prepared_statements(conns1[0]).add('stmt')
+            conns1[0].close()
+        self.assertEquals({}, pool.conn_prepared_statements)
+        with pool.get_conns(2) as conns2:
+            self.assertNotIn(conns1[0], conns2)
+            self.assertEquals(set(), pool.prepared_statements(conns2[0]))
+
+    def test_least_loaded_host(self):
+        from tilequeue.query.pool import HostLatencyTracker
+        tracker = HostLatencyTracker(['fast', 'slow'])
+        tracker.start('fast')
+        tracker.finish('fast', 0.1)
+        tracker.start('slow')
+        tracker.finish('slow', 1.0)
+        pool = self._make_pool(
+            True, dict(host=['fast', 'slow']), host_tracker=tracker)
+        with pool.get_conns(2) as conns:
+            self.assertEquals(['fast', 'fast'], [c.host for c in conns])
+
+    def test_track_query(self):
+        from tilequeue.query.pool import HostLatencyTracker
+        tracker = HostLatencyTracker(['h1', 'h2'])
+        pool = self._make_pool(
+            False, dict(host=['h1', 'h2']), host_tracker=tracker)
+        with pool.get_conns(1) as conns:
+            host = conns[0].host
+            with pool.track_query(conns[0]):
+                self.assertEquals(1, tracker.in_flight[host])
+        self.assertEquals(0, tracker.in_flight[host])
+        self.assertIsNotNone(tracker.latency[host])
+        self.assertEquals({}, pool.conn_dbname_hosts)
+
+    def test_conns_spread_over_hosts(self):
+        from tilequeue.query.pool import HostLatencyTracker
+        tracker = HostLatencyTracker(['h1', 'h2'])
+        for host in ('h1', 'h2'):
+            tracker.start(host)
+            tracker.finish(host, 1.0)
+        pool = self._make_pool(
+            False, dict(host=['h1', 'h2']), host_tracker=tracker)
+        with pool.get_conns(2) as conns:
+            self.assertEquals(['h1', 'h2'], sorted(c.host for c in conns))
+
+    def test_failed_query_backs_off(self):
+        from tilequeue.query.pool import HostLatencyTracker
+        tracker = HostLatencyTracker(['h1', 'h2'])
+        tracker.start('h2')
+        tracker.finish('h2', 1.0)
+        pool = self._make_pool(
+            False, dict(host=['h1', 'h2']), host_tracker=tracker)
+        with pool.get_conns(1) as conns:
+            self.assertEquals('h1', conns[0].host)
+            with self.assertRaises(ValueError):
+                with pool.track_query(conns[0]):
+                    raise ValueError('query failed')
+        self.assertEquals(['h2', 'h2'], tracker.choose_many(2))
+
+    def test_alternate_conn(self):
+        from tilequeue.query.pool import HostLatencyTracker
+        tracker = HostLatencyTracker(['h1', 'h2'])
+        pool = self._make_pool(
+            False, dict(host=['h1', 'h2']), host_tracker=tracker)
+        with pool.get_conns(1) as conns:
+            with pool.get_alternate_conn(conns[0]) as alternate_conns:
+                self.assertEquals(conns[0].dbname, alternate_conns[0].dbname)
+                self.assertNotEquals(conns[0].host, alternate_conns[0].host)
+
+    def test_no_alternate_conn_with_single_host(self):
+        from tilequeue.query.pool import HostLatencyTracker
+        tracker = HostLatencyTracker(['h1'])
+        pool = self._make_pool(False, dict(host=['h1']), host_tracker=tracker)
+        with pool.get_conns(1) as conns:
+            self.assertIsNone(pool.get_alternate_conn(conns[0]))
+
+
+class HostLatencyTrackerTest(unittest.TestCase):
+
+    def test_in_flight_counts_towards_load(self):
+        from tilequeue.query.pool import HostLatencyTracker
+        tracker = HostLatencyTracker(['h1', 'h2'])
+        for host in ('h1', 'h2'):
+            tracker.start(host)
+            tracker.finish(host, 1.0)
+        tracker.start('h1')
+        self.assertEquals('h2', tracker.choose())
+        self.assertEquals('h1', tracker.choose(exclude=('h2',)))
+        self.assertIsNone(tracker.choose(exclude=('h1', 'h2')))
+
+    def test_cancelled_query_not_a_failure(self):
+        from psycopg2.extensions import QueryCanceledError
+        from tilequeue.query.pool import DBConnectionPool
+        from tilequeue.query.pool import HostLatencyTracker
+        tracker = HostLatencyTracker(['h1', 'h2'])
+        tracker.start('h1')
+        tracker.finish('h1', None, failed=True)
+        self.assertEquals('h2', tracker.choose())
+        self.assertEquals('h1', tracker.choose(exclude=('h2',)))
+
+        pool = DBConnectionPool(['a'], dict(host=['h1', 'h2']),
+                                host_tracker=tracker)
+        pool._connect = lambda conn_info: _StubConn(
+            conn_info['dbname'], conn_info.get('host'))
+        tracker.failed_until['h1'] = 0
+        with pool.get_conns(1) as conns:
+            host = conns[0].host
+            with self.assertRaises(QueryCanceledError):
+                with pool.track_query(conns[0]):
+                    raise QueryCanceledError()
+        self.assertEquals(0, tracker.failed_until[host])
+
+
+class LatencyPercentilesTest(unittest.TestCase):
+
+    def test_percentile(self):
+        from tilequeue.query.pool import LatencyPercentiles
+        percentiles = LatencyPercentiles()
+        for i in range(100):
+            percentiles.add(0, float(i))
+        self.assertEquals(95.0, percentiles.percentile(0, 95, 10))
+        self.assertIsNone(percentiles.percentile(1, 95, 10))
+        self.assertIsNone(percentiles.percentile(0, 95, 1000))
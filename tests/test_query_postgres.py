@@ -0,0 +1,378 @@
+"""
+Tests for `tilequeue.query.postgres`.
+"""
+import unittest
+
+
+class _StubCursor(object):
+
+    def __init__(self, description, rows):
+        self.description = None
+        self._description = description
+        self.rows = list(rows)
+        self.closed = False
+
+    def execute(self, query):
+        self.query = query
+
+    def fetchmany(self, size):
+        batch = self.rows[:size]
+        self.rows = self.rows[size:]
+        self.description = self._description
+        return batch
+
+    def close(self):
+        self.closed = True
+
+
+class _StubConn(object):
+
+    def __init__(self, cursor):
+        self.cursor_obj = cursor
+        self.autocommit = True
+        self.rolled_back = False
+        self.closed = False
+
+    def cursor(self, name=None):
+        self.cursor_name = name
+        self.autocommit_in_query = self.autocommit
+        return self.cursor_obj
+
+    def rollback(self):
+        self.rolled_back = True
+
+    def close(self):
+        self.closed = True
+
+
+class ExecuteQueryStreamingTest(unittest.TestCase):
+
+    def test_rows_built_in_final_form(self):
+        from tilequeue.query.postgres import execute_query_streaming
+        description = [('__id__',), ('__geometry__',), ('name',)]
+        rows = [
+            (1, buffer('wkb1'), 'foo'),
+            (2, buffer('wkb2'), None),
+            (3, buffer('wkb3'), 'bar'),
+        ]
+        cursor = _StubCursor(description, rows)
+        conn = _StubConn(cursor)
+
+        result = execute_query_streaming(conn, 'select 1', 2)
+
+        self.assertEquals([
+            dict(__id__=1, __geometry__='wkb1', name='foo'),
+            dict(__id__=2, __geometry__='wkb2'),
+            dict(__id__=3, __geometry__='wkb3', name='bar'),
+        ], result)
+        self.assertIs(bytes, type(result[0]['__geometry__']))
+        self.assertIsNotNone(conn.cursor_name)
+        # the query ran in a transaction, and autocommit was put back
+        self.assertFalse(conn.autocommit_in_query)
+        self.assertTrue(conn.autocommit)
+        self.assertTrue(conn.rolled_back)
+        self.assertTrue(cursor.closed)
+
+    def test_empty_result(self):
+        from tilequeue.query.postgres import execute_query_streaming
+        conn = _StubConn(_StubCursor([('__id__',)], []))
+        self.assertEquals([], execute_query_streaming(conn, 'select 1', 10))
+
+    def test_error_closes_connection(self):
+        from tilequeue.query.postgres import execute_query_streaming
+
+        class failing_cursor(_StubCursor):
+            def execute(self, query):
+                raise ValueError('query failed')
+
+        conn = _StubConn(failing_cursor([], []))
+        with self.assertRaises(ValueError):
+            execute_query_streaming(conn, 'select 1', 10)
+        self.assertTrue(conn.rolled_back)
+        self.assertTrue(conn.autocommit)
+        self.assertTrue(conn.closed)
+
+
+class _Source(object):
+
+    def __init__(self, name, template_specs):
+        self.name = name
+        self.template_specs = template_specs
+
+
+class PreparedQueriesTest(unittest.TestCase):
+
+    def _make_generator(self, templates, prepare_statements=True):
+        from jinja2 import DictLoader
+        from jinja2 import Environment
+        from tilequeue.query.postgres import make_jinja_environment
+        from tilequeue.query.postgres import PreparedSourcesQueriesGenerator
+        from tilequeue.query.postgres import SourcesQueriesGenerator
+        from tilequeue.query.postgres import TemplateFinder
+        from tilequeue.query.postgres import TemplateQueryGenerator
+        from tilequeue.query.postgres import TemplateSpec
+
+        environment = Environment(loader=DictLoader(templates))
+        environment.filters = dict(
+            environment.filters, **make_jinja_environment('.').filters)
+        query_generator = TemplateQueryGenerator(
+            TemplateFinder(environment, True))
+        sources = [_Source(name, [TemplateSpec(name, 0, 21)])
+                   for name in sorted(templates)]
+        if prepare_statements:
+            return PreparedSourcesQueriesGenerator(sources, query_generator)
+        return SourcesQueriesGenerator(sources, query_generator)
+
+    def test_bounds_as_parameters(self):
+        from tilequeue.query.postgres import PreparedQuery
+        generator = self._make_generator({
+            'a': 'SELECT {{ zoom }} WHERE '
+                 '{{ bounds.polygon|bbox_filter("way") }} AND '
+                 '{{ bounds.polygon|bbox_padded_intersection("way", 2.0) }}',
+        })
+        bounds = (0.0, 0.0, 10.0, 10.0)
+        queries = generator(5, bounds)
+
+        self.assertEquals(1, len(queries))
+        query = queries[0]
+        self.assertIsInstance(query, PreparedQuery)
+        self.assertIn('SELECT 5 ', query.sql)
+        self.assertIn('$1::float8', query.sql)
+        self.assertIn('$8::float8', query.sql)
+        self.assertNotIn('10.0', query.sql)
+        self.assertEquals(
+            [0.0, 0.0, 10.0, 10.0, -5.0, -5.0, 15.0, 15.0], query.values)
+
+        # the statement is rendered once per zoom
+        other_query = generator(5, (1.0, 1.0, 2.0, 2.0))[0]
+        self.assertEquals(query.name, other_query.name)
+        self.assertNotEquals(query.name, generator(6, bounds)[0].name)
+
+    def test_same_sql_as_literal(self):
+        templates = {
+            'a': 'SELECT 1 WHERE {{ bounds.polygon|bbox_filter("way") }}',
+        }
+        bounds = (0.5, 1.5, 2.5, 3.5)
+        prepared = self._make_generator(templates)(5, bounds)[0]
+        literal = self._make_generator(templates, False)(5, bounds)[0]
+        sql = prepared.sql
+        for i, value in enumerate(prepared.values):
+            sql = sql.replace('$%d::float8' % (i + 1), '%.12f' % value)
+        self.assertEquals(literal, sql)
+
+    def test_unpreparable_falls_back(self):
+        generator = self._make_generator({
+            'a': 'SELECT {{ bounds.polygon[0] }}',
+        })
+        queries = generator(5, (0.5, 1.5, 2.5, 3.5))
+        self.assertEquals(['SELECT 0.5'], queries)
+
+    def test_execute_prepares_once(self):
+        from tilequeue.query.postgres import execute_prepared_query
+        from tilequeue.query.postgres import PreparedQuery
+
+        class stub_cursor(object):
+            description = [('__id__',), ('name',)]
+
+            def __init__(self, executed):
+                self.executed = executed
+
+            def execute(self, sql, params=None):
+                self.executed.append((sql, params))
+
+            def fetchall(self):
+                return [(1, 'foo'), (2, None)]
+
+            def close(self):
+                pass
+
+        class stub_conn(object):
+            def __init__(self):
+                self.executed = []
+
+            def cursor(self):
+                return stub_cursor(self.executed)
+
+        conn = stub_conn()
+        prepared_statements = set()
+        query = PreparedQuery('tilequeue_x', 'SELECT $1', [1.0])
+        for _ in range(2):
+            rows = execute_prepared_query(conn, query, prepared_statements)
+            self.assertEquals([dict(__id__=1, name='foo'), dict(__id__=2)],
+                              rows)
+
+        self.assertEquals([
+            ('PREPARE tilequeue_x AS SELECT $1', None),
+            ('EXECUTE tilequeue_x (%s)', [1.0]),
+            ('EXECUTE tilequeue_x (%s)', [1.0]),
+        ], conn.executed)
+        self.assertEquals(set(['tilequeue_x']), prepared_statements)
+
+
+class _HedgeConn(object):
+
+    def __init__(self, name):
+        import threading
+        self.name = name
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+
+class _HedgeConnPool(object):
+
+    def __init__(self, alternate_conn):
+        self.alternate_conn = alternate_conn
+
+    def get_alternate_conn(self, conn):
+        from contextlib import contextmanager
+
+        @contextmanager
+        def alternate_conn_ctx():
+            yield [self.alternate_conn]
+
+        if self.alternate_conn is None:
+            return None
+        return alternate_conn_ctx()
+
+
+class QueryHedgerTest(unittest.TestCase):
+
+    def _hedger(self, alternate_conn):
+        from tilequeue.query.postgres import QueryHedger
+        hedger = QueryHedger(_HedgeConnPool(alternate_conn), 50, 1)
+        hedger.latencies.add(0, 0.01)
+        return hedger
+
+    def test_no_hedge_without_samples(self):
+        from tilequeue.query.postgres import QueryHedger
+        hedger = QueryHedger(_HedgeConnPool(None), 50, 1)
+        conn = _HedgeConn('primary')
+        self.assertEquals('primary', hedger(lambda c: c.name, conn, 0))
+        self.assertEquals(1, len(hedger.latencies.samples[0]))
+
+    def test_slow_query_hedged_and_cancelled(self):
+        primary = _HedgeConn('primary')
+        alternate = _HedgeConn('alternate')
+
+        def run_query(conn):
+            if conn is primary:
+                # blocks until cancelled, like a slow query would
+                conn.cancelled.wait(5)
+                raise Exception('cancelled')
+            return conn.name
+
+        hedger = self._hedger(alternate)
+        self.assertEquals('alternate', hedger(run_query, primary, 0))
+        self.assertTrue(primary.cancelled.is_set())
+        self.assertFalse(alternate.cancelled.is_set())
+
+    def test_hedge_falls_back_on_failure(self):
+        import threading
+        primary = _HedgeConn('primary')
+        alternate = _HedgeConn('alternate')
+        primary_done = threading.Event()
+
+        def run_query(conn):
+            if conn is alternate:
+                raise Exception('replica error')
+            primary_done.wait(0.1)
+            return conn.name
+
+        hedger = self._hedger(alternate)
+        self.assertEquals('primary', hedger(run_query, primary, 0))
+
+    def test_single_host_waits(self):
+        import threading
+        primary = _HedgeConn('primary')
+        wait = threading.Event()
+
+        def run_query(conn):
+            wait.wait(0.1)
+            return conn.name
+
+        hedger = self._hedger(None)
+        self.assertEquals('primary', hedger(run_query, primary, 0))
+
+
+class CompactGeometryFilterTest(unittest.TestCase):
+
+    def _render(self, twkb_detail_zooms, zoom):
+        from jinja2 import DictLoader
+        from tilequeue.query.postgres import make_jinja_environment
+        environment = make_jinja_environment('.', twkb_detail_zooms)
+        environment.loader = DictLoader(
+            {'t.jinja': "SELECT {{ 'way' | compact_geometry }}"})
+        return environment.get_template('t.jinja').render(zoom=zoom)
+
+    def test_wkb_by_default(self):
+        self.assertEquals('SELECT ST_AsBinary(way)', self._render(None, 5))
+
+    def test_twkb_precision_for_zoom(self):
+        from tilequeue.twkb import twkb_precision
+        self.assertEquals(
+            'SELECT ST_AsTWKB(way, %d)' % twkb_precision(14, 2),
+            self._render(2, 14))
+
+
+class MultiZoomFetchTest(unittest.TestCase):
+
+    def _fetcher(self, sources, rows, multi_zoom=True):
+        from tilequeue.query.postgres import DataFetcher
+        from tilequeue.query.postgres import SourcesQueriesGenerator
+
+        fetched_zooms = []
+
+        class Fetcher(DataFetcher):
+            def __call__(self, zoom, unpadded_bounds):
+                fetched_zooms.append(zoom)
+                return rows
+
+        queries_generator = SourcesQueriesGenerator(sources, None)
+        fetcher = Fetcher(
+            dict(dbnames=['db']), queries_generator, None,
+            multi_zoom=multi_zoom)
+        return fetcher, fetched_zooms
+
+    def _sources(self, *template_specs):
+        from tilequeue.query.postgres import DataSource
+        from tilequeue.query.postgres import TemplateSpec
+        return [DataSource('src', [TemplateSpec(*spec)
+                                   for spec in template_specs])]
+
+    def test_fetched_once_and_filtered(self):
+        rows = [
+            dict(__id__=1, __roads_properties__=dict(min_zoom=3)),
+            dict(__id__=2, __roads_properties__=dict(min_zoom=5.5),
+                 __pois_properties__=dict(min_zoom=1)),
+            dict(__id__=3, __roads_properties__=dict(min_zoom=6)),
+        ]
+        fetcher, fetched_zooms = self._fetcher(
+            self._sources(('t.jinja', 0, 21)), rows)
+
+        rows_by_zoom = fetcher.fetch_zooms([4, 5, 6], (0, 0, 1, 1))
+
+        self.assertEquals([6], fetched_zooms)
+        self.assertIs(rows, rows_by_zoom[6])
+        self.assertEquals([1, 2], [r['__id__'] for r in rows_by_zoom[5]])
+        self.assertEquals([1, 2], [r['__id__'] for r in rows_by_zoom[4]])
+        self.assertIsNone(rows_by_zoom[4][1]['__roads_properties__'])
+        self.assertEquals(
+            dict(min_zoom=5.5), rows_by_zoom[5][1]['__roads_properties__'])
+        # the rows are copies, and the originals are unchanged
+        self.assertEquals(
+            dict(min_zoom=5.5), rows[1]['__roads_properties__'])
+
+    def test_zoom_bands_fetched_separately(self):
+        fetcher, fetched_zooms = self._fetcher(
+            self._sources(('low.jinja', 0, 5), ('high.jinja', 5, 21)), [])
+        rows_by_zoom = fetcher.fetch_zooms([3, 4, 5, 6], (0, 0, 1, 1))
+        self.assertEquals([4, 6], sorted(fetched_zooms))
+        self.assertEquals([3, 4, 5, 6], sorted(rows_by_zoom))
+
+    def test_disabled(self):
+        fetcher, fetched_zooms = self._fetcher(
+            self._sources(('t.jinja', 0, 21)), [], multi_zoom=False)
+        fetcher.fetch_zooms([4, 5, 6], (0, 0, 1, 1))
+        self.assertEquals([4, 5, 6], sorted(fetched_zooms))
@@ -38,7 +38,7 @@ class RawrTestCase(unittest.TestCase):
 
     def _make(self, min_zoom_fn, props_fn, tables, tile_pyramid,
               layer_name='testlayer', label_placement_layers={},
-              min_z=10, max_z=16):
+              min_z=10, max_z=16, narrow_candidates=False):
         from tilequeue.query.common import LayerInfo
         from tilequeue.query.rawr import make_rawr_data_fetcher
 
@@ -47,7 +47,8 @@ class RawrTestCase(unittest.TestCase):
         indexes_cfg = [dict(type='osm')]
         return make_rawr_data_fetcher(
             min_z, max_z, storage, layers, indexes_cfg,
-            label_placement_layers=label_placement_layers)
+            label_placement_layers=label_placement_layers,
+            narrow_candidates=narrow_candidates)
 
 
 # the call to DataFetcher.fetch_tiles wants a list of "data" dictionaries,
@@ -674,6 +675,119 @@ class TestMeta(RawrTestCase):
                           read_row.get('__testlayer_properties__'))
 
 
+class TestNarrowCandidates(RawrTestCase):
+
+    def test_same_rows_as_index_lookup(self):
+        # fetching a pyramid top-down, with each tile narrowing the features
+        # found for its parent, should give the same rows as looking each
+        # tile up in the index.
+        from shapely.geometry import LineString
+        from shapely.geometry import Point
+        from tilequeue.query.rawr import TilePyramid
+        from tilequeue.tile import coord_children_preorder
+        from tilequeue.tile import coord_to_mercator_bounds
+        from tilequeue.tile import mercator_point_to_coord
+
+        def min_zoom_fn(shape, props, fid, meta):
+            return props['min_zoom']
+
+        def props_fn(shape, props, fid, meta):
+            return {}
+
+        coord = mercator_point_to_coord(10, 0, 0)
+        minx, miny, maxx, maxy = coord_to_mercator_bounds(coord)
+        dx = (maxx - minx) / 8.0
+        dy = (maxy - miny) / 8.0
+        tables = TestGetTable({
+            'planet_osm_point': [
+                (1, Point(minx + dx, miny + dy).wkb, dict(min_zoom=10)),
+                (2, Point(maxx - dx, maxy - dy).wkb, dict(min_zoom=11.5)),
+                (3, Point(minx + 3 * dx, maxy - dy).wkb, dict(min_zoom=12)),
+            ],
+            'planet_osm_line': [
+                (4, LineString([(minx + dx, miny + dy),
+                                (maxx - dx, maxy - dy)]).wkb,
+                 dict(min_zoom=11)),
+            ],
+        })
+        tile_pyramid = TilePyramid(10, coord.column, coord.row, 12)
+
+        pyramid = [coord] + list(coord_children_preorder(coord, 12))
+        rows_by_narrowing = {}
+        for narrow_candidates in (False, True):
+            fetcher = self._make(
+                min_zoom_fn, props_fn, tables, tile_pyramid, max_z=12,
+                narrow_candidates=narrow_candidates)
+            for fetch, data in fetcher.fetch_tiles(
+                    [dict(coord=c) for c in pyramid]):
+                c = data['coord']
+                rows = fetch(c.zoom, coord_to_mercator_bounds(c))
+                ids = sorted(row['__id__'] for row in rows)
+                rows_by_narrowing.setdefault(narrow_candidates, []).append(
+                    (c, ids))
+
+        self.assertEquals(rows_by_narrowing[False], rows_by_narrowing[True])
+        # check that the test covers some features
+        self.assertTrue(any(ids for _, ids in rows_by_narrowing[True]))
+
+
+class PayloadStorage(object):
+
+    def __init__(self, tables):
+        self.tables = tables
+
+    def read_payload(self, top_tile):
+        return 'payload'
+
+    def unpack(self, payload):
+        assert payload == 'payload'
+        return self.tables
+
+
+class TestIndexInProcessors(RawrTestCase):
+
+    def test_deferred_fetch(self):
+        # with index_in_processors, each RAWR tile is handed out once with
+        # all the jobs which need it, and can be sent to another process to
+        # be fetched from.
+        import pickle
+        from shapely.geometry import Point
+        from tilequeue.query.common import LayerInfo
+        from tilequeue.query.rawr import DataFetcher
+        from tilequeue.tile import coord_children_range
+        from tilequeue.tile import coord_to_mercator_bounds
+        from tilequeue.tile import mercator_point_to_coord
+
+        def min_zoom_fn(shape, props, fid, meta):
+            return 10
+
+        def props_fn(shape, props, fid, meta):
+            return {}
+
+        coord = mercator_point_to_coord(10, 0, 0)
+        minx, miny, maxx, maxy = coord_to_mercator_bounds(coord)
+        tables = TestGetTable({
+            'planet_osm_point': [
+                (1, Point(minx + 1, miny + 1).wkb, {}),
+            ],
+        })
+        layers = {'testlayer': LayerInfo(min_zoom_fn, props_fn)}
+        fetcher = DataFetcher(
+            10, 16, PayloadStorage(tables), layers, [dict(type='osm')], {},
+            index_in_processors=True)
+
+        coords = [coord] + list(coord_children_range(coord, 11))
+        fetched = list(fetcher.fetch_tiles([dict(coord=c) for c in coords]))
+        self.assertEquals(1, len(fetched))
+        deferred, all_data = fetched[0]
+        self.assertTrue(deferred.deferred)
+        self.assertEquals(coords, [data['coord'] for data in all_data])
+
+        fetch = fetcher.fetch_deferred(pickle.loads(pickle.dumps(deferred)))
+        rows = fetch(10, coord_to_mercator_bounds(coord))
+        self.assertEquals([1], [row['__id__'] for row in rows])
+
+
 class TestTileFootprint(unittest.TestCase):
 
     def test_single_tile(self):
@@ -36,3 +36,21 @@ class TestQuerySplit(unittest.TestCase):
         # be the same objects in memory, so even an id() based sorting should
         # work.
         self.assertEquals(sorted(expected), sorted(result))
+
+    def test_prefetch(self):
+        from tilequeue.query.split import make_split_data_fetcher
+
+        class _PrefetchFetcher(_NullFetcher):
+            def __init__(self):
+                self.prefetched = []
+
+            def prefetch(self, coord):
+                self.prefetched.append(coord)
+
+        below = _NullFetcher()
+        above = _PrefetchFetcher()
+        splitter = make_split_data_fetcher(10, below, above)
+
+        splitter.prefetch(_c(9, 0, 0))
+        splitter.prefetch(_c(10, 0, 0))
+        self.assertEquals([_c(10, 0, 0)], above.prefetched)
@@ -47,3 +47,403 @@ class RawrKeyTest(unittest.TestCase):
                 key_format_type=KeyFormatType.hash_prefix)
         key = tile_key_gen(prefix, coord, extension)
         self.assertEqual('c35b6/19851026/10/1/2.zip', key)
+
+
+class RawrConnectionPoolTest(unittest.TestCase):
+
+    def _make_stub_conn_ctx(self):
+        class stub_conn_ctx(object):
+            def __init__(self):
+                self.n_opened = 0
+                self.n_closed = 0
+
+            def __call__(self):
+                factory = self
+
+                class ctx(object):
+                    def __enter__(self):
+                        factory.n_opened += 1
+                        return type('stub-conn', (), dict(closed=False))()
+
+                    def __exit__(self, exc_type, exc_val, exc_tb):
+                        factory.n_closed += 1
+
+                return ctx()
+        return stub_conn_ctx()
+
+    def test_reuses_connection(self):
+        from tilequeue.rawr import RawrConnectionPool
+        conn_ctx = self._make_stub_conn_ctx()
+        pool = RawrConnectionPool(conn_ctx, 2)
+        with pool() as conn1:
+            pass
+        with pool() as conn2:
+            pass
+        self.assertIs(conn1, conn2)
+        self.assertEquals(1, conn_ctx.n_opened)
+        self.assertEquals(0, conn_ctx.n_closed)
+
+    def test_max_idle(self):
+        from tilequeue.rawr import RawrConnectionPool
+        conn_ctx = self._make_stub_conn_ctx()
+        pool = RawrConnectionPool(conn_ctx, 1)
+        with pool():
+            with pool():
+                pass
+        self.assertEquals(2, conn_ctx.n_opened)
+        self.assertEquals(1, conn_ctx.n_closed)
+
+    def test_closes_on_exception(self):
+        from tilequeue.rawr import RawrConnectionPool
+        conn_ctx = self._make_stub_conn_ctx()
+        pool = RawrConnectionPool(conn_ctx, 2)
+        with self.assertRaises(ValueError):
+            with pool():
+                raise ValueError('boom')
+        self.assertEquals(1, conn_ctx.n_closed)
+        with pool():
+            pass
+        self.assertEquals(2, conn_ctx.n_opened)
+
+
+class RawrAsyncSinkTest(unittest.TestCase):
+
+    def test_write_in_background(self):
+        from multiprocessing.pool import ThreadPool
+        from tilequeue.rawr import RawrAsyncSink
+        written = []
+        io_pool = ThreadPool(1)
+        sink = RawrAsyncSink(written.append, io_pool)
+        self.assertIsNone(sink.take_pending())
+        sink('tile')
+        pending = sink.take_pending()
+        timing = pending.get()
+        self.assertEquals(['tile'], written)
+        self.assertIn('upload', timing)
+        self.assertIsNone(sink.take_pending())
+        io_pool.terminate()
+
+    def test_write_failure(self):
+        from multiprocessing.pool import ThreadPool
+        from tilequeue.rawr import RawrAsyncSink
+
+        def failing_sink(rawr_tile):
+            raise ValueError('upload failed')
+
+        io_pool = ThreadPool(1)
+        sink = RawrAsyncSink(failing_sink, io_pool)
+        sink('tile')
+        with self.assertRaises(ValueError):
+            sink.take_pending().get()
+        io_pool.terminate()
+
+
+class ConcurrentRawrTileGenerationPipelineTest(unittest.TestCase):
+
+    def _make_stub_conn_ctx(self):
+        from contextlib import contextmanager
+
+        class stub_conn(object):
+            def __enter__(self):
+                return self
+
+            def __exit__(self, exc_type, exc_val, exc_tb):
+                pass
+
+            def cursor(self):
+                return self
+
+        @contextmanager
+        def conn_ctx():
+            yield stub_conn()
+        return conn_ctx
+
+    def test_all_jobs_processed(self):
+        from multiprocessing.pool import ThreadPool
+        from tilequeue.queue.message import SingleMessageMarshaller
+        from tilequeue.rawr import ConcurrentRawrTileGenerationPipeline
+        from tilequeue.rawr import RawrAsyncSink
+        from tilequeue.rawr import RawrFileQueue
+        from tilequeue.rawr import unconvert_coord_object
+        from tilequeue.tile import deserialize_coord
+        import tempfile
+        import threading
+
+        coords = [deserialize_coord('10/%d/1' % x) for x in range(8)]
+        with tempfile.NamedTemporaryFile() as fh:
+            for coord in coords:
+                fh.write('%d/%d/%d\n' % (coord.zoom, coord.column, coord.row))
+            fh.flush()
+            msg_marshaller = SingleMessageMarshaller()
+            rawr_queue = RawrFileQueue(fh.name, msg_marshaller)
+
+        lock = threading.Lock()
+        uploaded = []
+        enqueued = []
+
+        def sink(tile):
+            with lock:
+                uploaded.append(unconvert_coord_object(tile))
+
+        io_pool = ThreadPool(2)
+        async_sink = RawrAsyncSink(sink, io_pool)
+
+        def rawr_gen(table_reader, tile):
+            async_sink(tile)
+            return dict(source=1)
+
+        class stub_queue_writer(object):
+            def enqueue_batch(self, coords):
+                enqueued.extend(coords)
+                return len(coords), 0
+
+        class stub_logger(object):
+            def __init__(self):
+                self.errors = []
+                self.timings = []
+
+            def lifecycle(self, msg):
+                pass
+
+            def error(self, msg, exception, stacktrace, parent_coord):
+                self.errors.append(msg)
+
+            def processed(self, n_enqueued, n_inflight, did_rawr_tile_gen,
+                          timing, parent_coord):
+                self.timings.append(timing)
+
+        rawr_proc_logger = stub_logger()
+        pipeline = ConcurrentRawrTileGenerationPipeline(
+            rawr_queue, msg_marshaller, 10, rawr_gen, stub_queue_writer(),
+            lambda *args: None, rawr_proc_logger, self._make_stub_conn_ctx(),
+            3, 2, async_sink)
+        with self.assertRaises(SystemExit):
+            pipeline()
+        io_pool.terminate()
+
+        self.assertEquals([], rawr_proc_logger.errors)
+        self.assertEquals(set(coords), set(uploaded))
+        self.assertEquals(set(coords), set(enqueued))
+        for timing in rawr_proc_logger.timings:
+            self.assertIn('queue_read', timing)
+            self.assertIn('upload_wait', timing)
+            self.assertIn('upload', timing['rawr_gen'])
+            self.assertIn('source', timing['rawr_gen'])
+
+
+class RawrPrefetcherTest(unittest.TestCase):
+
+    def _make_stub_source(self, payloads):
+        import threading
+
+        class stub_source(object):
+            def __init__(self):
+                self.reads = []
+                self.read_event = threading.Event()
+
+            def read_payload(self, tile):
+                self.reads.append(tile)
+                self.read_event.set()
+                return payloads[tile]
+
+            def unpack(self, payload):
+                return 'unpacked:%s' % payload
+
+            def __call__(self, tile):
+                return self.unpack(self.read_payload(tile))
+
+        return stub_source()
+
+    def test_prefetched_tile(self):
+        from multiprocessing.pool import ThreadPool
+        from raw_tiles.tile import Tile
+        from tilequeue.rawr import RawrPrefetcher
+        tile = Tile(10, 1, 2)
+        source = self._make_stub_source({tile: 'abc'})
+        io_pool = ThreadPool(1)
+        prefetcher = RawrPrefetcher(source, io_pool, 1024)
+        prefetcher.prefetch(tile)
+        prefetcher.prefetch(tile)
+        self.assertEquals('unpacked:abc', prefetcher(tile))
+        self.assertEquals([tile], source.reads)
+        self.assertEquals(0, prefetcher.n_bytes)
+        # once claimed, the tile isn't held any more
+        self.assertEquals('unpacked:abc', prefetcher(tile))
+        self.assertEquals([tile, tile], source.reads)
+        io_pool.terminate()
+
+    def test_failed_prefetch_read_again(self):
+        from multiprocessing.pool import ThreadPool
+        from raw_tiles.tile import Tile
+        from tilequeue.rawr import RawrPrefetcher
+        tile = Tile(10, 1, 2)
+        source = self._make_stub_source({tile: 'abc'})
+        read_payload = source.read_payload
+        failures = []
+
+        def _fail_once(tile):
+            if failures:
+                raise failures.pop()
+            return read_payload(tile)
+        source.read_payload = _fail_once
+
+        io_pool = ThreadPool(1)
+        for unpack_in_background in (True, False):
+            failures.append(Exception('read failed'))
+            prefetcher = RawrPrefetcher(
+                source, io_pool, 1024,
+                unpack_in_background=unpack_in_background)
+            prefetcher.prefetch(tile)
+            prefetcher.prefetches[(10, 1, 2)].result.wait()
+            self.assertEquals('unpacked:abc', prefetcher(tile))
+            self.assertEquals(0, prefetcher.n_in_flight)
+
+        failures.append(Exception('read failed'))
+        prefetcher = RawrPrefetcher(
+            source, io_pool, 1024, unpack_in_background=False)
+        prefetcher.prefetch(tile)
+        self.assertEquals('abc', prefetcher.read_payload(tile))
+        io_pool.terminate()
+
+    def test_not_prefetched(self):
+        from multiprocessing.pool import ThreadPool
+        from raw_tiles.tile import Tile
+        from tilequeue.rawr import RawrPrefetcher
+        tile = Tile(10, 1, 2)
+        source = self._make_stub_source({tile: 'abc'})
+        io_pool = ThreadPool(1)
+        prefetcher = RawrPrefetcher(source, io_pool, 1024)
+        self.assertEquals('unpacked:abc', prefetcher(tile))
+        io_pool.terminate()
+
+    def test_byte_budget(self):
+        from multiprocessing.pool import ThreadPool
+        from raw_tiles.tile import Tile
+        from tilequeue.rawr import RawrPrefetcher
+        tile1 = Tile(10, 1, 1)
+        tile2 = Tile(10, 2, 2)
+        tile3 = Tile(10, 3, 3)
+        source = self._make_stub_source({
+            tile1: 'x' * 6, tile2: 'y' * 6, tile3: 'z' * 6})
+        io_pool = ThreadPool(1)
+        prefetcher = RawrPrefetcher(source, io_pool, 10)
+
+        self.assertTrue(prefetcher.prefetch(tile1))
+        prefetcher.prefetches[(10, 1, 1)].result.wait()
+        self.assertEquals(6, prefetcher.n_bytes)
+
+        # going over the budget drops the newest payload, as the oldest is
+        # the one which will be needed next
+        prefetcher.prefetch(tile2)
+        prefetcher.prefetches[(10, 2, 2)].result.wait()
+        self.assertEquals(6, prefetcher.n_bytes)
+        self.assertEquals([(10, 1, 1)], prefetcher.prefetches.keys())
+
+        # and nothing new is started while at the budget
+        prefetcher.max_bytes = 6
+        self.assertFalse(prefetcher.prefetch(tile3))
+        self.assertNotIn((10, 3, 3), prefetcher.prefetches)
+        io_pool.terminate()
+
+    def test_payloads_kept_when_not_unpacking(self):
+        from multiprocessing.pool import ThreadPool
+        from raw_tiles.tile import Tile
+        from tilequeue.rawr import RawrPrefetcher
+        tile = Tile(10, 1, 2)
+        source = self._make_stub_source({tile: 'abc'})
+        io_pool = ThreadPool(1)
+        prefetcher = RawrPrefetcher(
+            source, io_pool, 1024, unpack_in_background=False)
+        prefetcher.prefetch(tile)
+        self.assertEquals('abc', prefetcher.read_payload(tile))
+        self.assertEquals([tile], source.reads)
+        io_pool.terminate()
+
+    def test_in_flight_counted(self):
+        import threading
+        from multiprocessing.pool import ThreadPool
+        from raw_tiles.tile import Tile
+        from tilequeue.rawr import RawrPrefetcher
+        tile1 = Tile(10, 1, 1)
+        tile2 = Tile(10, 2, 2)
+        source = self._make_stub_source({tile1: 'x' * 6, tile2: 'y' * 6})
+        read_payload = source.read_payload
+        release = threading.Event()
+
+        def _slow_read_payload(tile):
+            release.wait()
+            return read_payload(tile)
+        source.read_payload = _slow_read_payload
+        io_pool = ThreadPool(2)
+        prefetcher = RawrPrefetcher(source, io_pool, 1024, max_in_flight=1)
+
+        # the second isn't started while the first is still being read
+        prefetcher.prefetch(tile1)
+        prefetcher.prefetch(tile2)
+        self.assertEquals([(10, 1, 1)], prefetcher.prefetches.keys())
+        release.set()
+        self.assertEquals('unpacked:' + 'x' * 6, prefetcher(tile1))
+        self.assertEquals(0, prefetcher.n_in_flight)
+        io_pool.terminate()
+
+    def test_read_error(self):
+        from multiprocessing.pool import ThreadPool
+        from raw_tiles.tile import Tile
+        from tilequeue.rawr import RawrPrefetcher
+        tile = Tile(10, 1, 2)
+        source = self._make_stub_source({})
+        io_pool = ThreadPool(1)
+        prefetcher = RawrPrefetcher(source, io_pool, 1024)
+        prefetcher.prefetch(tile)
+        with self.assertRaises(KeyError):
+            prefetcher(tile)
+        io_pool.terminate()
+
+
+class RawrCachedSourceTest(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.dir_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir_path)
+
+    def test_conditional_read(self):
+        from botocore.exceptions import ClientError
+        from cStringIO import StringIO
+        from raw_tiles.tile import Tile
+        from tilequeue.cache import DiskCache
+        from tilequeue.rawr import RawrCachedSource
+        from tilequeue.rawr import RawrS3Source
+        from tilequeue.store import KeyFormatType
+        from tilequeue.store import S3TileKeyGenerator
+
+        class stub_s3_client(object):
+            def __init__(self):
+                self.n_downloads = 0
+
+            def get_object(self, **props):
+                if props.get('IfNoneMatch') == '"abc"':
+                    response = dict(
+                        Error=dict(Code='304'),
+                        ResponseMetadata=dict(HTTPStatusCode=304))
+                    raise ClientError(response, 'GetObject')
+                self.n_downloads += 1
+                return dict(
+                    Body=StringIO('payload'),
+                    ETag='"abc"',
+                    ResponseMetadata=dict(HTTPStatusCode=200))
+
+        tile_key_gen = S3TileKeyGenerator(
+            key_format_type=KeyFormatType.hash_prefix)
+        s3_client = stub_s3_client()
+        s3_source = RawrS3Source(
+            s3_client, 'bucket', 'prefix', 'zip', {}, tile_key_gen)
+        source = RawrCachedSource(s3_source, DiskCache(self.dir_path, 1024))
+
+        tile = Tile(10, 1, 2)
+        self.assertEquals('payload', source.read_payload(tile))
+        self.assertEquals('payload', source.read_payload(tile))
+        self.assertEquals(1, s3_client.n_downloads)
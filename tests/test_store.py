@@ -141,6 +141,164 @@ class S3Test(unittest.TestCase):
                           store.s3_client.put_props.get('Tagging'))
 
 
+class S3ReadIfChangedTest(unittest.TestCase):
+
+    def _make_store(self, s3_client):
+        from tilequeue.store import KeyFormatType
+        from tilequeue.store import S3
+        from tilequeue.store import S3TileKeyGenerator
+        tile_key_gen = S3TileKeyGenerator(
+            key_format_type=KeyFormatType.hash_prefix)
+        return S3(s3_client, 'bucket', 'prefix', False, 60, None,
+                  'public-read', None, tile_key_gen)
+
+    def _make_stub_s3_client(self, objects):
+        from botocore.exceptions import ClientError
+        from cStringIO import StringIO
+
+        class stub_s3_client(object):
+            def __init__(self):
+                self.requests = []
+
+            def get_object(self, **props):
+                self.requests.append(props)
+                obj = objects.get(props['Key'])
+                if obj is None:
+                    raise ClientError(
+                        dict(Error=dict(Code='NoSuchKey')), 'GetObject')
+                data, etag = obj
+                if props.get('IfNoneMatch') == etag:
+                    raise ClientError(
+                        dict(Error=dict(Code='304')), 'GetObject')
+                if props.get('IfMatch', etag) != etag:
+                    raise ClientError(
+                        dict(Error=dict(Code='PreconditionFailed')),
+                        'GetObject')
+                byte_range = props.get('Range')
+                if byte_range:
+                    start, end = byte_range[len('bytes='):].split('-')
+                    if not start:
+                        start = max(0, len(data) - int(end))
+                        end = len(data) - 1
+                    start, end = int(start), min(int(end), len(data) - 1)
+                    return dict(
+                        Body=StringIO(data[start:end + 1]), ETag=etag,
+                        ContentRange='bytes %d-%d/%d' % (
+                            start, end, len(data)))
+                return dict(Body=StringIO(data), ETag=etag)
+
+        return stub_s3_client()
+
+    def test_read_if_changed(self):
+        from tilequeue.format import mvt_format
+        from tilequeue.tile import deserialize_coord
+        coord = deserialize_coord('14/1/2')
+        s3_client = self._make_stub_s3_client({})
+        store = self._make_store(s3_client)
+        key = store.tile_key_gen('prefix', coord, mvt_format.extension)
+
+        self.assertEquals((None, None), store.read_tile_if_changed(
+            coord, mvt_format, None))
+
+        s3_client = self._make_stub_s3_client({key: ('data', '"abc"')})
+        store.s3_client = s3_client
+        self.assertEquals(('data', '"abc"'), store.read_tile_if_changed(
+            coord, mvt_format, None))
+        self.assertIsNone(store.read_tile_if_changed(
+            coord, mvt_format, '"abc"'))
+        self.assertEquals('"abc"', s3_client.requests[-1]['IfNoneMatch'])
+
+    def test_read_tile_range(self):
+        from tilequeue.format import zip_format
+        from tilequeue.store import TileChangedError
+        from tilequeue.store import TileNotModifiedError
+        from tilequeue.tile import deserialize_coord
+        coord = deserialize_coord('10/1/2')
+        s3_client = self._make_stub_s3_client({})
+        store = self._make_store(s3_client)
+        key = store.tile_key_gen('prefix', coord, zip_format.extension)
+        self.assertIsNone(store.read_tile_range(coord, zip_format, -4))
+
+        s3_client = self._make_stub_s3_client({key: ('0123456789', '"e"')})
+        store.s3_client = s3_client
+        self.assertEquals(
+            ('6789', '"e"', 10), store.read_tile_range(coord, zip_format, -4))
+        self.assertEquals(
+            ('234', '"e"', 10),
+            store.read_tile_range(coord, zip_format, 2, 3, '"e"'))
+        self.assertEquals('bytes=2-4', s3_client.requests[-1]['Range'])
+        with self.assertRaises(TileChangedError):
+            store.read_tile_range(coord, zip_format, 2, 3, '"old"')
+        with self.assertRaises(TileNotModifiedError):
+            store.read_tile_range(coord, zip_format, -4, unless_etag='"e"')
+        self.assertEquals(
+            ('6789', '"e"', 10),
+            store.read_tile_range(coord, zip_format, -4, unless_etag='"o"'))
+
+
+class CachedStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.dir_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir_path)
+
+    def _make_stub_store(self):
+        class stub_store(object):
+            def __init__(self):
+                self.tiles = {}
+                self.etags = []
+                self.n_downloads = 0
+
+            def write_tile(self, tile_data, coord, format):
+                self.tiles[coord] = tile_data
+
+            def read_tile_if_changed(self, coord, format, etag):
+                self.etags.append(etag)
+                tile_data = self.tiles.get(coord)
+                if tile_data is None:
+                    return None, None
+                tile_etag = 'etag-%s' % tile_data
+                if etag == tile_etag:
+                    return None
+                self.n_downloads += 1
+                return tile_data, tile_etag
+
+            def delete_tiles(self, coords, format):
+                for coord in coords:
+                    del self.tiles[coord]
+                return len(coords)
+
+        return stub_store()
+
+    def test_read_through_cache(self):
+        from tilequeue.cache import DiskCache
+        from tilequeue.format import mvt_format
+        from tilequeue.store import CachedStore
+        from tilequeue.tile import deserialize_coord
+        coord = deserialize_coord('14/1/2')
+        stub_store = self._make_stub_store()
+        store = CachedStore(stub_store, DiskCache(self.dir_path, 1024))
+
+        self.assertIsNone(store.read_tile(coord, mvt_format))
+
+        store.write_tile('data', coord, mvt_format)
+        self.assertEquals('data', store.read_tile(coord, mvt_format))
+        self.assertEquals('data', store.read_tile(coord, mvt_format))
+        self.assertEquals(1, stub_store.n_downloads)
+        self.assertEquals([None, None, 'etag-data'], stub_store.etags)
+
+        # changes in the store are picked up
+        stub_store.tiles[coord] = 'new data'
+        self.assertEquals('new data', store.read_tile(coord, mvt_format))
+
+        store.delete_tiles([coord], mvt_format)
+        self.assertIsNone(store.read_tile(coord, mvt_format))
+
+
 class _LogicalLog(object):
     """
     A logical time description of when things happened. Used for recording that
@@ -226,6 +384,129 @@ class MultiStoreTest(unittest.TestCase):
                 (0, 's1', 'read_tile', coord, json_format),
             ])
 
+    def test_parallel_write_primary(self):
+        from tilequeue.format import json_format
+        from tilequeue.store import MultiStore
+        from ModestMaps.Core import Coordinate
+        from mock import Mock
+
+        coord = Coordinate(zoom=0, column=0, row=0)
+
+        log = _LogicalLog()
+        s0 = _LoggingStore('s0', log)
+        s1 = Mock()
+        s1.write_tile.side_effect = IOError('s1 down')
+        logger = Mock()
+        m = MultiStore([s0, s1], parallel=True, primary=0, logger=logger)
+
+        # the failure of a non-primary store is only logged
+        m.write_tile('foo', coord, json_format)
+        self.assertEqual(
+            log.items, [(0, 's0', 'write_tile', 'foo', coord, json_format)])
+        self.assertEqual(1, logger.warning.call_count)
+
+        # but without a primary, any failure fails the write, after writing
+        # to the other stores.
+        m = MultiStore([s0, s1], parallel=True)
+        with self.assertRaises(IOError):
+            m.write_tile('bar', coord, json_format)
+        self.assertEqual('bar', log.items[-1][3])
+
+    def test_fastest_read_fallback(self):
+        from tilequeue.format import json_format
+        from tilequeue.store import MultiStore
+        from ModestMaps.Core import Coordinate
+        from mock import Mock
+
+        coord = Coordinate(zoom=0, column=0, row=0)
+
+        s0 = Mock()
+        s0.read_tile.return_value = 's0 data'
+        s1 = Mock()
+        s1.read_tile.side_effect = IOError('s1 down')
+        m = MultiStore([s0, s1], fastest_read=True)
+        m.health[0].read_seconds = 1.0
+
+        # s1 is tried first, as it looks quicker, and s0 when it fails.
+        self.assertEqual('s0 data', m.read_tile(coord, json_format))
+        self.assertEqual(1, s1.read_tile.call_count)
+
+        # after which s1 is tried last.
+        self.assertEqual('s0 data', m.read_tile(coord, json_format))
+        self.assertEqual(1, s1.read_tile.call_count)
+
+    def test_change_check_uses_written_store(self):
+        from tilequeue.format import json_format
+        from tilequeue.store import MultiStore
+        from tilequeue.store import write_tile_if_changed
+        from ModestMaps.Core import Coordinate
+        from mock import Mock
+
+        coord = Coordinate(zoom=0, column=0, row=0)
+
+        # the old store already has the tile, and is the quickest to read,
+        # but the store being migrated to doesn't have it yet.
+        old = Mock(spec=['read_tile', 'write_tile'])
+        old.read_tile.return_value = 'foo'
+        new = Mock(spec=['read_tile', 'write_tile'])
+        new.read_tile.return_value = None
+        m = MultiStore([old, new], fastest_read=True)
+        m.health[1].read_seconds = 1.0
+
+        self.assertEqual('foo', m.read_tile(coord, json_format))
+        self.assertTrue(write_tile_if_changed(m, 'foo', coord, json_format))
+        new.write_tile.assert_called_once_with('foo', coord, json_format)
+
+    def test_parallel_change_check_per_store(self):
+        from tilequeue.format import json_format
+        from tilequeue.store import MultiStore
+        from tilequeue.store import write_tile_if_changed
+        from ModestMaps.Core import Coordinate
+        from mock import Mock
+
+        coord = Coordinate(zoom=0, column=0, row=0)
+        tiles = {}
+
+        def _store(name):
+            store = Mock(spec=['read_tile', 'write_tile'])
+            store.read_tile.side_effect = lambda c, f: tiles.get(name)
+            return store
+
+        # the write to the secondary store fails the first time
+        primary = _store('primary')
+        secondary = _store('secondary')
+        primary.write_tile.side_effect = \
+            lambda data, c, f: tiles.__setitem__('primary', data)
+        secondary.write_tile.side_effect = Exception('secondary failed')
+        m = MultiStore([primary, secondary], parallel=True, primary=0)
+        self.assertTrue(write_tile_if_changed(m, 'foo', coord, json_format))
+        self.assertNotIn('secondary', tiles)
+
+        # so is written the next time, even though the primary has the tile
+        secondary.write_tile.side_effect = \
+            lambda data, c, f: tiles.__setitem__('secondary', data)
+        self.assertTrue(write_tile_if_changed(m, 'foo', coord, json_format))
+        self.assertEqual('foo', tiles['secondary'])
+        self.assertEqual(1, primary.write_tile.call_count)
+
+        # and once both have it, neither is written
+        self.assertFalse(write_tile_if_changed(m, 'foo', coord, json_format))
+        self.assertEqual(1, primary.write_tile.call_count)
+        self.assertEqual(2, secondary.write_tile.call_count)
+        m.write_pool.terminate()
+
+    def test_multi_list_tiles(self):
+        from tilequeue.format import json_format
+        from tilequeue.store import MultiStore
+
+        log = _LogicalLog()
+        s0 = _LoggingStore('s0', log)
+        s1 = _LoggingStore('s1', log)
+        m = MultiStore([s0, s1])
+
+        self.assertEqual([], list(m.list_tiles(json_format)))
+        self.assertEqual(log.items, [(0, 's1', 'list_tiles', json_format)])
+
     def test_multi_cfg_list(self):
         from tilequeue.store import _make_s3_store
 
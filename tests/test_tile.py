@@ -134,6 +134,22 @@ class TestTileGeneration(unittest.TestCase):
         for actual_child, exp_child in zip(actual, exp):
             self.assertEqual(exp_child, actual_child)
 
+    def test_tiles_children_preorder(self):
+        from tilequeue.tile import coord_children_preorder
+        from tilequeue.tile import coord_children_range
+        coord = Coordinate(3, 4, 2)
+        actual = list(coord_children_preorder(coord, 5))
+        self.assertEqual(
+            sorted(coord_children_range(coord, 5)), sorted(actual))
+        # each coord comes after its parent
+        seen = set([coord])
+        for child in actual:
+            self.assertIn(child.zoomBy(-1).container(), seen)
+            seen.add(child)
+        # and depth first, so the first child's descendants come next
+        self.assertEqual(4, actual[1].zoom)
+        self.assertEqual(5, actual[2].zoom)
+
     def test_tiles_children_subrange(self):
         from tilequeue.tile import coord_children_subrange as subrange
         from tilequeue.tile import coord_children
@@ -248,3 +264,28 @@ class TestMetatileZoom(unittest.TestCase):
         self.assertEqual(0, func('256'))
         self.assertEqual(1, func('512'))
         self.assertEqual(2, func('1024'))
+
+
+class TestHilbertIndex(unittest.TestCase):
+
+    def test_round_trip(self):
+        from tilequeue.tile import hilbert_coord
+        from tilequeue.tile import hilbert_index
+        for zoom in range(5):
+            n = 1 << zoom
+            indexes = set()
+            for x in range(n):
+                for y in range(n):
+                    d = hilbert_index(zoom, x, y)
+                    indexes.add(d)
+                    self.assertEqual((x, y), hilbert_coord(zoom, d))
+            self.assertEqual(set(range(n * n)), indexes)
+
+    def test_neighbours_adjacent(self):
+        from tilequeue.tile import hilbert_coord
+        zoom = 4
+        x, y = hilbert_coord(zoom, 0)
+        for d in range(1, 1 << (2 * zoom)):
+            next_x, next_y = hilbert_coord(zoom, d)
+            self.assertEqual(1, abs(next_x - x) + abs(next_y - y))
+            x, y = next_x, next_y
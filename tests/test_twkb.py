@@ -0,0 +1,150 @@
+"""
+Tests for `tilequeue.twkb`.
+"""
+import unittest
+
+
+def _varint(value):
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return out
+
+
+def _svarint(value):
+    return _varint((value << 1) ^ (value >> 63))
+
+
+class _Encoder(object):
+
+    """Minimal TWKB encoder for 2D geometries, to make test data"""
+
+    def __init__(self, precision):
+        self.precision = precision
+        self.last = [0, 0]
+
+    def header(self, geom_type, metadata=0):
+        zigzag = (self.precision << 1) ^ (self.precision >> 63)
+        return bytearray([geom_type | (zigzag << 4), metadata])
+
+    def coords(self, coords):
+        out = bytearray()
+        for coord in coords:
+            for i in range(2):
+                value = int(round(coord[i] * 10 ** self.precision))
+                out += _svarint(value - self.last[i])
+                self.last[i] = value
+        return out
+
+    def line(self, coords):
+        return _varint(len(coords)) + self.coords(coords)
+
+    def polygon(self, rings):
+        out = _varint(len(rings))
+        for ring in rings:
+            out += self.line(ring)
+        return out
+
+
+class TwkbLoadsTest(unittest.TestCase):
+
+    def test_spec_linestring(self):
+        from tilequeue.twkb import loads
+        # SELECT ST_AsTWKB('LINESTRING(1 1, 5 5)'::geometry)
+        shape = loads(b'\x02\x00\x02\x02\x02\x08\x08')
+        self.assertEquals('LineString', shape.type)
+        self.assertEquals([(1, 1), (5, 5)], list(shape.coords))
+
+    def test_point_negative_precision(self):
+        from tilequeue.twkb import loads
+        encoder = _Encoder(-2)
+        data = encoder.header(1) + encoder.coords([(12300, -4500)])
+        shape = loads(bytes(data))
+        self.assertEquals((12300, -4500), shape.coords[0])
+
+    def test_polygon_with_hole(self):
+        from tilequeue.twkb import loads
+        shell = [(0, 0), (10, 0), (10, 10), (0, 10), (0, 0)]
+        hole = [(2, 2), (2, 4), (4, 4), (4, 2), (2, 2)]
+        encoder = _Encoder(1)
+        data = encoder.header(3) + encoder.polygon([shell, hole])
+        shape = loads(bytes(data))
+        self.assertEquals('Polygon', shape.type)
+        self.assertEquals(shell, list(shape.exterior.coords))
+        self.assertEquals(hole, list(shape.interiors[0].coords))
+        self.assertEquals(96, shape.area)
+
+    def test_multipolygon_deltas_across_parts(self):
+        from tilequeue.twkb import loads
+        square1 = [(0, 0), (1, 0), (1, 1), (0, 1), (0, 0)]
+        square2 = [(5, 5), (6, 5), (6, 6), (5, 6), (5, 5)]
+        encoder = _Encoder(3)
+        data = encoder.header(6) + _varint(2) + \
+            encoder.polygon([square1]) + encoder.polygon([square2])
+        shape = loads(bytes(data))
+        self.assertEquals('MultiPolygon', shape.type)
+        self.assertEquals(square2, list(shape.geoms[1].exterior.coords))
+
+    def test_bbox_and_size_skipped(self):
+        from tilequeue.twkb import loads
+        encoder = _Encoder(1)
+        body = bytearray()
+        for value in (0, 50, 0, 50):
+            body += _svarint(value)
+        body += encoder.line([(0, 0), (5, 5)])
+        data = encoder.header(2, 0x01 | 0x02) + _varint(len(body)) + body
+        shape = loads(bytes(data))
+        self.assertEquals([(0, 0), (5, 5)], list(shape.coords))
+
+    def test_empty(self):
+        from tilequeue.twkb import loads
+        shape = loads(bytes(_Encoder(1).header(3, 0x10)))
+        self.assertTrue(shape.is_empty)
+
+    def test_collapsed_line_is_empty(self):
+        from tilequeue.twkb import loads
+        encoder = _Encoder(1)
+        data = encoder.header(2) + encoder.line([(1, 1)])
+        self.assertTrue(loads(bytes(data)).is_empty)
+
+
+class LoadGeometryTest(unittest.TestCase):
+
+    def test_wkb_and_twkb(self):
+        from shapely.geometry import Point
+        from tilequeue.twkb import load_geometry
+        point = Point(1, 2)
+        self.assertEquals(point, load_geometry(point.wkb))
+        encoder = _Encoder(1)
+        data = encoder.header(1) + encoder.coords([(1, 2)])
+        self.assertEquals(point, load_geometry(bytes(data)))
+
+    def test_sliver_repaired(self):
+        from shapely.geometry import Polygon
+        from tilequeue.twkb import load_geometry
+        # valid, but rounding pulls the middle of the top edge onto the
+        # bottom one.
+        sliver = [(0, 0), (1, 0), (1, 0.06), (0.5, 0.04), (0, 0.06), (0, 0)]
+        self.assertTrue(Polygon(sliver).is_valid)
+        encoder = _Encoder(1)
+        data = encoder.header(3) + encoder.polygon([sliver])
+        shape = load_geometry(bytes(data))
+        self.assertTrue(shape.is_valid)
+        self.assertEquals('MultiPolygon', shape.type)
+        self.assertAlmostEqual(0.05, shape.area)
+
+
+class TwkbPrecisionTest(unittest.TestCase):
+
+    def test_precision_increases_with_zoom(self):
+        from tilequeue.twkb import twkb_precision
+        precisions = [twkb_precision(z) for z in range(21)]
+        self.assertEquals(sorted(precisions), precisions)
+        self.assertNotIn(0, precisions)
+        self.assertTrue(all(-8 <= p <= 7 for p in precisions))
+
+    def test_detail_zooms(self):
+        from tilequeue.twkb import twkb_precision
+        self.assertEquals(twkb_precision(10, 4), twkb_precision(14))
@@ -0,0 +1,449 @@
+"""
+Tests for `tilequeue.worker`.
+"""
+import unittest
+
+
+class AffinityQueuesTest(unittest.TestCase):
+
+    def _make(self, n_queues):
+        import Queue
+        from tilequeue.worker import AffinityQueues
+        return AffinityQueues(
+            [Queue.Queue() for i in range(n_queues)], 10,
+            steal_interval_seconds=0.01)
+
+    def test_same_parent_same_queue(self):
+        from tilequeue.tile import coord_children_range
+        from tilequeue.tile import deserialize_coord
+        queues = self._make(8)
+        parent = deserialize_coord('10/300/400')
+        indexes = set(queues.queue_index(c)
+                      for c in coord_children_range(parent, 13))
+        self.assertEquals(set([queues.queue_index(parent)]), indexes)
+
+        # low zooms are grouped by the parent two levels up
+        self.assertEquals(
+            queues.queue_index(deserialize_coord('5/8/8')),
+            queues.queue_index(deserialize_coord('5/11/11')))
+
+    def test_consumer_reads_own_queue_first(self):
+        from tilequeue.tile import deserialize_coord
+        queues = self._make(2)
+        coord = deserialize_coord('10/1/2')
+        index = queues.queue_index(coord)
+        other_index = 1 - index
+        queues.queues[other_index].put('other')
+        queues.put(dict(coord=coord))
+        self.assertEquals(
+            dict(coord=coord), queues.consumer(index).get(timeout=1))
+        # and steals when its own queue is empty
+        self.assertEquals('other', queues.consumer(index).get(timeout=1))
+
+    def test_sentinels_reach_each_consumer(self):
+        import Queue
+        queues = self._make(3)
+        for i in range(3):
+            queues.put(None)
+        consumer = queues.consumer(0)
+        self.assertIsNone(consumer.get(timeout=1))
+        # the other sentinels aren't stolen
+        with self.assertRaises(Queue.Empty):
+            consumer.get(timeout=0.05)
+        self.assertIsNone(queues.consumer(1).get(timeout=1))
+        self.assertIsNone(queues.consumer(2).get(timeout=1))
+
+    def test_stolen_sentinel_held_when_queue_full(self):
+        import Queue
+        from tilequeue.worker import AffinityQueues
+
+        class _RefilledQueue(Queue.Queue):
+            # a producer fills the space as soon as the sentinel is taken
+            def get_nowait(self):
+                data = Queue.Queue.get_nowait(self)
+                self.put_nowait('job')
+                return data
+
+        own_queue = Queue.Queue(1)
+        other_queue = _RefilledQueue(1)
+        other_queue.put(None)
+        queues = AffinityQueues(
+            [own_queue, other_queue], 10, steal_interval_seconds=0.01)
+        consumer = queues.consumer(0)
+
+        # the stealing consumer doesn't block putting the sentinel back
+        with self.assertRaises(Queue.Empty):
+            consumer.get(block=False)
+        self.assertEquals([other_queue], consumer.held_sentinels)
+
+        # and returns it once there's room, ahead of its own sentinel
+        Queue.Queue.get_nowait(other_queue)
+        own_queue.put(None)
+        self.assertIsNone(consumer.get(timeout=1))
+        self.assertEquals([], consumer.held_sentinels)
+        self.assertIsNone(Queue.Queue.get_nowait(other_queue))
+
+
+class WorkerThreadsTest(unittest.TestCase):
+
+    def _worker(self, input_queue, results):
+        def worker(stop):
+            while True:
+                data = input_queue.get()
+                if data is None:
+                    break
+                results.append(data)
+        return worker
+
+    def test_grow_and_shrink(self):
+        import Queue
+        from tilequeue.worker import WorkerThreads
+        input_queue = Queue.Queue()
+        results = []
+        workers = WorkerThreads(
+            'test', self._worker(input_queue, results), input_queue)
+        workers.start(2)
+        workers.grow()
+        self.assertEquals(3, workers.n_workers)
+
+        input_queue.put('a')
+        workers.shrink()
+        self.assertEquals(2, workers.n_workers)
+        input_queue.put('b')
+
+        workers.put_sentinels()
+        workers.join()
+        self.assertEquals(['a', 'b'], sorted(results))
+        self.assertTrue(input_queue.empty())
+
+
+class ConcurrencyTunerTest(unittest.TestCase):
+
+    class _StubWorkers(object):
+        def __init__(self, name, n_workers):
+            self.name = name
+            self.n_workers = n_workers
+
+        def grow(self):
+            self.n_workers += 1
+
+        def shrink(self):
+            self.n_workers -= 1
+
+    def _make(self, input_queue, fetched_queue, processed_queue):
+        from mock import Mock
+        from tilequeue.worker import ConcurrencyTuner
+        fetch_workers = self._StubWorkers('fetch', 2)
+        storage_workers = self._StubWorkers('storage', 2)
+        tuner = ConcurrencyTuner(
+            fetch_workers, (1, 3), storage_workers, (1, 3), input_queue,
+            fetched_queue, processed_queue, Mock(), None)
+        return tuner, fetch_workers, storage_workers
+
+    def test_grow_fetch_when_processors_starved(self):
+        import Queue
+        input_queue = Queue.Queue()
+        input_queue.put('job')
+        processed_queue = Queue.Queue(1)
+        processed_queue.put('tile')
+        tuner, fetch_workers, storage_workers = self._make(
+            input_queue, Queue.Queue(), processed_queue)
+        for i in range(3):
+            tuner.fetched_sampler.sample()
+            tuner.input_sampler.sample()
+            tuner.processed_sampler.sample()
+        tuner.tune()
+        self.assertEquals(3, fetch_workers.n_workers)
+        self.assertEquals(3, storage_workers.n_workers)
+        self.assertEquals(2, tuner.tile_proc_logger.lifecycle.call_count)
+
+        # and not past the bounds
+        for i in range(3):
+            tuner.fetched_sampler.sample()
+            tuner.input_sampler.sample()
+        tuner.tune()
+        self.assertEquals(3, fetch_workers.n_workers)
+
+    def test_shrink_when_idle(self):
+        import Queue
+        fetched_queue = Queue.Queue(1)
+        fetched_queue.put('data')
+        tuner, fetch_workers, storage_workers = self._make(
+            Queue.Queue(), fetched_queue, Queue.Queue())
+        for i in range(3):
+            tuner.fetched_sampler.sample()
+            tuner.processed_sampler.sample()
+        tuner.tune()
+        self.assertEquals(1, fetch_workers.n_workers)
+        self.assertEquals(1, storage_workers.n_workers)
+
+
+    def test_budgeted_queues(self):
+        import Queue
+        from tilequeue.budget import BudgetedQueue
+        from tilequeue.budget import ByteBudget
+        from tilequeue.budget import formatted_data_size
+
+        # the queues have room for more jobs, but not more bytes
+        def _budgeted_queue():
+            q = BudgetedQueue(
+                Queue.Queue(16), ByteBudget(10), formatted_data_size)
+            q.put(dict(formatted_tiles=[dict(tile='x' * 10)]))
+            return q
+
+        tuner, fetch_workers, storage_workers = self._make(
+            Queue.Queue(), _budgeted_queue(), _budgeted_queue())
+        for i in range(3):
+            tuner.fetched_sampler.sample()
+            tuner.processed_sampler.sample()
+        tuner.tune()
+        self.assertEquals(1, fetch_workers.n_workers)
+        self.assertEquals(3, storage_workers.n_workers)
+
+
+class QueuePrintIoPoolsTest(unittest.TestCase):
+
+    def test_io_pool_stats_reported(self):
+        import threading
+        from mock import Mock
+        from tilequeue.iopool import IoPool
+        from tilequeue.worker import QueuePrint
+
+        pool = IoPool('db', 1)
+        pool.apply_async(sum, ([1, 2],)).get()
+        tile_proc_logger = Mock()
+        stats_handler = Mock()
+        stop = threading.Event()
+
+        def _log_io_pools(pool_stats):
+            stop.set()
+        tile_proc_logger.log_io_pools.side_effect = _log_io_pools
+
+        queue_printer = QueuePrint(
+            0.01, (), tile_proc_logger, stop, stats_handler, (pool,))
+        queue_printer()
+        pool.close()
+        pool.join()
+
+        pool_stats = tile_proc_logger.log_io_pools.call_args[0][0]
+        self.assertEquals(1, len(pool_stats))
+        name, stats = pool_stats[0]
+        self.assertEquals('db', name)
+        self.assertEquals(1, stats.n_tasks)
+        stats_handler.io_pool.assert_called_once_with('db', stats)
+
+
+class PipelinedS3StorageTest(unittest.TestCase):
+
+    class _Store(object):
+        def __init__(self, fail_coords=()):
+            self.tiles = {}
+            self.fail_coords = fail_coords
+
+        def read_tile(self, coord, format):
+            return None
+
+        def write_tile(self, tile_data, coord, format):
+            if coord in self.fail_coords:
+                raise IOError('write failed')
+            self.tiles[coord] = tile_data
+
+    def _job(self, coord, tiles):
+        from tilequeue.format import json_format
+        return dict(
+            coord=coord, metadata=dict(timing={}),
+            formatted_tiles=[dict(tile=tile, coord=coord, format=json_format)
+                             for tile in tiles])
+
+    def test_jobs_output_after_writes(self):
+        import Queue
+        import threading
+        from mock import Mock
+        from tilequeue.iopool import IoPool
+        from tilequeue.tile import deserialize_coord
+        from tilequeue.worker import PipelinedS3Storage
+
+        store = self._Store(fail_coords=[deserialize_coord('10/1/2')])
+        input_queue = Queue.Queue()
+        output_queue = Queue.Queue()
+        pool = IoPool('upload', 4)
+        tile_proc_logger = Mock()
+        storage = PipelinedS3Storage(
+            input_queue, output_queue, pool, store, tile_proc_logger, None,
+            max_in_flight=2)
+
+        coords = [deserialize_coord('10/1/%d' % y) for y in range(4)]
+        input_queue.put(self._job(coords[0], ['a']))
+        input_queue.put(self._job(coords[1], []))
+        input_queue.put(self._job(coords[2], ['b']))
+        input_queue.put(self._job(coords[3], ['c']))
+        input_queue.put(None)
+        storage(threading.Event())
+        pool.close()
+        pool.join()
+
+        outputs = {}
+        while not output_queue.empty():
+            data = output_queue.get_nowait()
+            outputs[data['coord']] = data['metadata']['store']
+        self.assertEquals(
+            dict(stored=1, not_stored=0, unchanged=0), outputs[coords[0]])
+        self.assertEquals(
+            dict(stored=0, not_stored=0, unchanged=0), outputs[coords[1]])
+        self.assertEquals(
+            dict(stored=1, not_stored=0, unchanged=0), outputs[coords[3]])
+        # the failed write is logged, and its job isn't output
+        self.assertNotIn(coords[2], outputs)
+        self.assertEquals(1, tile_proc_logger.error.call_count)
+        self.assertEquals('c', store.tiles[coords[3]])
+
+
+    def test_failed_submit_finishes_job(self):
+        import Queue
+        import threading
+        from mock import Mock
+        from tilequeue.iopool import IoPool
+        from tilequeue.tile import deserialize_coord
+        from tilequeue.worker import PipelinedS3Storage
+
+        class failing_pool(IoPool):
+            # fails to submit the second write
+            n_calls = 0
+
+            def apply_async(self, *args, **kwargs):
+                self.n_calls += 1
+                if self.n_calls == 2:
+                    raise RuntimeError('pool closed')
+                return super(failing_pool, self).apply_async(
+                    *args, **kwargs)
+
+        store = self._Store()
+        input_queue = Queue.Queue()
+        output_queue = Queue.Queue()
+        pool = failing_pool('upload', 2)
+        tile_proc_logger = Mock()
+        storage = PipelinedS3Storage(
+            input_queue, output_queue, pool, store, tile_proc_logger, None,
+            max_in_flight=1)
+
+        coord = deserialize_coord('10/1/1')
+        input_queue.put(self._job(coord, ['a', 'b']))
+        input_queue.put(None)
+        # returns, rather than waiting forever on the job
+        storage(threading.Event())
+        pool.close()
+        pool.join()
+
+        self.assertTrue(output_queue.empty())
+        self.assertEquals(1, tile_proc_logger.error.call_count)
+        self.assertEquals('Store error',
+                          tile_proc_logger.error.call_args[0][0])
+
+class CoalescedJobsTest(unittest.TestCase):
+
+    def _read_duplicates(self, coalescer, stats_handler, prefetch_fn=None):
+        # reads the same coord, in two messages, returning the jobs output
+        import Queue
+        import threading
+        from mock import Mock
+        from tilequeue.queue import MessageHandle
+        from tilequeue.queue.message import SingleMessageMarshaller
+        from tilequeue.worker import TileQueueReader
+
+        tile_queue = Mock()
+        queue_mapper = Mock()
+        queue_mapper.queues_in_priority_order.return_value = [(0, tile_queue)]
+        queue_mapper.get_queue.return_value = tile_queue
+        msg_tracker = Mock()
+        msg_tracker.track.side_effect = lambda queue_handle, coords, parent: [
+            queue_handle.handle]
+
+        output_queue = Queue.Queue()
+        reader_stop = threading.Event()
+        msg_handles = [MessageHandle('a', '10/1/2'),
+                       MessageHandle('b', '10/1/2')]
+
+        def _read():
+            if not msg_handles:
+                reader_stop.set()
+                return []
+            return [msg_handles.pop(0)]
+        tile_queue.read.side_effect = _read
+        reader = TileQueueReader(
+            queue_mapper, SingleMessageMarshaller(), msg_tracker,
+            output_queue, Mock(), stats_handler, reader_stop, 16, None,
+            prefetch_fn=prefetch_fn, coalescer=coalescer)
+        reader()
+
+        jobs = []
+        while not output_queue.empty():
+            jobs.append(output_queue.get_nowait())
+        return jobs, queue_mapper, msg_tracker
+
+    def test_duplicates_acked_with_job(self):
+        import Queue
+        import threading
+        from mock import Mock
+        from tilequeue.coalesce import JobCoalescer
+        from tilequeue.tile import deserialize_coord
+        from tilequeue.worker import TileQueueWriter
+
+        coord = deserialize_coord('10/1/2')
+        stats_handler = Mock()
+        coalescer = JobCoalescer()
+        jobs, queue_mapper, msg_tracker = self._read_duplicates(
+            coalescer, stats_handler)
+
+        # only the first message's job is rendered
+        self.assertEquals(1, len(jobs))
+        all_data, parent = jobs[0]
+        self.assertEquals(1, len(all_data))
+        self.assertEquals(1, stats_handler.coalesced_coord.call_count)
+
+        data = all_data[0]
+        data['metadata'].update(layers=dict(size=0), store={})
+        writer_queue = Queue.Queue()
+        writer_queue.put(data)
+        writer_queue.put(None)
+        writer = TileQueueWriter(
+            queue_mapper, writer_queue, Mock(), msg_tracker, Mock(),
+            stats_handler, threading.Event(), coalescer)
+        writer()
+
+        acked = [call[0][0] for call in msg_tracker.done.call_args_list]
+        self.assertEquals(['a', 'b'], sorted(acked))
+        self.assertEquals(coord, data['coord'])
+
+    def test_not_attached_once_prefetched(self):
+        from mock import Mock
+        from tilequeue.coalesce import JobCoalescer
+        stats_handler = Mock()
+        prefetch_fn = Mock(return_value=True)
+        jobs, _, _ = self._read_duplicates(
+            JobCoalescer(), stats_handler, prefetch_fn)
+
+        # the first job's data was already being read when the second
+        # arrived, so both are rendered.
+        self.assertEquals(2, len(jobs))
+        self.assertEquals(2, prefetch_fn.call_count)
+        self.assertEquals(0, stats_handler.coalesced_coord.call_count)
+
+    def test_attached_when_prefetch_not_started(self):
+        from mock import Mock
+        from tilequeue.coalesce import JobCoalescer
+        from tilequeue.query.rawr import DataFetcher as RawrDataFetcher
+        from tilequeue.query.split import make_split_data_fetcher
+
+        # storage which can't read ahead, so nothing is read until the job
+        # is fetched.
+        storage = Mock(spec=['__call__'])
+        below_fetcher = Mock(spec=['fetch_tiles'])
+        above_fetcher = RawrDataFetcher(10, 16, storage, [], {}, [])
+        fetcher = make_split_data_fetcher(10, below_fetcher, above_fetcher)
+        self.assertFalse(fetcher.prefetch(Mock(zoom=10)))
+
+        stats_handler = Mock()
+        jobs, _, _ = self._read_duplicates(
+            JobCoalescer(), stats_handler, fetcher.prefetch)
+        self.assertEquals(1, len(jobs))
+        self.assertEquals(1, stats_handler.coalesced_coord.call_count)
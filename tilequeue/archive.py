@@ -0,0 +1,693 @@
+# single-file tile archives. tiles are appended to a log as they're stored,
+# and when the build is done the logs are sorted into runs, which are merged
+# into an archive.
+#
+# an archive is laid out as:
+#
+#   header | root directory | leaf directories | tile data
+#
+# tiles are addressed by a tile id, which counts along the Hilbert curve at
+# each zoom, so that tiles near each other on the map are near each other in
+# the archive. tiles with the same content are stored once, and runs of
+# consecutive tile ids with the same content share a directory entry.
+# directories are zlib compressed lists of entries. when there are too many
+# entries for the root directory, it points to leaf directories instead, so
+# that reading a tile takes at most three range reads: the header and root,
+# a leaf and the tile data.
+import bisect
+import hashlib
+import heapq
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from collections import namedtuple
+
+from ModestMaps.Core import Coordinate
+
+from tilequeue.tile import hilbert_coord
+from tilequeue.tile import hilbert_index
+
+
+MAGIC = 'TQARCHV1'
+HEADER_FORMAT = '<8s8sQQQQQQQQ'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+RUN_RECORD_FORMAT = '<QI'
+RUN_RECORD_SIZE = struct.calcsize(RUN_RECORD_FORMAT)
+# the length of a record which deletes its tile, and has no data.
+TOMBSTONE_LENGTH = 0xffffffff
+
+
+ArchiveHeader = namedtuple(
+    'ArchiveHeader',
+    ('extension', 'root_offset', 'root_length', 'leaf_offset', 'leaf_length',
+     'data_offset', 'data_length', 'n_tiles', 'n_contents'))
+
+# a run_length of 0 means the entry points to a leaf directory rather than
+# tile data.
+DirectoryEntry = namedtuple(
+    'DirectoryEntry', ('tile_id', 'run_length', 'offset', 'length'))
+
+
+def coord_to_tile_id(coord):
+    zoom = int(coord.zoom)
+    # the ids of all the tiles at lower zooms come first
+    base = ((1 << (2 * zoom)) - 1) // 3
+    return base + hilbert_index(zoom, int(coord.column), int(coord.row))
+
+
+def tile_id_to_coord(tile_id):
+    zoom = 0
+    base = 0
+    while True:
+        n_tiles = 1 << (2 * zoom)
+        if tile_id < base + n_tiles:
+            break
+        base += n_tiles
+        zoom += 1
+    column, row = hilbert_coord(zoom, tile_id - base)
+    return Coordinate(zoom=zoom, column=column, row=row)
+
+
+def _write_varint(out, value):
+    while value >= 0x80:
+        out.append(chr((value & 0x7f) | 0x80))
+        value >>= 7
+    out.append(chr(value))
+
+
+def _read_varint(buf, pos):
+    value = 0
+    shift = 0
+    while True:
+        byte = ord(buf[pos])
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def encode_directory(entries):
+    out = []
+    _write_varint(out, len(entries))
+    last_id = 0
+    for entry in entries:
+        _write_varint(out, entry.tile_id - last_id)
+        last_id = entry.tile_id
+    for entry in entries:
+        _write_varint(out, entry.run_length)
+    for entry in entries:
+        _write_varint(out, entry.length)
+    # offsets which follow on from the previous entry's data are written as
+    # 0, as they usually do.
+    for i, entry in enumerate(entries):
+        prev = entries[i - 1] if i > 0 else None
+        if prev is not None and entry.offset == prev.offset + prev.length:
+            _write_varint(out, 0)
+        else:
+            _write_varint(out, entry.offset + 1)
+    return zlib.compress(''.join(out))
+
+
+def decode_directory(data):
+    buf = zlib.decompress(data)
+    n, pos = _read_varint(buf, 0)
+    tile_ids = []
+    last_id = 0
+    for i in range(n):
+        delta, pos = _read_varint(buf, pos)
+        last_id += delta
+        tile_ids.append(last_id)
+    run_lengths = []
+    for i in range(n):
+        run_length, pos = _read_varint(buf, pos)
+        run_lengths.append(run_length)
+    lengths = []
+    for i in range(n):
+        length, pos = _read_varint(buf, pos)
+        lengths.append(length)
+    entries = []
+    for i in range(n):
+        offset, pos = _read_varint(buf, pos)
+        if offset == 0:
+            prev = entries[i - 1]
+            offset = prev.offset + prev.length
+        else:
+            offset -= 1
+        entries.append(DirectoryEntry(
+            tile_ids[i], run_lengths[i], offset, lengths[i]))
+    return entries
+
+
+def _record(tile_id, data):
+    if data is None:
+        return struct.pack(RUN_RECORD_FORMAT, tile_id, TOMBSTONE_LENGTH)
+    return struct.pack(RUN_RECORD_FORMAT, tile_id, len(data)) + data
+
+
+def write_run(path, tiles):
+    """
+    write a run of (tile_id, data), which must be in tile id order. data of
+    None records that the tile was deleted.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fp:
+        for tile_id, data in tiles:
+            fp.write(_record(tile_id, data))
+    os.rename(tmp_path, path)
+
+
+def read_run(path):
+    """
+    yield (tile_id, data) from a run or log file, in the order written
+
+    A record cut short at the end of the file, by the writer dying part way
+    through it, is ignored. Its write never returned, so it wasn't stored.
+    """
+    with open(path, 'rb') as fp:
+        while True:
+            record = fp.read(RUN_RECORD_SIZE)
+            if len(record) < RUN_RECORD_SIZE:
+                break
+            tile_id, length = struct.unpack(RUN_RECORD_FORMAT, record)
+            if length == TOMBSTONE_LENGTH:
+                yield tile_id, None
+                continue
+            data = fp.read(length)
+            if len(data) < length:
+                break
+            yield tile_id, data
+
+
+def sort_log(log_path, run_bytes):
+    """
+    Write the tiles in an unsorted log out as sorted runs of up to about
+    run_bytes each, returning their paths in the order they were written.
+    """
+    run_paths = []
+    prefix = log_path[:-len('.log')]
+
+    def _write(tiles):
+        run_path = '%s-%06d.run' % (prefix, len(run_paths))
+        write_run(run_path, sorted(tiles.items()))
+        run_paths.append(run_path)
+
+    # within a run, later writes of a tile replace earlier ones, and later
+    # runs replace earlier ones when they're merged.
+    tiles = {}
+    n_bytes = 0
+    for tile_id, data in read_run(log_path):
+        old = tiles.get(tile_id)
+        if old is not None:
+            n_bytes -= len(old)
+        tiles[tile_id] = data
+        if data is not None:
+            n_bytes += len(data)
+        if n_bytes >= run_bytes:
+            _write(tiles)
+            tiles = {}
+            n_bytes = 0
+    if tiles:
+        _write(tiles)
+    return run_paths
+
+
+def _merged_runs(run_paths):
+    # where runs have the same tile, the one from the run later in the list
+    # wins. the data is None if that was a deletion.
+    def _tagged(run_index, path):
+        for tile_id, data in read_run(path):
+            yield tile_id, -run_index, data
+
+    last_id = None
+    for tile_id, _, data in heapq.merge(
+            *[_tagged(i, path) for i, path in enumerate(run_paths)]):
+        if tile_id != last_id:
+            last_id = tile_id
+            yield tile_id, data
+
+
+class _ContentIndex(object):
+
+    """
+    The location of each distinct tile content written, by its sha1
+
+    Kept in memory until there are max_memory of them, when they're moved
+    to a temporary sqlite database, so that the whole planet's worth don't
+    need to fit in memory.
+    """
+
+    def __init__(self, max_memory=1000000):
+        self.max_memory = max_memory
+        self.memory = {}
+        self.db = None
+        self.db_dir = None
+        self.n_contents = 0
+
+    def get(self, digest):
+        location = self.memory.get(digest)
+        if location is None and self.db is not None:
+            location = self.db.execute(
+                'SELECT offset, length FROM contents WHERE digest = ?',
+                (buffer(digest),)).fetchone()
+        return location
+
+    def put(self, digest, location):
+        self.memory[digest] = location
+        self.n_contents += 1
+        if len(self.memory) >= self.max_memory:
+            self._spill()
+
+    def _spill(self):
+        if self.db is None:
+            import sqlite3
+            self.db_dir = tempfile.mkdtemp()
+            self.db = sqlite3.connect(
+                os.path.join(self.db_dir, 'contents.db'))
+            # only needed while the archive is written
+            self.db.execute('PRAGMA journal_mode=OFF')
+            self.db.execute('PRAGMA synchronous=OFF')
+            self.db.execute(
+                'CREATE TABLE contents ('
+                'digest BLOB PRIMARY KEY, offset INTEGER, length INTEGER)')
+        self.db.executemany(
+            'INSERT INTO contents VALUES (?, ?, ?)',
+            ((buffer(digest), offset, length)
+             for digest, (offset, length) in self.memory.iteritems()))
+        self.db.commit()
+        self.memory = {}
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            shutil.rmtree(self.db_dir)
+            self.db = None
+
+
+class _DirectoryWriter(object):
+
+    """
+    Builds the directories from tiles added in tile id order
+
+    Leaf directories are written to leaves_fp as they fill, so that only the
+    root directory is kept in memory. The entries are only put in the root
+    directory itself if there are no more than leaf_size of them.
+    """
+
+    def __init__(self, leaves_fp, leaf_size):
+        self.leaves_fp = leaves_fp
+        self.leaf_size = leaf_size
+        # the entries not yet written to a leaf, the last of which can still
+        # be extended by the next tile.
+        self.pending = []
+        self.root_entries = []
+        self.leaf_length = 0
+
+    def _write_leaf(self, leaf_entries):
+        leaf = encode_directory(leaf_entries)
+        self.root_entries.append(DirectoryEntry(
+            leaf_entries[0].tile_id, 0, self.leaf_length, len(leaf)))
+        self.leaves_fp.write(leaf)
+        self.leaf_length += len(leaf)
+
+    def add(self, tile_id, offset, length):
+        last = self.pending[-1] if self.pending else None
+        if last is not None and last.offset == offset and \
+                last.tile_id + last.run_length == tile_id:
+            self.pending[-1] = last._replace(run_length=last.run_length + 1)
+            return
+        if len(self.pending) > self.leaf_size:
+            self._write_leaf(self.pending[:self.leaf_size])
+            self.pending = self.pending[self.leaf_size:]
+        self.pending.append(DirectoryEntry(tile_id, 1, offset, length))
+
+    def root(self):
+        """write the remaining leaves, returning the root directory"""
+        if not self.root_entries and len(self.pending) <= self.leaf_size:
+            return encode_directory(self.pending)
+        for i in range(0, len(self.pending), self.leaf_size):
+            self._write_leaf(self.pending[i:i + self.leaf_size])
+        self.pending = []
+        return encode_directory(self.root_entries)
+
+
+def finalize_archive(run_paths, output_path, extension, leaf_size=4096):
+    """
+    Merge sorted runs into an archive at output_path, returning its header.
+
+    The runs are merged in tile id order, with tiles from later runs in the
+    list replacing, or deleting, the same tiles in earlier ones. The tile
+    data and leaf directories are streamed to temporary files, and the
+    locations of distinct contents spill to disk, so that memory use doesn't
+    grow with the number of tiles.
+    """
+    contents = _ContentIndex()
+    n_tiles = 0
+    data_length = 0
+    with tempfile.TemporaryFile() as data_fp, \
+            tempfile.TemporaryFile() as leaves_fp:
+        directory = _DirectoryWriter(leaves_fp, leaf_size)
+        try:
+            for tile_id, data in _merged_runs(run_paths):
+                if data is None:
+                    continue
+                n_tiles += 1
+                digest = hashlib.sha1(data).digest()
+                location = contents.get(digest)
+                if location is None:
+                    location = (data_length, len(data))
+                    contents.put(digest, location)
+                    data_fp.write(data)
+                    data_length += len(data)
+                offset, length = location
+                directory.add(tile_id, offset, length)
+        finally:
+            contents.close()
+
+        root = directory.root()
+        leaf_length = directory.leaf_length
+
+        root_offset = HEADER_SIZE
+        header = ArchiveHeader(
+            extension, root_offset, len(root), root_offset + len(root),
+            leaf_length, root_offset + len(root) + leaf_length, data_length,
+            n_tiles, contents.n_contents)
+
+        tmp_path = output_path + '.tmp'
+        with open(tmp_path, 'wb') as fp:
+            fp.write(struct.pack(HEADER_FORMAT, MAGIC, *header))
+            fp.write(root)
+            leaves_fp.seek(0)
+            shutil.copyfileobj(leaves_fp, fp)
+            data_fp.seek(0)
+            shutil.copyfileobj(data_fp, fp)
+        os.rename(tmp_path, output_path)
+
+    return header
+
+
+def _indexed(entries):
+    return [entry.tile_id for entry in entries], entries
+
+
+def file_range_reader(fp):
+    """
+    return a function reading byte ranges of an open file. keeping the file
+    open means the reads are all of the same archive, even if it's replaced.
+    """
+    lock = threading.Lock()
+
+    def read_range(offset, length):
+        with lock:
+            fp.seek(offset)
+            return fp.read(length)
+    return read_range
+
+
+def s3_range_reader(s3_client, bucket, key):
+    """return a function reading byte ranges of an object in S3"""
+    def read_range(offset, length):
+        resp = s3_client.get_object(
+            Bucket=bucket, Key=key,
+            Range='bytes=%d-%d' % (offset, offset + length - 1))
+        return resp['Body'].read()
+    return read_range
+
+
+class ArchiveReader(object):
+
+    """
+    Reads tiles from an archive using byte range reads
+
+    The header and root directory are read once, usually with a single
+    range read, and leaf directories are kept once read, so that most tiles
+    take a single range read.
+    """
+
+    # bytes read along with the header, hopefully including the root
+    initial_read_bytes = 16384
+
+    def __init__(self, read_range):
+        self.read_range = read_range
+        self.lock = threading.Lock()
+        self.root = None
+        self.header = None
+        # leaf offset -> (tile ids, entries)
+        self.leaves = {}
+
+    def _load_root(self):
+        with self.lock:
+            if self.root is None:
+                data = self.read_range(0, self.initial_read_bytes)
+                fields = struct.unpack(HEADER_FORMAT, data[:HEADER_SIZE])
+                if fields[0] != MAGIC:
+                    raise ValueError('Not a tile archive')
+                header = ArchiveHeader(fields[1].rstrip('\0'), *fields[2:])
+                root_end = header.root_offset + header.root_length
+                if root_end <= len(data):
+                    root_data = data[header.root_offset:root_end]
+                else:
+                    root_data = self.read_range(
+                        header.root_offset, header.root_length)
+                self.root = _indexed(decode_directory(root_data))
+                self.header = header
+        return self.root
+
+    def _leaf(self, entry):
+        leaf = self.leaves.get(entry.offset)
+        if leaf is None:
+            leaf = _indexed(decode_directory(self.read_range(
+                self.header.leaf_offset + entry.offset, entry.length)))
+            self.leaves[entry.offset] = leaf
+        return leaf
+
+    def _find(self, tile_id):
+        tile_ids, entries = self._load_root()
+        while True:
+            i = bisect.bisect_right(tile_ids, tile_id) - 1
+            if i < 0:
+                return None
+            entry = entries[i]
+            if entry.run_length > 0:
+                if tile_id < entry.tile_id + entry.run_length:
+                    return entry
+                return None
+            tile_ids, entries = self._leaf(entry)
+
+    def read_tile(self, coord):
+        entry = self._find(coord_to_tile_id(coord))
+        if entry is None:
+            return None
+        return self.read_range(
+            self.header.data_offset + entry.offset, entry.length)
+
+    def entries(self):
+        for entry in self._load_root()[1]:
+            if entry.run_length > 0:
+                yield entry
+            else:
+                for leaf_entry in self._leaf(entry)[1]:
+                    yield leaf_entry
+
+    def tiles(self):
+        """yield (tile_id, data) for all the tiles, in tile id order"""
+        for entry in self.entries():
+            data = self.read_range(
+                self.header.data_offset + entry.offset, entry.length)
+            for tile_id in range(
+                    entry.tile_id, entry.tile_id + entry.run_length):
+                yield tile_id, data
+
+    def list_tiles(self):
+        for entry in self.entries():
+            for tile_id in range(
+                    entry.tile_id, entry.tile_id + entry.run_length):
+                yield tile_id_to_coord(tile_id)
+
+
+class ArchiveStore(object):
+
+    """
+    Stores tiles in an archive per format, in a local directory
+
+    Each tile is appended to a log for its format before the write returns,
+    so that a tile which has been acknowledged survives the process dying.
+    Each process has its own logs. `finalize` sorts the logs into runs of
+    up to run_bytes and merges them into `<extension>.archive`. It should be
+    called once all the tiles have been written, possibly by several
+    processes sharing the directory. Deleted tiles are logged too, and
+    dropped from the archive by `finalize`. Tiles are only read from the
+    finalized archives.
+    """
+
+    def __init__(self, base_path, run_bytes=64 * 1024 * 1024,
+                 leaf_size=4096):
+        if os.path.exists(base_path):
+            if not os.path.isdir(base_path):
+                raise IOError(
+                    '`{}` exists and is not a directory!'.format(base_path))
+        else:
+            os.makedirs(base_path)
+
+        self.base_path = base_path
+        self.run_bytes = run_bytes
+        self.leaf_size = leaf_size
+        self.lock = threading.Lock()
+        # extension -> log file, for the process which opened them
+        self.logs = {}
+        self.logs_pid = None
+        # extension -> (identity of the archive file, ArchiveReader)
+        self.readers = {}
+
+    def _runs_path(self, extension):
+        return os.path.join(self.base_path, 'runs', extension)
+
+    def _archive_path(self, extension):
+        return os.path.join(self.base_path, '%s.archive' % extension)
+
+    def _log(self, extension):
+        # called with the lock held. logs aren't shared with forked
+        # processes, which open their own.
+        pid = os.getpid()
+        if self.logs_pid != pid:
+            self.logs = {}
+            self.logs_pid = pid
+        log = self.logs.get(extension)
+        if log is None:
+            runs_path = self._runs_path(extension)
+            try:
+                os.makedirs(runs_path)
+            except OSError:
+                pass
+            # names sort in the order the logs were started, so the runs
+            # sorted from later logs win.
+            log_name = '%016d-%d.log' % (int(time.time() * 1000000), pid)
+            log = self.logs[extension] = open(
+                os.path.join(runs_path, log_name), 'ab')
+        return log
+
+    def _append(self, extension, records):
+        with self.lock:
+            log = self._log(extension)
+            for record in records:
+                log.write(record)
+            # handed to the OS, so that it survives the process dying
+            log.flush()
+
+    def write_tile(self, tile_data, coord, format):
+        self._append(
+            format.extension, [_record(coord_to_tile_id(coord), tile_data)])
+
+    def _reader(self, extension):
+        # the reader holds the archive open, and is replaced once the file
+        # at the path is a different one, after it's been finalized again.
+        # forked processes open their own, as they'd share the file offset.
+        path = self._archive_path(extension)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        identity = (os.getpid(), stat.st_dev, stat.st_ino, stat.st_mtime)
+        with self.lock:
+            cached = self.readers.get(extension)
+            if cached is not None and cached[0] == identity:
+                return cached[1]
+
+        try:
+            fp = open(path, 'rb')
+        except IOError:
+            return None
+        stat = os.fstat(fp.fileno())
+        identity = (os.getpid(), stat.st_dev, stat.st_ino, stat.st_mtime)
+        reader = ArchiveReader(file_range_reader(fp))
+        with self.lock:
+            self.readers[extension] = (identity, reader)
+        return reader
+
+    def read_tile(self, coord, format):
+        reader = self._reader(format.extension)
+        if reader is None:
+            return None
+        return reader.read_tile(coord)
+
+    def delete_tiles(self, coords, format):
+        """
+        Record the tiles as deleted, which takes effect when the archive is
+        next finalized. All the coords are counted as deleted.
+        """
+        records = [_record(coord_to_tile_id(coord), None)
+                   for coord in coords]
+        self._append(format.extension, records)
+        return len(records)
+
+    def list_tiles(self, format):
+        reader = self._reader(format.extension)
+        if reader is None:
+            return iter(())
+        return reader.list_tiles()
+
+    def close(self):
+        """close this process's logs"""
+        with self.lock:
+            logs = self.logs if self.logs_pid == os.getpid() else {}
+            self.logs = {}
+        for log in logs.values():
+            log.close()
+
+    def finalize(self):
+        """
+        Merge all the runs for each format into its archive, along with the
+        existing archive, returning the headers of the archives written.
+        """
+        self.close()
+        headers = []
+        runs_root = os.path.join(self.base_path, 'runs')
+        if not os.path.isdir(runs_root):
+            return headers
+
+        for extension in sorted(os.listdir(runs_root)):
+            runs_path = self._runs_path(extension)
+            # a log is only removed once its runs have been written. if that
+            # was interrupted, sorting it again writes the same runs.
+            for name in sorted(os.listdir(runs_path)):
+                if name.endswith('.log'):
+                    log_path = os.path.join(runs_path, name)
+                    sort_log(log_path, self.run_bytes)
+                    os.remove(log_path)
+            run_paths = [os.path.join(runs_path, name)
+                         for name in sorted(os.listdir(runs_path))
+                         if name.endswith('.run')]
+            if not run_paths:
+                continue
+
+            # tiles already in the archive come first, so that the runs
+            # replace them.
+            archive_path = self._archive_path(extension)
+            merge_paths = list(run_paths)
+            if os.path.exists(archive_path):
+                prev_run_path = os.path.join(runs_path, 'archive.prev')
+                with open(archive_path, 'rb') as archive_fp:
+                    reader = ArchiveReader(file_range_reader(archive_fp))
+                    write_run(prev_run_path, reader.tiles())
+                merge_paths.insert(0, prev_run_path)
+
+            headers.append(finalize_archive(
+                merge_paths, archive_path, extension, self.leaf_size))
+            with self.lock:
+                self.readers.pop(extension, None)
+            for path in merge_paths:
+                os.remove(path)
+
+        return headers
+
+
+def make_archive_store(yml):
+    path = yml.get('path') or yml.get('name')
+    assert path, 'Missing archive store path'
+    return ArchiveStore(
+        path, yml.get('run-bytes', 64 * 1024 * 1024),
+        yml.get('leaf-size', 4096))
@@ -0,0 +1,147 @@
+# memory budgets for the queues between the stages of tilequeue process, so
+# that they hold back on the size of the data waiting in them, rather than
+# the number of jobs.
+import Queue
+import multiprocessing
+import time
+
+
+# key of the estimated size in the data of each job while it's queued
+_QUEUED_BYTES = '__queued_bytes__'
+
+
+def _value_size(value):
+    if isinstance(value, (str, unicode, bytearray, buffer)):
+        return len(value)
+    elif isinstance(value, dict):
+        return sum(len(k) + _value_size(v) for k, v in value.iteritems())
+    elif isinstance(value, (list, tuple)):
+        return sum(_value_size(v) for v in value)
+    # numbers, None and anything else count as a machine word.
+    return 8
+
+
+def fetched_data_size(data):
+    """estimate of the bytes held by a job's fetched data"""
+    deferred = data.get('deferred_fetch')
+    if deferred is not None:
+        return len(deferred.payload or '')
+    return _value_size(data['source_rows'])
+
+
+def formatted_data_size(data):
+    """bytes of the formatted tiles of a processed job"""
+    return sum(len(tile['tile']) for tile in data['formatted_tiles'])
+
+
+class ByteBudget(object):
+
+    """
+    A budget of bytes, shared between processes
+
+    Data which fits in the budget is admitted straight away, and otherwise
+    waits for earlier data to be released. Data is always admitted when
+    nothing else is held, however large it is, so that it can't get stuck.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.n_bytes = multiprocessing.Value('l', 0, lock=False)
+        # the number of callers waiting for bytes to be released
+        self.n_waiting = multiprocessing.Value('l', 0, lock=False)
+        self.cond = multiprocessing.Condition()
+
+    def acquire(self, n_bytes, timeout=None):
+        """reserve n_bytes, returning False if that timed out"""
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self.cond:
+            while self.n_bytes.value > 0 and \
+                    self.n_bytes.value + n_bytes > self.max_bytes:
+                wait_seconds = None
+                if deadline is not None:
+                    wait_seconds = deadline - time.time()
+                    if wait_seconds <= 0:
+                        return False
+                self.n_waiting.value += 1
+                try:
+                    self.cond.wait(wait_seconds)
+                finally:
+                    self.n_waiting.value -= 1
+            self.n_bytes.value += n_bytes
+        return True
+
+    def release(self, n_bytes):
+        with self.cond:
+            self.n_bytes.value -= n_bytes
+            self.cond.notify_all()
+
+    def used(self):
+        return self.n_bytes.value
+
+    def utilization(self):
+        return float(self.n_bytes.value) / self.max_bytes
+
+    def exhausted(self):
+        """True if the budget is used up, or someone is waiting on it"""
+        return self.n_waiting.value > 0 or self.utilization() >= 1
+
+
+class BudgetedQueue(object):
+
+    """
+    Wraps a queue so that the jobs waiting in it are kept within a ByteBudget
+
+    The size of each job is estimated by `size_fn` when it's put, and
+    released when it's taken off the queue again. Sentinels aren't counted.
+    """
+
+    def __init__(self, queue, budget, size_fn):
+        self.queue = queue
+        self.budget = budget
+        self.size_fn = size_fn
+
+    def put(self, data, block=True, timeout=None):
+        if data is None:
+            self.queue.put(data, block, timeout)
+            return
+
+        n_bytes = self.size_fn(data)
+        if not self.budget.acquire(n_bytes, timeout if block else 0):
+            raise Queue.Full
+        data[_QUEUED_BYTES] = n_bytes
+        try:
+            self.queue.put(data, block, timeout)
+        except Exception:
+            del data[_QUEUED_BYTES]
+            self.budget.release(n_bytes)
+            raise
+
+    def get(self, block=True, timeout=None):
+        data = self.queue.get(block, timeout)
+        if data is not None:
+            self.budget.release(data.pop(_QUEUED_BYTES, 0))
+        return data
+
+    def consumer(self, index):
+        # for a budgeted AffinityQueues, all the consumers share the budget.
+        return BudgetedQueue(
+            self.queue.consumer(index), self.budget, self.size_fn)
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def empty(self):
+        return self.queue.empty()
+
+    def full(self):
+        # the queue is sized generously and the budget usually holds it back
+        # first, which counts as full too, eg for the concurrency tuner.
+        return self.budget.exhausted() or self.queue.full()
+
+    def close(self):
+        self.queue.close()
+
+    def join_thread(self):
+        self.queue.join_thread()
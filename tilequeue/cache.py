@@ -0,0 +1,265 @@
+# local disk cache for objects read from remote storage
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from tilequeue.store import os_replace
+
+
+class MemoryCache(object):
+
+    """
+    Least recently used cache of payloads in memory, up to max_bytes
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # key -> payload, from least to most recently used
+        self.lru = OrderedDict()
+        self.n_bytes = 0
+
+    def get(self, key):
+        with self.lock:
+            payload = self.lru.pop(key, None)
+            if payload is not None:
+                self.lru[key] = payload
+            return payload
+
+    def put(self, key, payload):
+        with self.lock:
+            old = self.lru.pop(key, None)
+            if old is not None:
+                self.n_bytes -= len(old)
+            self.lru[key] = payload
+            self.n_bytes += len(payload)
+            while self.n_bytes > self.max_bytes and self.lru:
+                _, evicted = self.lru.popitem(last=False)
+                self.n_bytes -= len(evicted)
+
+
+class DiskCache(object):
+
+    """
+    Content addressed cache of payloads on local disk
+
+    Each payload is stored once, under the hash of its content, and an index
+    maps keys to the ETag and content hash that they were last read with.
+    Both are kept on disk, so the cache survives restarts. Once the payloads
+    and index entries add up to more than `max_bytes`, the least recently
+    used of them are removed. An index entry whose payload has been removed
+    reads as a miss, until it's removed in turn or the key is put again.
+
+    Several processes can share the directory. Each lists it again after
+    writing 1/32 of `max_bytes`, or after `rescan_seconds`, and evicts by the
+    files' modification times, which are updated when they're used. So the
+    processes share the one bound, though it can be overshot by what they
+    write in between.
+
+    The cache doesn't decide whether an entry is still valid. Use `read` with
+    a conditional read of the origin (e.g. an S3 GET with IfNoneMatch) to
+    check the cached ETag each time.
+    """
+
+    def __init__(self, path, max_bytes, rescan_seconds=60,
+                 stale_tmp_seconds=3600):
+        self.objects_path = os.path.join(path, 'objects')
+        self.index_path = os.path.join(path, 'index')
+        for dir_path in (self.objects_path, self.index_path):
+            try:
+                os.makedirs(dir_path)
+            except OSError:
+                if not os.path.isdir(dir_path):
+                    raise
+
+        self.max_bytes = max_bytes
+        self.rescan_seconds = rescan_seconds
+        self.stale_tmp_seconds = stale_tmp_seconds
+        # other processes can use the same directory, eg the processors, so
+        # it's listed again to see what they've written once this process
+        # has written a share of max_bytes, or after rescan_seconds.
+        self.rescan_bytes = max(1, max_bytes / 32)
+        self.lock = threading.Lock()
+        # path of each object and index entry -> size, from least to most
+        # recently used
+        self.lru = OrderedDict()
+        self.n_bytes = 0
+        self.n_written = 0
+        self.scan_time = None
+        self._scan()
+
+    def _scan(self):
+        now = time.time()
+        with self.lock:
+            # files used at the same time on disk, as far as the mtime can
+            # tell, are kept in the order this process used them.
+            positions = dict((path, i) for i, path in enumerate(self.lru))
+
+        files = []
+        for dir_path in (self.objects_path, self.index_path):
+            for name in os.listdir(dir_path):
+                path = os.path.join(dir_path, name)
+                try:
+                    stat = os.stat(path)
+                    if name.endswith('.tmp'):
+                        # left over from an interrupted write, unless it's
+                        # a write in progress in another process.
+                        if now - stat.st_mtime > self.stale_tmp_seconds:
+                            os.remove(path)
+                        continue
+                except OSError:
+                    # removed by another process
+                    continue
+                files.append((stat.st_mtime, positions.get(path, -1), path,
+                              stat.st_size))
+
+        files.sort()
+        lru = OrderedDict()
+        n_bytes = 0
+        for _, _, path, size in files:
+            lru[path] = size
+            n_bytes += size
+
+        with self.lock:
+            self.lru = lru
+            self.n_bytes = n_bytes
+            self.n_written = 0
+            self.scan_time = now
+            self._evict()
+
+    def _object_file(self, digest):
+        return os.path.join(self.objects_path, digest)
+
+    def _index_file(self, key):
+        return os.path.join(self.index_path, hashlib.sha1(key).hexdigest())
+
+    def _write_file(self, dir_path, file_path, data):
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=dir_path)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(data)
+            os_replace(tmp_path, file_path)
+        except Exception:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def _used(self, path, size=None):
+        # expects to be called with the lock held. marks the file as the
+        # most recently used, or adds it if it's new.
+        old_size = self.lru.pop(path, None)
+        if size is None:
+            size = old_size
+        if size is None:
+            return
+        if old_size is not None:
+            self.n_bytes -= old_size
+        self.lru[path] = size
+        self.n_bytes += size
+
+    def _evict(self):
+        # expects to be called with the lock held
+        while self.n_bytes > self.max_bytes and self.lru:
+            path, size = self.lru.popitem(last=False)
+            self.n_bytes -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def get(self, key):
+        """return the (etag, payload) last stored for key, or None"""
+        index_file = self._index_file(key)
+        try:
+            with open(index_file, 'rb') as fp:
+                etag, digest = fp.read().split('\n')
+            object_file = self._object_file(digest)
+            with open(object_file, 'rb') as fp:
+                payload = fp.read()
+        except (IOError, ValueError):
+            return None
+
+        with self.lock:
+            self._used(index_file)
+            self._used(object_file)
+        for path in (index_file, object_file):
+            try:
+                # keep the recency on disk too, for the next restart
+                os.utime(path, None)
+            except OSError:
+                pass
+
+        return etag, payload
+
+    def put(self, key, etag, payload):
+        digest = hashlib.sha1(payload).hexdigest()
+        object_file = self._object_file(digest)
+        if os.path.exists(object_file):
+            try:
+                os.utime(object_file, None)
+            except OSError:
+                pass
+        else:
+            self._write_file(self.objects_path, object_file, payload)
+        index_file = self._index_file(key)
+        index_data = '%s\n%s' % (etag, digest)
+        self._write_file(self.index_path, index_file, index_data)
+
+        with self.lock:
+            self._used(object_file, len(payload))
+            self._used(index_file, len(index_data))
+            self.n_written += len(payload) + len(index_data)
+            rescan = self.n_written >= self.rescan_bytes or \
+                time.time() - self.scan_time >= self.rescan_seconds
+            if not rescan:
+                self._evict()
+        if rescan:
+            self._scan()
+
+    def delete(self, key):
+        index_file = self._index_file(key)
+        try:
+            os.remove(index_file)
+        except OSError:
+            pass
+        with self.lock:
+            size = self.lru.pop(index_file, None)
+            if size is not None:
+                self.n_bytes -= size
+
+    def read(self, key, read_if_changed):
+        """
+        Read through the cache, validating any cached payload
+
+        `read_if_changed` is called with the cached ETag, or None, and should
+        return None if the origin still has that version. Otherwise it should
+        return a tuple of the payload, which may be None if it's missing, and
+        its ETag.
+        """
+        cached = self.get(key)
+        etag = cached[0] if cached else None
+
+        result = read_if_changed(etag)
+        if result is None:
+            assert cached, 'Not modified response for uncached %r' % key
+            return cached[1]
+
+        payload, etag = result
+        if payload is None or not etag:
+            self.delete(key)
+        else:
+            self.put(key, etag, payload)
+        return payload
+
+
+def make_disk_cache(yml):
+    path = yml.get('path')
+    assert path, 'Missing cache path'
+    max_bytes = yml.get('max-bytes')
+    assert max_bytes, 'Missing cache max-bytes'
+    return DiskCache(path, max_bytes)
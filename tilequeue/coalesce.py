@@ -0,0 +1,104 @@
+# coalescing of duplicate jobs within tilequeue process. expiry often enqueues
+# the same coordinate several times in quick succession, through different
+# messages or queues, and rather than render it again, a later job can wait
+# for the one already in flight and be acknowledged along with it.
+import threading
+import time
+
+
+class _InFlight(object):
+
+    def __init__(self, coord, start_time):
+        self.coord = coord
+        self.start_time = start_time
+        # (coord_handle, timing_state) of the jobs waiting on this one
+        self.attached = []
+
+
+class JobCoalescer(object):
+
+    """
+    Tracks the coordinates being rendered, so that duplicate jobs can be
+    attached to them
+
+    A job can only be attached to one which hasn't started fetching its
+    data yet, including prefetching it, so that the data rendered is at
+    least as new as the request for it. Duplicates which arrive later are
+    rendered as usual.
+
+    Jobs which fail are never marked done, and are forgotten after
+    max_age_seconds, along with the jobs attached to them. Neither are
+    acknowledged, so the queue will retry both.
+    """
+
+    def __init__(self, max_age_seconds=3600):
+        self.max_age_seconds = max_age_seconds
+        self.lock = threading.Lock()
+        # coalesce_id -> _InFlight
+        self.jobs = {}
+        # coord -> coalesce_id, of the jobs yet to start fetching
+        self.not_fetching = {}
+        self.next_id = 0
+        self.last_prune_time = time.time()
+
+    def add(self, coord, coord_handle, timing_state):
+        """
+        return the coalesce_id for a new job for the coordinate, or None if
+        it was attached to a job already in flight
+        """
+        now = time.time()
+        with self.lock:
+            self._prune(now)
+            coalesce_id = self.not_fetching.get(coord)
+            if coalesce_id is not None:
+                self.jobs[coalesce_id].attached.append(
+                    (coord_handle, timing_state))
+                return None
+
+            self.next_id += 1
+            coalesce_id = self.next_id
+            self.jobs[coalesce_id] = _InFlight(coord, now)
+            self.not_fetching[coord] = coalesce_id
+            return coalesce_id
+
+    def fetching(self, coalesce_id):
+        """mark the job as having started to fetch its data"""
+        with self.lock:
+            self._unlist(coalesce_id)
+
+    def done(self, coalesce_id):
+        """
+        finish the job, returning the (coord_handle, timing_state) of the
+        jobs attached to it
+        """
+        with self.lock:
+            self._unlist(coalesce_id)
+            in_flight = self.jobs.pop(coalesce_id, None)
+        if in_flight is None:
+            return []
+        return in_flight.attached
+
+    def _unlist(self, coalesce_id):
+        in_flight = self.jobs.get(coalesce_id)
+        if in_flight is not None and \
+                self.not_fetching.get(in_flight.coord) == coalesce_id:
+            del self.not_fetching[in_flight.coord]
+
+    def _prune(self, now):
+        if now - self.last_prune_time < self.max_age_seconds:
+            return
+        self.last_prune_time = now
+        for coalesce_id, in_flight in self.jobs.items():
+            if now - in_flight.start_time > self.max_age_seconds:
+                self._unlist(coalesce_id)
+                del self.jobs[coalesce_id]
+
+    def __len__(self):
+        with self.lock:
+            return len(self.jobs)
+
+
+def make_job_coalescer(yml):
+    if not yml:
+        return None
+    return JobCoalescer(yml.get('max-age-seconds', 3600))
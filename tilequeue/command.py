@@ -28,6 +28,7 @@ from zope.dottedname.resolve import resolve
 from tilequeue.config import create_query_bounds_pad_fn
 from tilequeue.config import make_config_from_argparse
 from tilequeue.format import lookup_format_by_extension
+from tilequeue.format import with_mvt_layer_cache
 from tilequeue.metro_extract import city_bounds
 from tilequeue.metro_extract import parse_metro_extract
 from tilequeue.process import process
@@ -37,6 +38,7 @@ from tilequeue.query import make_data_fetcher
 from tilequeue.queue import make_sqs_queue
 from tilequeue.queue import make_visibility_manager
 from tilequeue.store import make_store
+from tilequeue.tile import coord_children_preorder
 from tilequeue.tile import coord_children_range
 from tilequeue.tile import coord_int_zoom_up
 from tilequeue.tile import coord_is_valid
@@ -58,12 +60,14 @@ from tilequeue.utils import AwsSessionHelper
 from tilequeue.utils import grouper
 from tilequeue.utils import parse_log_file
 from tilequeue.utils import time_block
+from tilequeue.worker import ConcurrencyTuner
 from tilequeue.worker import DataFetch
 from tilequeue.worker import ProcessAndFormatData
 from tilequeue.worker import QueuePrint
 from tilequeue.worker import S3Storage
 from tilequeue.worker import TileQueueReader
 from tilequeue.worker import TileQueueWriter
+from tilequeue.worker import WorkerThreads
 
 
 def create_coords_generator_from_tiles_file(fp, logger=None):
@@ -79,11 +83,19 @@ def create_coords_generator_from_tiles_file(fp, logger=None):
         yield coord
 
 
-def lookup_formats(format_extensions):
+def lookup_formats(format_extensions, mvt_layer_cache_cfg=None):
+    # optionally, MVT formats cache their encoded layers.
+    layer_cache = None
+    if mvt_layer_cache_cfg:
+        from tilequeue.format import make_mvt_layer_cache
+        layer_cache = make_mvt_layer_cache(mvt_layer_cache_cfg)
+
     formats = []
     for extension in format_extensions:
         format = lookup_format_by_extension(extension)
         assert format is not None, 'Unknown extension: %s' % extension
+        if layer_cache is not None:
+            format = with_mvt_layer_cache(format, layer_cache)
         formats.append(format)
     return formats
 
@@ -406,7 +418,8 @@ def make_seed_tile_generator(cfg):
 def _make_store(cfg,
                 s3_role_arn=None,
                 s3_role_session_duration_s=None,
-                logger=None):
+                logger=None,
+                max_pool_connections=None):
     store_cfg = cfg.yml.get('store')
     assert store_cfg, 'Store was not configured, but is necessary.'
     if logger is None:
@@ -414,10 +427,19 @@ def _make_store(cfg,
     store = make_store(store_cfg,
                        s3_role_arn=s3_role_arn,
                        s3_role_session_duration_s=s3_role_session_duration_s,
-                       logger=logger)
+                       logger=logger,
+                       max_pool_connections=max_pool_connections)
     return store
 
 
+def _close_store(store):
+    # stores which keep files open for writing, such as the archive store,
+    # need closing once all the tiles have been written.
+    close = getattr(store, 'close', None)
+    if close is not None:
+        close()
+
+
 def explode_and_intersect(coord_ints, tiles_of_interest, until=0):
 
     next_coord_ints = coord_ints
@@ -612,6 +634,16 @@ def make_min_zoom_calc_mapping(process_yaml_cfg):
     return min_zoom_calc_mapping
 
 
+def _make_fingerprinter(cfg, peripherals, formats=()):
+    # the formats only matter for computing fingerprints, not for forgetting
+    # the ones of deleted tiles.
+    if not cfg.fingerprint_cfg:
+        return None
+    from tilequeue.fingerprint import make_fingerprinter
+    return make_fingerprinter(
+        cfg.fingerprint_cfg, peripherals.redis_client, formats)
+
+
 def tilequeue_process(cfg, peripherals):
     from tilequeue.log import JsonTileProcessingLogger
     logger = make_logger(cfg, 'process')
@@ -628,9 +660,8 @@ def tilequeue_process(cfg, peripherals):
         parse_layer_data(
             query_cfg, cfg.buffer_cfg, os.path.dirname(cfg.query_cfg)))
 
-    formats = lookup_formats(cfg.output_formats)
-
-    store = _make_store(cfg)
+    formats = lookup_formats(
+        cfg.output_formats, cfg.mvt_layer_cache_cfg)
 
     assert cfg.postgresql_conn_info, 'Missing postgresql connection info'
 
@@ -654,10 +685,12 @@ def tilequeue_process(cfg, peripherals):
     # geometry waiting to be processed from taking up all the RAM!
     size_sqr = (cfg.metatile_size or 1)**2
     default_queue_buffer_size = max(1, 16 / size_sqr)
+    # queues with a byte budget are kept within that instead, so they don't
+    # need to allow for large jobs in the number they hold.
     sql_queue_buffer_size = cfg.sql_queue_buffer_size or \
-        default_queue_buffer_size
+        (16 if cfg.sql_queue_max_bytes else default_queue_buffer_size)
     proc_queue_buffer_size = cfg.proc_queue_buffer_size or \
-        default_queue_buffer_size
+        (16 if cfg.proc_queue_max_bytes else default_queue_buffer_size)
     s3_queue_buffer_size = cfg.s3_queue_buffer_size or \
         default_queue_buffer_size
     n_layers = len(all_layer_data)
@@ -667,14 +700,53 @@ def tilequeue_process(cfg, peripherals):
         n_simultaneous_s3_storage = max(n_cpu / 2, 1)
     assert n_simultaneous_s3_storage > 0
 
-    # thread pool used for queries and uploading to s3
-    n_total_needed_query = n_layers * n_simultaneous_query_sets
-    n_total_needed_s3 = n_formats * n_simultaneous_s3_storage
-    n_total_needed = n_total_needed_query + n_total_needed_s3
+    # optionally adjust the number of fetch and storage workers as they run,
+    # within bounds around the configured numbers.
+    autotune_yaml = cfg.autotune_cfg
+    fetch_bounds = (n_simultaneous_query_sets, n_simultaneous_query_sets)
+    s3_storage_bounds = (n_simultaneous_s3_storage, n_simultaneous_s3_storage)
+    if autotune_yaml:
+        fetch_yaml = autotune_yaml.get('fetch', {})
+        fetch_bounds = (
+            fetch_yaml.get('min', 1),
+            fetch_yaml.get('max', n_simultaneous_query_sets * 2))
+        s3_storage_yaml = autotune_yaml.get('storage', {})
+        s3_storage_bounds = (
+            s3_storage_yaml.get('min', 1),
+            s3_storage_yaml.get('max', n_simultaneous_s3_storage * 2))
+        for min_workers, max_workers in (fetch_bounds, s3_storage_bounds):
+            assert 0 < min_workers <= max_workers, \
+                'Invalid autotune bounds: %d - %d' % (min_workers, max_workers)
+        n_simultaneous_query_sets = min(
+            max(n_simultaneous_query_sets, fetch_bounds[0]), fetch_bounds[1])
+        n_simultaneous_s3_storage = min(
+            max(n_simultaneous_s3_storage, s3_storage_bounds[0]),
+            s3_storage_bounds[1])
+
+    # separate thread pools for queries and for uploading to s3, so that
+    # neither can starve the other. by default, each is sized for the most
+    # workers there can be.
+    from tilequeue.iopool import make_io_pool
+    io_pools_yaml = cfg.io_pools_cfg or {}
     n_max_io_workers = 50
-    n_io_workers = min(n_total_needed, n_max_io_workers)
-    io_pool = ThreadPool(n_io_workers)
-    feature_fetcher = make_data_fetcher(cfg, layer_data, query_cfg, io_pool)
+    n_total_needed_query = n_layers * fetch_bounds[1]
+    n_total_needed_s3 = n_formats * s3_storage_bounds[1]
+    db_pool = make_io_pool(
+        'db', io_pools_yaml.get('db'),
+        min(n_total_needed_query, n_max_io_workers))
+    upload_pool = make_io_pool(
+        'upload', io_pools_yaml.get('upload'),
+        min(n_total_needed_s3, n_max_io_workers))
+    io_pools = (db_pool, upload_pool)
+
+    store = _make_store(cfg, max_pool_connections=upload_pool.n_workers)
+    # optionally index RAWR tiles and read rows from them in the processor
+    # processes, so that the fetch threads in this process only do I/O.
+    rawr_yaml = cfg.yml.get('rawr') or {}
+    index_in_processors = bool(rawr_yaml.get('index-in-processors'))
+    feature_fetcher = make_data_fetcher(
+        cfg, layer_data, query_cfg, db_pool,
+        index_in_processors=index_in_processors)
 
     # create all queues used to manage pipeline
 
@@ -685,14 +757,48 @@ def tilequeue_process(cfg, peripherals):
     # in waiting while others are processed, can become stale faster
     tile_input_queue = Queue.Queue(10)
 
+    # create a data processor per cpu
+    n_data_processors = n_cpu
+
     # holds raw sql results - no filtering or processing done on them
-    sql_data_fetch_queue = multiprocessing.Queue(sql_queue_buffer_size)
+    affinity_yaml = cfg.processor_affinity_cfg
+    if affinity_yaml:
+        # each processor has its own queue, and jobs near each other go to
+        # the same processor, so that its caches get reused.
+        from tilequeue.worker import AffinityQueues
+        affinity_zoom = affinity_yaml.get('zoom')
+        if affinity_zoom is None:
+            affinity_zoom = rawr_yaml.get('group-zoom', 10)
+        per_processor_buffer_size = max(
+            1, sql_queue_buffer_size / n_data_processors)
+        sql_data_fetch_queue = AffinityQueues(
+            [multiprocessing.Queue(per_processor_buffer_size)
+             for i in range(n_data_processors)],
+            affinity_zoom, affinity_yaml.get('low-zoom-levels', 2))
+    else:
+        sql_data_fetch_queue = multiprocessing.Queue(sql_queue_buffer_size)
 
     # holds data after it has been filtered and processed
     # this is where the cpu intensive part of the operation will happen
     # the results will be data that is formatted for each necessary format
     processor_queue = multiprocessing.Queue(proc_queue_buffer_size)
 
+    # optionally hold back on the estimated size of the data waiting in the
+    # queues too, as jobs can vary in size a lot.
+    if cfg.sql_queue_max_bytes or cfg.proc_queue_max_bytes:
+        from tilequeue.budget import BudgetedQueue
+        from tilequeue.budget import ByteBudget
+    if cfg.sql_queue_max_bytes:
+        from tilequeue.budget import fetched_data_size
+        sql_data_fetch_queue = BudgetedQueue(
+            sql_data_fetch_queue, ByteBudget(cfg.sql_queue_max_bytes),
+            fetched_data_size)
+    if cfg.proc_queue_max_bytes:
+        from tilequeue.budget import formatted_data_size
+        processor_queue = BudgetedQueue(
+            processor_queue, ByteBudget(cfg.proc_queue_max_bytes),
+            formatted_data_size)
+
     # holds data after it has been sent to s3
     s3_store_queue = Queue.Queue(s3_queue_buffer_size)
 
@@ -705,29 +811,54 @@ def tilequeue_process(cfg, peripherals):
     msg_tracker = make_msg_tracker(msg_tracker_yaml, logger)
     from tilequeue.stats import TileProcessingStatsHandler
     stats_handler = TileProcessingStatsHandler(peripherals.stats)
+    # start reading the data for jobs as soon as they come off the queue,
+    # if the data fetcher supports it.
+    prefetch_fn = getattr(feature_fetcher, 'prefetch', None)
+    from tilequeue.queue.scheduler import make_queue_scheduler
+    queue_scheduler = make_queue_scheduler(
+        cfg.yml.get('queue-scheduler'), queue_mapper, tile_proc_logger)
+    # optionally acknowledge duplicate jobs along with the one in flight,
+    # rather than render them again.
+    from tilequeue.coalesce import make_job_coalescer
+    coalescer = make_job_coalescer(cfg.coalesce_cfg)
     tile_queue_reader = TileQueueReader(
         queue_mapper, msg_marshaller, msg_tracker, tile_input_queue,
         tile_proc_logger, stats_handler, thread_tile_queue_reader_stop,
-        cfg.max_zoom, cfg.group_by_zoom)
+        cfg.max_zoom, cfg.group_by_zoom, prefetch_fn, queue_scheduler,
+        coalescer)
 
     data_fetch = DataFetch(
-        feature_fetcher, tile_input_queue, sql_data_fetch_queue, io_pool,
+        feature_fetcher, tile_input_queue, sql_data_fetch_queue, db_pool,
         tile_proc_logger, stats_handler, cfg.metatile_zoom, cfg.max_zoom,
-        cfg.metatile_start_zoom)
+        cfg.metatile_start_zoom, coalescer)
+
+    # skip jobs whose input hasn't changed since their tiles were stored.
+    fingerprinter = _make_fingerprinter(cfg, peripherals, formats)
 
     data_processor = ProcessAndFormatData(
         post_process_data, formats, sql_data_fetch_queue, processor_queue,
         cfg.buffer_cfg, output_calc_mapping, layer_data, tile_proc_logger,
-        stats_handler)
-
-    s3_storage = S3Storage(processor_queue, s3_store_queue, io_pool, store,
-                           tile_proc_logger, cfg.metatile_size)
+        stats_handler, fingerprinter, feature_fetcher)
+
+    # optionally have each storage worker keep many jobs' uploads going,
+    # rather than wait on the uploads of one job at a time.
+    storage_pipeline_yaml = cfg.storage_pipeline_cfg
+    if storage_pipeline_yaml:
+        from tilequeue.worker import PipelinedS3Storage
+        s3_storage = PipelinedS3Storage(
+            processor_queue, s3_store_queue, upload_pool, store,
+            tile_proc_logger, cfg.metatile_size, fingerprinter,
+            storage_pipeline_yaml.get('max-in-flight', 64))
+    else:
+        s3_storage = S3Storage(
+            processor_queue, s3_store_queue, upload_pool, store,
+            tile_proc_logger, cfg.metatile_size, fingerprinter)
 
     thread_tile_writer_stop = threading.Event()
     tile_queue_writer = TileQueueWriter(
         queue_mapper, s3_store_queue, peripherals.inflight_mgr,
         msg_tracker, tile_proc_logger, stats_handler,
-        thread_tile_writer_stop)
+        thread_tile_writer_stop, coalescer)
 
     def create_and_start_thread(fn, *args):
         t = threading.Thread(target=fn, args=args)
@@ -736,35 +867,27 @@ def tilequeue_process(cfg, peripherals):
 
     thread_tile_queue_reader = create_and_start_thread(tile_queue_reader)
 
-    threads_data_fetch = []
-    threads_data_fetch_stop = []
-    for i in range(n_simultaneous_query_sets):
-        thread_data_fetch_stop = threading.Event()
-        thread_data_fetch = create_and_start_thread(data_fetch,
-                                                    thread_data_fetch_stop)
-        threads_data_fetch.append(thread_data_fetch)
-        threads_data_fetch_stop.append(thread_data_fetch_stop)
+    data_fetch_workers = WorkerThreads(
+        'fetch', data_fetch, tile_input_queue)
+    data_fetch_workers.start(n_simultaneous_query_sets)
 
-    # create a data processor per cpu
-    n_data_processors = n_cpu
     data_processors = []
     data_processors_stop = []
     for i in range(n_data_processors):
         data_processor_stop = multiprocessing.Event()
+        data_processor_queue = None
+        if affinity_yaml:
+            data_processor_queue = sql_data_fetch_queue.consumer(i)
         process_data_processor = multiprocessing.Process(
-            target=data_processor, args=(data_processor_stop,))
+            target=data_processor,
+            args=(data_processor_stop, data_processor_queue))
         process_data_processor.start()
         data_processors.append(process_data_processor)
         data_processors_stop.append(data_processor_stop)
 
-    threads_s3_storage = []
-    threads_s3_storage_stop = []
-    for i in range(n_simultaneous_s3_storage):
-        thread_s3_storage_stop = threading.Event()
-        thread_s3_storage = create_and_start_thread(s3_storage,
-                                                    thread_s3_storage_stop)
-        threads_s3_storage.append(thread_s3_storage)
-        threads_s3_storage_stop.append(thread_s3_storage_stop)
+    s3_storage_workers = WorkerThreads(
+        'storage', s3_storage, processor_queue)
+    s3_storage_workers.start(n_simultaneous_s3_storage)
 
     thread_tile_writer = create_and_start_thread(tile_queue_writer)
 
@@ -779,15 +902,35 @@ def tilequeue_process(cfg, peripherals):
         queue_printer_thread_stop = threading.Event()
         queue_printer = QueuePrint(
             cfg.log_queue_sizes_interval_seconds, queue_data, tile_proc_logger,
-            queue_printer_thread_stop)
+            queue_printer_thread_stop, stats_handler, io_pools)
         queue_printer_thread = create_and_start_thread(queue_printer)
     else:
         queue_printer_thread = None
         queue_printer_thread_stop = None
 
+    if autotune_yaml:
+        tuner_thread_stop = threading.Event()
+        tuner = ConcurrencyTuner(
+            data_fetch_workers, fetch_bounds, s3_storage_workers,
+            s3_storage_bounds, tile_input_queue, sql_data_fetch_queue,
+            processor_queue, tile_proc_logger, tuner_thread_stop,
+            autotune_yaml.get('interval-seconds', 30),
+            autotune_yaml.get('sample-seconds', 1))
+        tuner_thread = create_and_start_thread(tuner)
+    else:
+        tuner_thread = None
+        tuner_thread_stop = None
+
     def stop_all_workers(signum, stack):
         tile_proc_logger.lifecycle('tilequeue processing shutdown ...')
 
+        # stop changing the numbers of workers before stopping them.
+        if tuner_thread:
+            tile_proc_logger.lifecycle('joining concurrency tuner ...')
+            tuner_thread_stop.set()
+            tuner_thread.join()
+            tile_proc_logger.lifecycle('joining concurrency tuner ... done')
+
         tile_proc_logger.lifecycle(
             'requesting all workers (threads and processes) stop ...')
 
@@ -795,12 +938,10 @@ def tilequeue_process(cfg, peripherals):
         # ask all these to stop first
 
         thread_tile_queue_reader_stop.set()
-        for thread_data_fetch_stop in threads_data_fetch_stop:
-            thread_data_fetch_stop.set()
+        data_fetch_workers.stop()
         for data_processor_stop in data_processors_stop:
             data_processor_stop.set()
-        for thread_s3_storage_stop in threads_s3_storage_stop:
-            thread_s3_storage_stop.set()
+        s3_storage_workers.stop()
         thread_tile_writer_stop.set()
 
         if queue_printer_thread_stop:
@@ -821,13 +962,11 @@ def tilequeue_process(cfg, peripherals):
         tile_proc_logger.lifecycle('joining tile queue reader ... done')
         tile_proc_logger.lifecycle(
             'enqueueing sentinels for data fetchers ...')
-        for i in range(len(threads_data_fetch)):
-            tile_input_queue.put(None)
+        data_fetch_workers.put_sentinels()
         tile_proc_logger.lifecycle(
             'enqueueing sentinels for data fetchers ... done')
         tile_proc_logger.lifecycle('joining data fetchers ...')
-        for thread_data_fetch in threads_data_fetch:
-            thread_data_fetch.join()
+        data_fetch_workers.join()
         tile_proc_logger.lifecycle('joining data fetchers ... done')
         tile_proc_logger.lifecycle(
             'enqueueing sentinels for data processors ...')
@@ -840,14 +979,13 @@ def tilequeue_process(cfg, peripherals):
             data_processor.join()
         tile_proc_logger.lifecycle('joining data processors ... done')
         tile_proc_logger.lifecycle('enqueueing sentinels for s3 storage ...')
-        for i in range(len(threads_s3_storage)):
-            processor_queue.put(None)
+        s3_storage_workers.put_sentinels()
         tile_proc_logger.lifecycle(
             'enqueueing sentinels for s3 storage ... done')
         tile_proc_logger.lifecycle('joining s3 storage ...')
-        for thread_s3_storage in threads_s3_storage:
-            thread_s3_storage.join()
+        s3_storage_workers.join()
         tile_proc_logger.lifecycle('joining s3 storage ... done')
+        _close_store(store)
         tile_proc_logger.lifecycle(
             'enqueueing sentinel for tile queue writer ...')
         s3_store_queue.put(None)
@@ -863,10 +1001,11 @@ def tilequeue_process(cfg, peripherals):
 
         tile_proc_logger.lifecycle('joining all workers ... done')
 
-        tile_proc_logger.lifecycle('joining io pool ...')
-        io_pool.close()
-        io_pool.join()
-        tile_proc_logger.lifecycle('joining io pool ... done')
+        tile_proc_logger.lifecycle('joining io pools ...')
+        for io_pool in io_pools:
+            io_pool.close()
+            io_pool.join()
+        tile_proc_logger.lifecycle('joining io pools ... done')
 
         tile_proc_logger.lifecycle('joining multiprocess data fetch queue ...')
         sql_data_fetch_queue.close()
@@ -1386,6 +1525,7 @@ def tilequeue_prune_tiles_of_interest(cfg, peripherals):
     peripherals.stats.gauge('gardener.removed', len(toi_to_remove))
 
     store = _make_store(cfg)
+    fingerprinter = _make_fingerprinter(cfg, peripherals)
     if not toi_to_remove:
         logger.info('Skipping TOI remove step because there are '
                     'no tiles to remove')
@@ -1394,9 +1534,13 @@ def tilequeue_prune_tiles_of_interest(cfg, peripherals):
                     len(toi_to_remove))
 
         for coord_ints in grouper(toi_to_remove, 1000):
+            coords = map(coord_unmarshall_int, coord_ints)
+            # forgotten first, so that a tile which comes back is stored
+            # again even if deleting it fails part way.
+            if fingerprinter is not None:
+                fingerprinter.forget(coords)
             removed = store.delete_tiles(
-                map(coord_unmarshall_int, coord_ints),
-                lookup_format_by_extension(
+                coords, lookup_format_by_extension(
                     store_parts['format']), store_parts['layer'])
             logger.info('Removed %s tiles from S3', removed)
 
@@ -1574,6 +1718,7 @@ def tilequeue_delete_stuck_tiles(cfg, peripherals):
     layer = 'all'
 
     store = _make_store(cfg)
+    fingerprinter = _make_fingerprinter(cfg, peripherals)
 
     logger.info('Removing tiles from S3 ...')
     total_removed = 0
@@ -1584,6 +1729,8 @@ def tilequeue_delete_stuck_tiles(cfg, peripherals):
             if coord:
                 coords.append(coord)
         if coords:
+            if fingerprinter is not None:
+                fingerprinter.forget(coords)
             n_removed = store.delete_tiles(coords, format, layer)
             total_removed += n_removed
             logger.info('Removed %s tiles from S3', n_removed)
@@ -1714,7 +1861,8 @@ def tilequeue_process_tile(cfg, peripherals, args):
             query_cfg, cfg.buffer_cfg, os.path.dirname(cfg.query_cfg)))
 
     output_calc_mapping = make_output_calc_mapping(cfg.process_yaml_cfg)
-    formats = lookup_formats(cfg.output_formats)
+    formats = lookup_formats(
+        cfg.output_formats, cfg.mvt_layer_cache_cfg)
 
     io_pool = ThreadPool(len(layer_data))
     data_fetcher = make_data_fetcher(cfg, layer_data, query_cfg, io_pool)
@@ -1757,12 +1905,17 @@ def tilequeue_rawr_enqueue(cfg, args):
 
 def _tilequeue_rawr_setup(cfg,
                           s3_role_arn=None,
-                          s3_role_session_duration_s=None):
+                          s3_role_session_duration_s=None,
+                          sink_io_pool=None):
     """command to read from rawr queue and generate rawr tiles
 
        if `s3_role_arn` is non-empty then it will be used as the IAM role
        to access the S3 and `s3_role_session_duration_s` determines the S3
        session duration in seconds
+
+       if `sink_io_pool` is provided, then rawr tiles are written to the sink
+       in the background on that pool, and the returned sink is a
+       RawrAsyncSink.
     """
     rawr_yaml = cfg.yml.get('rawr')
     assert rawr_yaml is not None, 'Missing rawr configuration in yaml'
@@ -1781,6 +1934,14 @@ def _tilequeue_rawr_setup(cfg,
     # pass through the postgresql yaml config directly
     conn_ctx = ConnectionContextManager(rawr_postgresql_yaml)
 
+    # when generating several tiles at once, keep the connections open
+    # between tiles rather than reconnecting for each one.
+    n_workers = rawr_yaml.get('workers', 1)
+    assert n_workers > 0, 'rawr workers should be positive'
+    if n_workers > 1:
+        from tilequeue.rawr import RawrConnectionPool
+        conn_ctx = RawrConnectionPool(conn_ctx, n_workers)
+
     rawr_source_list = rawr_yaml.get('sources', DEFAULT_RAWR_SOURCES)
     assert isinstance(rawr_source_list, list), \
         'RAWR source list should be a list'
@@ -1834,11 +1995,15 @@ def _tilequeue_rawr_setup(cfg,
         else:
             assert 0, 'Unknown rawr sink type %s' % sink_type
 
+    if sink_io_pool is not None:
+        from tilequeue.rawr import RawrAsyncSink
+        rawr_sink = RawrAsyncSink(rawr_sink, sink_io_pool)
+
     rawr_source = parse_sources(rawr_source_list)
     rawr_formatter = Msgpack()
     rawr_gen = RawrGenerator(rawr_source, rawr_formatter, rawr_sink)
 
-    return rawr_gen, conn_ctx
+    return rawr_gen, conn_ctx, rawr_sink
 
 
 # run RAWR tile processing in a loop, reading from queue
@@ -1866,12 +2031,28 @@ def tilequeue_rawr_process(cfg, peripherals):
     stats_handler = RawrTilePipelineStatsHandler(peripherals.stats)
     rawr_proc_logger = JsonRawrProcessingLogger(logger)
 
-    rawr_gen, conn_ctx = _tilequeue_rawr_setup(cfg)
+    n_workers = rawr_yaml.get('workers', 1)
+    if n_workers > 1:
+        from tilequeue.rawr import ConcurrentRawrTileGenerationPipeline
+        prefetch_size = rawr_yaml.get('prefetch', n_workers)
+        n_sink_workers = rawr_yaml.get('sink-workers', n_workers)
+        assert prefetch_size > 0, 'rawr prefetch should be positive'
+        assert n_sink_workers > 0, 'rawr sink-workers should be positive'
+        sink_io_pool = ThreadPool(n_sink_workers)
+        rawr_gen, conn_ctx, rawr_sink = _tilequeue_rawr_setup(
+            cfg, sink_io_pool=sink_io_pool)
+        rawr_pipeline = ConcurrentRawrTileGenerationPipeline(
+            rawr_queue, msg_marshaller, group_by_zoom, rawr_gen,
+            peripherals.queue_writer, stats_handler,
+            rawr_proc_logger, conn_ctx, n_workers, prefetch_size, rawr_sink)
+
+    else:
+        rawr_gen, conn_ctx, _ = _tilequeue_rawr_setup(cfg)
+        rawr_pipeline = RawrTileGenerationPipeline(
+            rawr_queue, msg_marshaller, group_by_zoom, rawr_gen,
+            peripherals.queue_writer, stats_handler,
+            rawr_proc_logger, conn_ctx)
 
-    rawr_pipeline = RawrTileGenerationPipeline(
-        rawr_queue, msg_marshaller, group_by_zoom, rawr_gen,
-        peripherals.queue_writer, stats_handler,
-        rawr_proc_logger, conn_ctx)
     rawr_pipeline()
 
 
@@ -1903,7 +2084,7 @@ def tilequeue_rawr_tile(cfg, args):
     assert rawr_yaml is not None, 'Missing rawr configuration in yaml'
     group_by_zoom = rawr_yaml.get('group-zoom')
     assert group_by_zoom is not None, 'Missing group-zoom rawr config'
-    rawr_gen, conn_ctx = \
+    rawr_gen, conn_ctx, _ = \
         _tilequeue_rawr_setup(cfg,
                               s3_role_arn=args.s3_role_arn,
                               s3_role_session_duration_s=args.
@@ -1913,26 +2094,40 @@ def tilequeue_rawr_tile(cfg, args):
     rawr_tile_logger = JsonRawrTileLogger(logger, run_id)
     rawr_tile_logger.lifecycle(parent, 'Rawr tile generation started')
 
+    def gen_coord(coord):
+        try:
+            coord_timing = {}
+            with time_block(coord_timing, 'total'):
+                rawr_tile_coord = convert_coord_object(coord)
+                with conn_ctx() as conn:
+                    # commit transaction
+                    with conn as conn:
+                        # cleanup cursor resources
+                        with conn.cursor() as cur:
+                            table_reader = TableReader(cur)
+                            rawr_gen_timing = rawr_gen(
+                                table_reader, rawr_tile_coord)
+                            coord_timing['gen'] = rawr_gen_timing
+            rawr_tile_logger.coord_done(parent, coord, coord_timing)
+        except Exception as e:
+            rawr_tile_logger.error(e, parent, coord)
+
+    # generate several of the job coords at once if configured to. the
+    # connections are shared between the workers by _tilequeue_rawr_setup.
+    n_workers = rawr_yaml.get('workers', 1)
     parent_timing = {}
     with time_block(parent_timing, 'total'):
         job_coords = find_job_coords_for(parent, group_by_zoom)
-        for coord in job_coords:
+        if n_workers > 1:
+            gen_pool = ThreadPool(n_workers)
             try:
-                coord_timing = {}
-                with time_block(coord_timing, 'total'):
-                    rawr_tile_coord = convert_coord_object(coord)
-                    with conn_ctx() as conn:
-                        # commit transaction
-                        with conn as conn:
-                            # cleanup cursor resources
-                            with conn.cursor() as cur:
-                                table_reader = TableReader(cur)
-                                rawr_gen_timing = rawr_gen(
-                                    table_reader, rawr_tile_coord)
-                                coord_timing['gen'] = rawr_gen_timing
-                rawr_tile_logger.coord_done(parent, coord, coord_timing)
-            except Exception as e:
-                rawr_tile_logger.error(e, parent, coord)
+                for _ in gen_pool.imap_unordered(gen_coord, job_coords):
+                    pass
+            finally:
+                gen_pool.terminate()
+        else:
+            for coord in job_coords:
+                gen_coord(coord)
     rawr_tile_logger.parent_coord_done(parent, parent_timing)
 
     rawr_tile_logger.lifecycle(parent, 'Rawr tile generation finished')
@@ -2129,6 +2324,11 @@ def tilequeue_meta_tile(cfg, args):
 
     check_metatile_exists = bool(batch_yaml.get('check-metatile-exists'))
 
+    # render each pyramid top-down, passing the features found for each
+    # tile down to its children, rather than looking them up in the RAWR
+    # index each time.
+    narrow_candidates = bool(batch_yaml.get('narrow-candidates'))
+
     parent = deserialize_coord(coord_str)
     assert parent, 'Invalid coordinate: %s' % coord_str
 
@@ -2147,7 +2347,8 @@ def tilequeue_meta_tile(cfg, args):
                                      query_cfg,
                                      io_pool,
                                      args.s3_role_arn,
-                                     args.s3_role_session_duration_s)
+                                     args.s3_role_session_duration_s,
+                                     narrow_candidates)
 
     rawr_yaml = cfg.yml.get('rawr')
     assert rawr_yaml is not None, 'Missing rawr configuration in yaml'
@@ -2162,7 +2363,8 @@ def tilequeue_meta_tile(cfg, args):
     # NOTE: max_zoom looks to be inclusive but zoom_stop is exclusive so pay attention the confusing names here
     zoom_stop = cfg.max_zoom
     assert zoom_stop > group_by_zoom
-    formats = lookup_formats(cfg.output_formats)
+    formats = lookup_formats(
+        cfg.output_formats, cfg.mvt_layer_cache_cfg)
 
     meta_tile_logger.begin_run(parent)
 
@@ -2176,7 +2378,11 @@ def tilequeue_meta_tile(cfg, args):
 
         # each coord here is the unit of work now
         pyramid_coords = [job_coord]
-        pyramid_coords.extend(coord_children_range(job_coord, zoom_stop))
+        if narrow_candidates:
+            pyramid_coords.extend(
+                coord_children_preorder(job_coord, zoom_stop))
+        else:
+            pyramid_coords.extend(coord_children_range(job_coord, zoom_stop))
         # for brevity of testing it is sometimes convenient to reduce to a single child coord that covers your test area
         # this makes it so that only that metatile is built rather than the whole tile pyramid which can save 20-50min
         # pyramid_coords = [Coordinate(zoom=13, column=2411, row=3080)] # this example covers liberty island at max zoom
@@ -2239,6 +2445,7 @@ def tilequeue_meta_tile(cfg, args):
 
         meta_tile_logger.end_pyramid(parent, job_coord)
 
+    _close_store(store)
     meta_tile_logger.end_run(parent)
 
 
@@ -2296,7 +2503,8 @@ def tilequeue_meta_tile_low_zoom(cfg, args):
 
     assert queue_zoom < group_by_zoom
 
-    formats = lookup_formats(cfg.output_formats)
+    formats = lookup_formats(
+        cfg.output_formats, cfg.mvt_layer_cache_cfg)
     zip_format = lookup_format_by_extension('zip')
     assert zip_format
 
@@ -2370,9 +2578,23 @@ def tilequeue_meta_tile_low_zoom(cfg, args):
 
         meta_low_zoom_logger.tile_processed(parent, coord, coord_start_ms)
 
+    _close_store(store)
     meta_low_zoom_logger.end_run(parent)
 
 
+def tilequeue_finalize_archive(cfg, args):
+    """
+    Merge the runs of tiles written to an archive store into its archives.
+    """
+    logger = make_logger(cfg, 'finalize_archive')
+    store = _make_store(cfg, logger=logger)
+    assert hasattr(store, 'finalize'), 'Store is not an archive store'
+    for header in store.finalize():
+        logger.info('Finalized %s archive: %d tiles, %d unique, %d bytes' % (
+            header.extension, header.n_tiles, header.n_contents,
+            header.data_offset + header.data_length))
+
+
 def tilequeue_main(argv_args=None):
     if argv_args is None:
         argv_args = sys.argv[1:]
@@ -2431,9 +2653,12 @@ def tilequeue_main(argv_args=None):
         inflight_mgr = make_inflight_manager(inflight_yaml, redis_client)
 
         enqueue_batch_size = 10
+        from tilequeue.locality import make_locality_order
         from tilequeue.queue.writer import QueueWriter
+        order_fn = make_locality_order(cfg.yml.get('enqueue-order'))
         queue_writer = QueueWriter(
-            queue_mapper, msg_marshaller, inflight_mgr, enqueue_batch_size)
+            queue_mapper, msg_marshaller, inflight_mgr, enqueue_batch_size,
+            order_fn)
 
         stats = make_statsd_client_from_cfg(cfg)
 
@@ -2648,6 +2873,11 @@ def tilequeue_main(argv_args=None):
                            help='Enqueue all coordinates below queue zoom')
     subparser.set_defaults(func=tilequeue_batch_enqueue)
 
+    subparser = subparsers.add_parser('finalize-archive')
+    subparser.add_argument('--config', required=True,
+                           help='The path to the tilequeue config file.')
+    subparser.set_defaults(func=tilequeue_finalize_archive)
+
     args = parser.parse_args(argv_args)
     assert os.path.exists(args.config), \
         'Config file {} does not exist!'.format(args.config)
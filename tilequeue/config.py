@@ -106,6 +106,13 @@ class Configuration(object):
         self.template_path = process_cfg['template-path']
         self.reload_templates = process_cfg['reload-templates']
         self.output_formats = process_cfg['formats']
+        self.mvt_layer_cache_cfg = process_cfg.get('mvt-layer-cache')
+        self.fingerprint_cfg = process_cfg.get('fingerprint')
+        self.processor_affinity_cfg = process_cfg.get('processor-affinity')
+        self.autotune_cfg = process_cfg.get('autotune')
+        self.io_pools_cfg = process_cfg.get('io-pools')
+        self.storage_pipeline_cfg = process_cfg.get('storage-pipeline')
+        self.coalesce_cfg = process_cfg.get('coalesce')
         self.buffer_cfg = process_cfg['buffer']
         self.process_yaml_cfg = process_cfg['yaml']
 
@@ -129,6 +136,8 @@ class Configuration(object):
         self.sql_queue_buffer_size = self._cfg('queue_buffer_size sql')
         self.proc_queue_buffer_size = self._cfg('queue_buffer_size proc')
         self.s3_queue_buffer_size = self._cfg('queue_buffer_size s3')
+        self.sql_queue_max_bytes = self._cfg('queue_max_bytes sql')
+        self.proc_queue_max_bytes = self._cfg('queue_max_bytes proc')
 
         self.tile_traffic_log_path = self._cfg(
             'toi-prune tile-traffic-log-path')
@@ -393,6 +402,10 @@ def default_yml_config():
             'proc': None,
             's3': None,
         },
+        'queue_max_bytes': {
+            'sql': None,
+            'proc': None,
+        },
     }
 
 
@@ -0,0 +1,145 @@
+# fingerprints of the input data of a job, used to skip processing jobs
+# whose output would be the same as the tiles already stored.
+import hashlib
+from decimal import Decimal
+
+from tilequeue.tile import coord_marshall_int
+
+
+def _update_hash(h, value):
+    # feed value into the hash, tagged with its type so that e.g. 1 and '1'
+    # differ, and with dict keys in a stable order.
+    if value is None:
+        h.update('N')
+    elif isinstance(value, bool):
+        h.update('T' if value else 'F')
+    elif isinstance(value, (int, long)):
+        h.update('i%d;' % value)
+    elif isinstance(value, float):
+        h.update('f%r;' % value)
+    elif isinstance(value, Decimal):
+        h.update('d%s;' % value)
+    elif isinstance(value, unicode):
+        value = value.encode('utf-8')
+        h.update('u%d:' % len(value))
+        h.update(value)
+    elif isinstance(value, (str, bytearray, buffer, memoryview)):
+        value = str(value)
+        h.update('s%d:' % len(value))
+        h.update(value)
+    elif isinstance(value, dict):
+        h.update('D%d:' % len(value))
+        for k in sorted(value.keys()):
+            _update_hash(h, k)
+            _update_hash(h, value[k])
+    elif isinstance(value, (list, tuple)):
+        h.update('L%d:' % len(value))
+        for item in value:
+            _update_hash(h, item)
+    else:
+        raise TypeError('Cannot fingerprint %r' % (value,))
+
+
+def fingerprint_source_rows(source_rows, config_version, nominal_zoom,
+                            format_extensions=()):
+    """
+    Return a fingerprint of the rows fetched for a job, or None if they
+    contain a value which can't be fingerprinted.
+
+    The order the rows come back from the database in doesn't change the
+    fingerprint. The config version should change whenever the queries,
+    processing or formatting do, as the output can change even when the
+    data hasn't.
+    """
+    try:
+        row_digests = []
+        for row in source_rows:
+            h = hashlib.sha1()
+            _update_hash(h, row)
+            row_digests.append(h.digest())
+    except TypeError:
+        return None
+
+    h = hashlib.sha1()
+    _update_hash(h, str(config_version))
+    _update_hash(h, nominal_zoom)
+    _update_hash(h, sorted(format_extensions))
+    for row_digest in sorted(row_digests):
+        h.update(row_digest)
+    return h.hexdigest()
+
+
+class RedisFingerprintIndex(object):
+
+    """
+    Fingerprints of the input data of the tiles in the store
+
+    Kept in a redis hash from the marshalled coordinate to the fingerprint,
+    so that it's shared by all the workers. A fingerprint should only be
+    recorded once the tiles made from that input have been stored.
+    """
+
+    def __init__(self, redis_client, fingerprint_key):
+        self.redis_client = redis_client
+        self.fingerprint_key = fingerprint_key
+
+    def get(self, coord):
+        coord_int = coord_marshall_int(coord)
+        return self.redis_client.hget(self.fingerprint_key, coord_int)
+
+    def put(self, coord, fingerprint):
+        coord_int = coord_marshall_int(coord)
+        self.redis_client.hset(self.fingerprint_key, coord_int, fingerprint)
+
+    def delete(self, coord):
+        coord_int = coord_marshall_int(coord)
+        self.redis_client.hdel(self.fingerprint_key, coord_int)
+
+    def delete_many(self, coords):
+        coord_ints = [coord_marshall_int(coord) for coord in coords]
+        if coord_ints:
+            self.redis_client.hdel(self.fingerprint_key, *coord_ints)
+
+
+class Fingerprinter(object):
+
+    """
+    Compare the fingerprint of a job's input with the one last stored
+    """
+
+    def __init__(self, index, config_version, format_extensions=()):
+        self.index = index
+        self.config_version = config_version
+        self.format_extensions = format_extensions
+
+    def __call__(self, source_rows, nominal_zoom):
+        return fingerprint_source_rows(
+            source_rows, self.config_version, nominal_zoom,
+            self.format_extensions)
+
+    def unchanged(self, coord, fingerprint):
+        """True if the tiles for coord were stored from the same input"""
+        if fingerprint is None:
+            return False
+        return self.index.get(coord) == fingerprint
+
+    def record(self, coord, fingerprint):
+        if fingerprint is not None:
+            self.index.put(coord, fingerprint)
+
+    def forget(self, coords):
+        """
+        Forget the fingerprints of coords whose tiles are being deleted, so
+        that they're stored again the next time they're processed.
+        """
+        self.index.delete_many(coords)
+
+
+def make_fingerprinter(yml, redis_client, formats):
+    config_version = yml.get('config-version')
+    assert config_version is not None, 'Missing fingerprint config-version'
+    assert redis_client, 'redis client required for fingerprints'
+    fingerprint_key = yml.get('key', 'tilequeue.fingerprints')
+    index = RedisFingerprintIndex(redis_client, fingerprint_key)
+    format_extensions = [fmt.extension for fmt in formats]
+    return Fingerprinter(index, config_version, format_extensions)
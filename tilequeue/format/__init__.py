@@ -1,3 +1,7 @@
+import hashlib
+import json
+from cStringIO import StringIO
+
 from tilequeue.format.geojson import encode_multiple_layers as json_encode_multiple_layers
 from tilequeue.format.geojson import encode_single_layer as json_encode_single_layer
 from tilequeue.format.mvt import encode as mvt_encode
@@ -91,6 +95,103 @@ def format_mvt(fp, feature_layers, zoom, bounds_merc, bounds_lnglat, extents):
     mvt_encode(fp, mvt_layers, bounds_merc, extents)
 
 
+class MvtLayerCache(object):
+
+    """
+    Cache of encoded MVT layers
+
+    Layers are keyed by a fingerprint of the features in them, along with
+    the bounds and extents they're encoded with, so a layer which comes out
+    the same as it did before doesn't need encoding again. Encoded layers are
+    kept in memory and, optionally, in a DiskCache behind that.
+    """
+
+    def __init__(self, memory_cache, disk_cache=None):
+        self.memory_cache = memory_cache
+        self.disk_cache = disk_cache
+
+    def fingerprint(self, mvt_layer, bounds_merc, extents):
+        """return the key for the layer, or None if it can't have one"""
+        digest = hashlib.sha1()
+        digest.update('%s\n%r\n%r\n' % (
+            mvt_layer['name'], tuple(bounds_merc), extents))
+        try:
+            for feature in mvt_layer['features']:
+                digest.update(feature['geometry'].wkb)
+                digest.update(json.dumps(
+                    [feature['properties'], feature['id']], sort_keys=True))
+        except (TypeError, ValueError):
+            # properties which aren't serializable
+            return None
+        return digest.hexdigest()
+
+    def get(self, key):
+        layer_data = self.memory_cache.get(key)
+        if layer_data is None and self.disk_cache is not None:
+            cached = self.disk_cache.get(key)
+            if cached is not None:
+                layer_data = cached[1]
+                self.memory_cache.put(key, layer_data)
+        return layer_data
+
+    def put(self, key, layer_data):
+        self.memory_cache.put(key, layer_data)
+        if self.disk_cache is not None:
+            self.disk_cache.put(key, 'mvt', layer_data)
+
+
+def make_format_mvt_cached(layer_cache):
+    """
+    Return a format function for MVT which encodes each layer on its own and
+    looks it up in layer_cache first.
+    """
+
+    def format_mvt_cached(fp, feature_layers, zoom, bounds_merc,
+                          bounds_lnglat, extents):
+        # a tile's layers are a repeated field of the tile message, so
+        # layers encoded on their own can be concatenated into the tile.
+        for mvt_layer in _make_mvt_layers(feature_layers):
+            key = layer_cache.fingerprint(mvt_layer, bounds_merc, extents)
+            layer_data = None
+            if key is not None:
+                layer_data = layer_cache.get(key)
+            if layer_data is None:
+                layer_fp = StringIO()
+                mvt_encode(layer_fp, [mvt_layer], bounds_merc, extents)
+                layer_data = layer_fp.getvalue()
+                if key is not None:
+                    layer_cache.put(key, layer_data)
+            fp.write(layer_data)
+
+    return format_mvt_cached
+
+
+def with_mvt_layer_cache(format, layer_cache):
+    """
+    Return a copy of the format which caches encoded layers, if it's an MVT
+    format encoded by mapbox-vector-tile, otherwise the format itself.
+    """
+    if format.format_fn is not format_mvt:
+        return format
+    return OutputFormat(
+        format.name, format.extension, format.mimetype,
+        make_format_mvt_cached(layer_cache), format.sort_key,
+        format.supports_shapely_geometry)
+
+
+def make_mvt_layer_cache(yml):
+    from tilequeue.cache import make_disk_cache
+    from tilequeue.cache import MemoryCache
+
+    memory_max_bytes = yml.get('memory-max-bytes', 256 * 1024 * 1024)
+    memory_cache = MemoryCache(memory_max_bytes)
+    disk_cache = None
+    disk_yml = yml.get('disk')
+    if disk_yml:
+        disk_cache = make_disk_cache(disk_yml)
+    return MvtLayerCache(memory_cache, disk_cache)
+
+
 def format_vtm(fp, feature_layers, zoom, bounds_merc, bounds_lnglat):
     vtm_encode(fp, feature_layers)
 
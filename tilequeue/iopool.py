@@ -0,0 +1,120 @@
+# thread pools for the blocking I/O of tilequeue process, kept separate per
+# purpose so that slow uploads can't hold up database queries, or the other
+# way around.
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+
+class IoPoolStats(object):
+
+    """
+    What an IoPool did over an interval
+
+    wait_seconds is the mean time tasks spent queued before a thread picked
+    them up, and utilization is the fraction of the thread time spent running
+    tasks.
+    """
+
+    def __init__(self, n_tasks, wait_seconds, max_wait_seconds, utilization,
+                 n_pending):
+        self.n_tasks = n_tasks
+        self.wait_seconds = wait_seconds
+        self.max_wait_seconds = max_wait_seconds
+        self.utilization = utilization
+        self.n_pending = n_pending
+
+
+class IoPool(object):
+
+    """
+    A ThreadPool with a bounded number of pending tasks, which measures how
+    long tasks wait and how busy its threads are
+
+    Submitting a task blocks while max_pending tasks are already queued or
+    running, so that producers are held back rather than the backlog growing
+    without bound. Like ThreadPool, a task must not wait on other tasks in
+    the same pool.
+    """
+
+    def __init__(self, name, n_workers, max_pending=None):
+        assert n_workers > 0, 'Invalid %s pool size: %d' % (name, n_workers)
+        if max_pending is None:
+            max_pending = n_workers * 2
+        assert max_pending >= n_workers, \
+            'Invalid %s pool max-pending: %d' % (name, max_pending)
+        self.name = name
+        self.n_workers = n_workers
+        self.max_pending = max_pending
+        self.pool = ThreadPool(n_workers)
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.n_pending = 0
+        self._reset(time.time())
+
+    def _reset(self, now):
+        self.sample_start = now
+        self.n_tasks = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.busy_seconds = 0.0
+
+    def _run(self, submit_time, func, args, kwds):
+        start_time = time.time()
+        try:
+            return func(*args, **kwds)
+        finally:
+            end_time = time.time()
+            wait_seconds = start_time - submit_time
+            with self.lock:
+                self.n_pending -= 1
+                self.n_tasks += 1
+                self.total_wait_seconds += wait_seconds
+                self.max_wait_seconds = max(
+                    self.max_wait_seconds, wait_seconds)
+                self.busy_seconds += end_time - start_time
+            self.pending.release()
+
+    def apply_async(self, func, args=(), kwds={}, callback=None):
+        self.pending.acquire()
+        with self.lock:
+            self.n_pending += 1
+        try:
+            return self.pool.apply_async(
+                self._run, (time.time(), func, args, kwds), callback=callback)
+        except Exception:
+            with self.lock:
+                self.n_pending -= 1
+            self.pending.release()
+            raise
+
+    def sample(self):
+        """return the IoPoolStats since the last sample, and start again"""
+        now = time.time()
+        with self.lock:
+            elapsed = now - self.sample_start
+            wait_seconds = 0.0
+            if self.n_tasks:
+                wait_seconds = self.total_wait_seconds / self.n_tasks
+            utilization = 0.0
+            if elapsed > 0:
+                utilization = min(
+                    1.0, self.busy_seconds / (elapsed * self.n_workers))
+            stats = IoPoolStats(
+                self.n_tasks, wait_seconds, self.max_wait_seconds,
+                utilization, self.n_pending)
+            self._reset(now)
+        return stats
+
+    def close(self):
+        self.pool.close()
+
+    def join(self):
+        self.pool.join()
+
+
+def make_io_pool(name, yml, default_n_workers):
+    yml = yml or {}
+    n_workers = yml.get('workers', default_n_workers)
+    max_pending = yml.get('max-pending')
+    return IoPool(name, n_workers, max_pending)
@@ -0,0 +1,132 @@
+# ordering of coordinates along a space-filling curve, so that work which is
+# sent out in that order touches data near the data of the work before it.
+import cPickle
+import heapq
+import tempfile
+
+from tilequeue.tile import hilbert_index
+
+
+# zoom at which coordinates of all zooms are compared. a tile sorts just
+# before all of its descendants, which sort together.
+_KEY_ZOOM = 32
+
+
+def _morton_index(zoom, column, row):
+    d = 0
+    for bit in range(zoom):
+        d |= ((column >> bit) & 1) << (2 * bit + 1)
+        d |= ((row >> bit) & 1) << (2 * bit)
+    return d
+
+
+_curves = dict(
+    hilbert=hilbert_index,
+    zorder=_morton_index,
+)
+
+
+def locality_key_fn(curve):
+    """
+    Return a function giving a sort key for a coordinate along the named
+    curve, either 'hilbert' or 'zorder'.
+    """
+    index_fn = _curves.get(curve)
+    assert index_fn, 'Unknown locality curve: %r' % (curve,)
+
+    def locality_key(coord):
+        zoom = int(coord.zoom)
+        d = index_fn(zoom, int(coord.column), int(coord.row))
+        return (d << (2 * (_KEY_ZOOM - zoom)), zoom)
+
+    return locality_key
+
+
+def _spill(items):
+    spill_file = tempfile.TemporaryFile()
+    pickler = cPickle.Pickler(spill_file, cPickle.HIGHEST_PROTOCOL)
+    for item in items:
+        pickler.dump(item)
+    spill_file.seek(0)
+    return spill_file
+
+
+def _unspill(spill_file):
+    unpickler = cPickle.Unpickler(spill_file)
+    try:
+        while True:
+            yield unpickler.load()
+    except EOFError:
+        pass
+    finally:
+        spill_file.close()
+
+
+def sorted_by_key(items, key_fn, max_in_memory=1000000):
+    """
+    Yield items in the order of key_fn, streaming through an external sort
+    so that no more than max_in_memory items are held at once. Items which
+    need sorting on disk must be picklable.
+    """
+    runs = []
+    chunk = []
+    for item in items:
+        chunk.append((key_fn(item), item))
+        if len(chunk) >= max_in_memory:
+            chunk.sort(key=lambda keyed: keyed[0])
+            runs.append(_spill(chunk))
+            chunk = []
+    chunk.sort(key=lambda keyed: keyed[0])
+
+    if not runs:
+        for _, item in chunk:
+            yield item
+        return
+
+    # the keys are only compared, never the items, as the index of the run
+    # breaks ties.
+    def _tagged(run_index, keyed_items):
+        for key, item in keyed_items:
+            yield key, run_index, item
+
+    merged_runs = [_tagged(i, _unspill(run)) for i, run in enumerate(runs)]
+    merged_runs.append(_tagged(len(runs), iter(chunk)))
+    for _, _, item in heapq.merge(*merged_runs):
+        yield item
+
+
+def sorted_by_locality(coords, curve='hilbert', max_in_memory=1000000):
+    """yield coords in order along the curve"""
+    return sorted_by_key(coords, locality_key_fn(curve), max_in_memory)
+
+
+def coord_groups_by_locality(coord_groups, curve='hilbert',
+                             max_in_memory=1000000):
+    """
+    yield CoordGroups in order along the curve, of the first of their coords
+    along it
+    """
+    locality_key = locality_key_fn(curve)
+
+    def group_key(coord_group):
+        return min(locality_key(coord) for coord in coord_group.coords)
+
+    return sorted_by_key(coord_groups, group_key, max_in_memory)
+
+
+def make_locality_order(yml):
+    """
+    Return a function ordering CoordGroups for the `enqueue-order` config,
+    or None if they should be left in the order they come.
+    """
+    if not yml:
+        return None
+    curve = yml.get('curve', 'hilbert')
+    max_in_memory = yml.get('max-in-memory', 1000000)
+    # check the curve up front
+    locality_key_fn(curve)
+
+    def order(coord_groups):
+        return coord_groups_by_locality(coord_groups, curve, max_in_memory)
+
+    return order
@@ -151,6 +151,10 @@ class JsonTileProcessingLogger(object):
         sizes = {}
         for queue, queue_name in queue_info:
             size = dict(size=queue.qsize())
+            budget = getattr(queue, 'budget', None)
+            if budget is not None:
+                size['bytes'] = budget.used()
+                size['utilization'] = budget.utilization()
             if queue.empty():
                 size['empty'] = True
             if queue.full():
@@ -164,6 +168,24 @@ class JsonTileProcessingLogger(object):
         json_str = json.dumps(json_obj)
         self.logger.info(json_str)
 
+    def log_io_pools(self, pool_stats):
+        pools = {}
+        for name, stats in pool_stats:
+            pools[name] = dict(
+                tasks=stats.n_tasks,
+                pending=stats.n_pending,
+                wait_ms=int(stats.wait_seconds * 1000),
+                max_wait_ms=int(stats.max_wait_seconds * 1000),
+                utilization=stats.utilization,
+            )
+        json_obj = dict(
+            category=log_category_name(LogCategory.QUEUE_SIZES),
+            type=log_level_name(LogLevel.INFO),
+            io_pools=pools,
+        )
+        json_str = json.dumps(json_obj)
+        self.logger.info(json_str)
+
     def _log_job_error(self, msg, exception, stacktrace, coord, parent_tile,
                        err_details):
         json_obj = dict(
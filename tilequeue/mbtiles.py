@@ -0,0 +1,220 @@
+# local tile store in MBTiles-style SQLite databases, which writes tiles in
+# batched transactions rather than making a file for each one.
+import os
+import Queue
+import sqlite3
+import sys
+import threading
+
+from ModestMaps.Core import Coordinate
+
+
+def _tms_row(coord):
+    # MBTiles rows count up from the south, as in TMS.
+    return (1 << coord.zoom) - 1 - coord.row
+
+
+class _Op(object):
+
+    """
+    A write or delete waiting for the writer thread to commit it
+    """
+
+    def __init__(self, extension, sql, params):
+        self.extension = extension
+        self.sql = sql
+        self.params = params
+        self.rowcount = 0
+        self.exc_info = None
+        self.done = threading.Event()
+
+    def wait(self):
+        self.done.wait()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.rowcount
+
+
+class MBTilesStore(object):
+
+    """
+    Stores tiles in an MBTiles database per format, in a local directory
+
+    All the changes are made by a single writer thread, which group commits
+    them: it takes every change already waiting, up to batch_size, and
+    commits them in one transaction straight away. While that's committing,
+    more writers queue up for the next batch, so batches grow with the
+    number of writers without anyone waiting for a batch to fill. A write
+    returns once the batch it's in has been committed, so that a tile which
+    has been acknowledged is safely stored. Reads use their own connection
+    per thread, which WAL mode allows alongside the writer.
+    """
+
+    def __init__(self, base_path, batch_size=1000):
+        if os.path.exists(base_path):
+            if not os.path.isdir(base_path):
+                raise IOError(
+                    '`{}` exists and is not a directory!'.format(base_path))
+        else:
+            os.makedirs(base_path)
+
+        self.base_path = base_path
+        self.batch_size = batch_size
+        self.ops = Queue.Queue()
+        self.lock = threading.Lock()
+        self.writer = None
+        self.local = threading.local()
+
+    def _db_path(self, extension):
+        return os.path.join(self.base_path, '%s.mbtiles' % extension)
+
+    def _connect(self, extension):
+        return sqlite3.connect(
+            self._db_path(extension), isolation_level=None,
+            check_same_thread=False)
+
+    def _create(self, extension):
+        conn = self._connect(extension)
+        conn.execute('PRAGMA journal_mode=WAL')
+        # in WAL mode, NORMAL only syncs at checkpoints, so a commit could
+        # be lost to a power failure. FULL syncs the WAL on every commit,
+        # which group commit spreads over the whole batch.
+        conn.execute('PRAGMA synchronous=FULL')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS metadata '
+            '(name TEXT, value TEXT, UNIQUE (name))')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS tiles '
+            '(zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, '
+            'tile_data BLOB, UNIQUE (zoom_level, tile_column, tile_row))')
+        conn.execute(
+            'INSERT OR IGNORE INTO metadata (name, value) '
+            'VALUES (\'format\', ?)', (extension,))
+        return conn
+
+    def _read_conn(self, extension):
+        conns = getattr(self.local, 'conns', None)
+        if conns is None:
+            conns = self.local.conns = {}
+        conn = conns.get(extension)
+        if conn is None:
+            # the writer creates the database, along with its tables.
+            if not os.path.exists(self._db_path(extension)):
+                return None
+            conn = conns[extension] = self._connect(extension)
+        return conn
+
+    def _submit(self, op):
+        # the writer thread is started when first needed, as the store is
+        # made before the worker processes are forked.
+        with self.lock:
+            if self.writer is None:
+                self.writer = threading.Thread(target=self._write_batches)
+                self.writer.daemon = True
+                self.writer.start()
+        self.ops.put(op)
+        return op
+
+    def _write_batches(self):
+        conns = {}
+        while True:
+            op = self.ops.get()
+            if op is None:
+                break
+            batch = [op]
+            # the callers are all waiting on their writes, so nothing more
+            # arrives by waiting. only what's already queued is taken.
+            while len(batch) < self.batch_size:
+                try:
+                    op = self.ops.get_nowait()
+                except Queue.Empty:
+                    break
+                if op is None:
+                    self.ops.put(None)
+                    break
+                batch.append(op)
+            self._commit(conns, batch)
+
+        for conn in conns.values():
+            conn.close()
+
+    def _commit(self, conns, batch):
+        by_extension = {}
+        for op in batch:
+            by_extension.setdefault(op.extension, []).append(op)
+
+        for extension, ops in by_extension.items():
+            try:
+                conn = conns.get(extension)
+                if conn is None:
+                    conn = conns[extension] = self._create(extension)
+                conn.execute('BEGIN')
+                try:
+                    for op in ops:
+                        cursor = conn.execute(op.sql, op.params)
+                        op.rowcount = cursor.rowcount
+                    conn.execute('COMMIT')
+                except Exception:
+                    conn.execute('ROLLBACK')
+                    raise
+            except Exception:
+                exc_info = sys.exc_info()
+                for op in ops:
+                    op.exc_info = exc_info
+            for op in ops:
+                op.done.set()
+
+    def write_tile(self, tile_data, coord, format):
+        op = self._submit(_Op(
+            format.extension,
+            'INSERT OR REPLACE INTO tiles '
+            '(zoom_level, tile_column, tile_row, tile_data) '
+            'VALUES (?, ?, ?, ?)',
+            (coord.zoom, coord.column, _tms_row(coord), buffer(tile_data))))
+        op.wait()
+
+    def read_tile(self, coord, format):
+        conn = self._read_conn(format.extension)
+        if conn is None:
+            return None
+        row = conn.execute(
+            'SELECT tile_data FROM tiles '
+            'WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+            (coord.zoom, coord.column, _tms_row(coord))).fetchone()
+        if row is None:
+            return None
+        return str(row[0])
+
+    def delete_tiles(self, coords, format):
+        # submit all the deletes before waiting, so they share batches.
+        ops = [self._submit(_Op(
+            format.extension,
+            'DELETE FROM tiles '
+            'WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+            (coord.zoom, coord.column, _tms_row(coord))))
+            for coord in coords]
+        return sum(op.wait() for op in ops)
+
+    def list_tiles(self, format):
+        conn = self._read_conn(format.extension)
+        if conn is None:
+            return
+        for zoom, column, tms_row in conn.execute(
+                'SELECT zoom_level, tile_column, tile_row FROM tiles'):
+            row = (1 << zoom) - 1 - tms_row
+            yield Coordinate(zoom=zoom, column=column, row=row)
+
+    def close(self):
+        """commit any outstanding changes and stop the writer thread"""
+        with self.lock:
+            writer = self.writer
+            self.writer = None
+        if writer is not None:
+            self.ops.put(None)
+            writer.join()
+
+
+def make_mbtiles_store(yml):
+    path = yml.get('path') or yml.get('name')
+    assert path, 'Missing mbtiles store path'
+    return MBTilesStore(path, yml.get('batch-size', 1000))
@@ -1,8 +1,15 @@
 import cStringIO as StringIO
+import struct
+import threading
 import zipfile
+import zlib
 from collections import defaultdict
+from collections import namedtuple
+from collections import OrderedDict
 from time import gmtime
 
+from ModestMaps.Core import Coordinate
+
 from tilequeue.format import zip_format
 
 
@@ -136,6 +143,259 @@ def extract_metatile(io, fmt, offset=None):
             return None
 
 
+# the fixed size parts of the zip records needed to find and read members
+_END_OF_CENTRAL_DIR = struct.Struct('<4s4H2LH')
+_CENTRAL_DIR_ENTRY = struct.Struct('<4s6H3L5H2L')
+_LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+
+
+MetatileMember = namedtuple(
+    'MetatileMember',
+    ('header_offset', 'compressed_size', 'size', 'method', 'name_length',
+     'extra_length'))
+
+
+def find_central_directory(tail):
+    """
+    Given bytes from the end of a zip, return the offset and size of its
+    central directory.
+    """
+    # the end record is the last thing in the file, followed only by a
+    # comment, which metatiles don't have.
+    pos = tail.rfind('PK\x05\x06')
+    if pos < 0 or len(tail) - pos < _END_OF_CENTRAL_DIR.size:
+        raise zipfile.BadZipfile('End of central directory not found')
+    fields = _END_OF_CENTRAL_DIR.unpack_from(tail, pos)
+    cd_size, cd_offset = fields[5], fields[6]
+    if cd_offset == 0xffffffff:
+        raise zipfile.LargeZipFile('Zip64 metatiles are not supported')
+    return cd_offset, cd_size
+
+
+def parse_central_directory(data):
+    """return a dict of member name to MetatileMember"""
+    members = {}
+    pos = 0
+    while pos + _CENTRAL_DIR_ENTRY.size <= len(data):
+        fields = _CENTRAL_DIR_ENTRY.unpack_from(data, pos)
+        if fields[0] != 'PK\x01\x02':
+            raise zipfile.BadZipfile('Bad central directory entry')
+        method = fields[4]
+        compressed_size, size = fields[8], fields[9]
+        name_length, extra_length, comment_length = fields[10:13]
+        header_offset = fields[16]
+        name_start = pos + _CENTRAL_DIR_ENTRY.size
+        name = data[name_start:name_start + name_length]
+        members[name] = MetatileMember(
+            header_offset, compressed_size, size, method, name_length,
+            extra_length)
+        pos = name_start + name_length + extra_length + comment_length
+    return members
+
+
+def _member_data(member, data):
+    # data starts at the member's local header
+    fields = _LOCAL_HEADER.unpack_from(data, 0)
+    if fields[0] != 'PK\x03\x04':
+        raise zipfile.BadZipfile('Bad local header')
+    start = _LOCAL_HEADER.size + fields[9] + fields[10]
+    raw = data[start:start + member.compressed_size]
+    if len(raw) < member.compressed_size:
+        return None
+    if member.method == zipfile.ZIP_DEFLATED:
+        return zlib.decompress(raw, -15)
+    elif member.method == zipfile.ZIP_STORED:
+        return raw
+    raise zipfile.BadZipfile(
+        'Unsupported compression method: %d' % member.method)
+
+
+def metatile_offset(coord, metatile_zoom):
+    """
+    Return the metatile containing coord, and the offset of coord within
+    it, for metatiles of metatile_zoom. Tiles at lower zooms than that are
+    in the 0/0/0 metatile.
+    """
+    delta_z = min(coord.zoom, metatile_zoom)
+    meta_coord = coord.zoomBy(-delta_z).container()
+    offset = Coordinate(
+        zoom=delta_z,
+        column=int(coord.column) - (int(meta_coord.column) << delta_z),
+        row=int(coord.row) - (int(meta_coord.row) << delta_z))
+    return meta_coord, offset
+
+
+class MetatileReader(object):
+
+    """
+    Reads single tiles from metatiles in a store, without reading or parsing
+    the whole metatile each time
+
+    The central directory of each metatile is read from its end with a range
+    read and kept, keyed by the metatile, along with its ETag. Tiles are then
+    read with a range read of just their member, which fails if the metatile
+    no longer has that ETag, in which case its directory is read again.
+    Tiles which aren't in a metatile's kept directory are only taken to be
+    missing once the metatile is found to still have the same ETag.
+
+    The store must support `read_tile_range`.
+    """
+
+    def __init__(self, store, metatile_zoom, max_metatiles=1024,
+                 tail_bytes=65536):
+        self.store = store
+        self.metatile_zoom = metatile_zoom
+        self.max_metatiles = max_metatiles
+        self.tail_bytes = tail_bytes
+        self.lock = threading.Lock()
+        # (zoom, column, row) -> (etag, members), least recently used first
+        self.indexes = OrderedDict()
+
+    def _key(self, meta_coord):
+        return (int(meta_coord.zoom), int(meta_coord.column),
+                int(meta_coord.row))
+
+    def _cached_index(self, key):
+        with self.lock:
+            index = self.indexes.pop(key, None)
+            if index is not None:
+                self.indexes[key] = index
+            return index
+
+    def _forget_index(self, key):
+        with self.lock:
+            self.indexes.pop(key, None)
+
+    def _read_index(self, meta_coord, unless_etag=None):
+        """
+        Read the central directory of the metatile, returning a tuple of its
+        ETag, its members and the bytes read from its end, which include the
+        directory and often some of the members too, along with their offset.
+
+        If unless_etag is given, this fails with TileNotModifiedError if the
+        metatile still has that ETag.
+        """
+        from tilequeue.store import TileChangedError
+
+        key = self._key(meta_coord)
+        for attempt in range(2):
+            result = self.store.read_tile_range(
+                meta_coord, zip_format, -self.tail_bytes,
+                unless_etag=unless_etag)
+            if result is None:
+                self._forget_index(key)
+                return None
+            tail, etag, size = result
+            tail_offset = size - len(tail)
+
+            cd_offset, cd_size = find_central_directory(tail)
+            if cd_offset >= tail_offset:
+                start = cd_offset - tail_offset
+                cd_data = tail[start:start + cd_size]
+                break
+            try:
+                result = self.store.read_tile_range(
+                    meta_coord, zip_format, cd_offset, cd_size, etag)
+            except TileChangedError:
+                if attempt > 0:
+                    raise
+                # the metatile was written again between the two reads
+                continue
+            if result is None:
+                self._forget_index(key)
+                return None
+            cd_data = result[0]
+            break
+        index = (etag, parse_central_directory(cd_data))
+
+        with self.lock:
+            self.indexes.pop(key, None)
+            self.indexes[key] = index
+            while len(self.indexes) > self.max_metatiles:
+                self.indexes.popitem(last=False)
+        return index, tail, tail_offset
+
+    def _read_member(self, meta_coord, etag, member):
+        # the local header's extra field is usually the same length as the
+        # central directory's, but if it's longer, read the rest again.
+        length = _LOCAL_HEADER.size + member.name_length + \
+            member.extra_length + member.compressed_size
+        while True:
+            result = self.store.read_tile_range(
+                meta_coord, zip_format, member.header_offset, length, etag)
+            if result is None:
+                # the metatile was deleted since it was indexed
+                self._forget_index(self._key(meta_coord))
+                return None
+            data = result[0]
+            tile_data = _member_data(member, data)
+            if tile_data is not None or len(data) < length:
+                return tile_data
+            fields = _LOCAL_HEADER.unpack_from(data, 0)
+            length = _LOCAL_HEADER.size + fields[9] + fields[10] + \
+                member.compressed_size
+
+    def read_tile(self, coord, fmt):
+        """
+        Return the tile at coord in format fmt from its metatile, or None if
+        there is no such tile.
+        """
+        meta_coord, offset = metatile_offset(coord, self.metatile_zoom)
+        return self.read_metatile_member(meta_coord, offset, fmt)
+
+    def read_metatile_member(self, meta_coord, offset, fmt):
+        """
+        Return the tile at offset in format fmt from the metatile at
+        meta_coord, or None if there is no such tile. This can read the
+        larger tiles at the lower offset zooms of a metatile, as well as the
+        ones `read_tile` does.
+        """
+        from tilequeue.store import TileChangedError
+        from tilequeue.store import TileNotModifiedError
+
+        name = '%d/%d/%d.%s' % (
+            offset.zoom, offset.column, offset.row, fmt.extension)
+        key = self._key(meta_coord)
+
+        index = self._cached_index(key)
+        for attempt in range(2):
+            member = None
+            if index is not None:
+                etag, members = index
+                member = members.get(name)
+
+            if member is None:
+                # either the directory isn't kept, or the tile wasn't in it,
+                # which might be because the metatile was written again
+                # since, so read the directory unless it's still the same.
+                unless_etag = index[0] if index is not None else None
+                try:
+                    result = self._read_index(meta_coord, unless_etag)
+                except TileNotModifiedError:
+                    return None
+                if result is None:
+                    return None
+                index, tail, tail_offset = result
+                etag, members = index
+                member = members.get(name)
+                if member is None:
+                    return None
+                # having just read the end of the metatile, the member may
+                # be in it already.
+                if member.header_offset >= tail_offset:
+                    return _member_data(
+                        member, tail[member.header_offset - tail_offset:])
+
+            try:
+                return self._read_member(meta_coord, etag, member)
+            except TileChangedError:
+                if attempt > 0:
+                    raise
+                # the metatile was written again since it was indexed
+                index = None
+        return None
+
+
 def _metatile_contents_equal(zip_1, zip_2):
     """
     Given two open zip files as arguments, this returns True if the zips
@@ -12,7 +12,6 @@ from shapely import geometry
 from shapely.geometry import GeometryCollection
 from shapely.geometry import MultiPolygon
 from shapely.geometry import shape
-from shapely.wkb import loads
 from zope.dottedname.resolve import resolve
 
 from tilequeue import utils
@@ -25,6 +24,7 @@ from tilequeue.tile import normalize_geometry_type
 from tilequeue.transform import calc_max_padded_bounds
 from tilequeue.transform import mercator_point_to_lnglat
 from tilequeue.transform import transform_feature_layers_shape
+from tilequeue.twkb import load_geometry
 
 
 def make_transform_fn(transform_fns):
@@ -316,7 +316,7 @@ def process_coord_no_format(
         features_size = 0
         for row in feature_layer['features']:
             wkb = row['__geometry__']
-            shape = loads(wkb)
+            shape = load_geometry(wkb)
 
             if shape.is_empty:
                 continue
@@ -887,8 +887,21 @@ class Processor(object):
             self.coord, self.metatile_zoom, self.cfg_tile_sizes, self.max_zoom)
         feature_layers_by_zoom = {}
 
+        # fetchers which can fetch several zooms together are asked for all
+        # of them at once.
+        fetch_zooms = getattr(self.fetch_fn, 'fetch_zooms', None)
+        if fetch_zooms is not None:
+            source_rows_by_zoom = fetch_zooms(
+                list(cut_coords_by_zoom), self.max_padded_bounds)
+        else:
+            source_rows_by_zoom = None
+
         for nominal_zoom, _ in cut_coords_by_zoom.items():
-            source_rows = self.fetch_fn(nominal_zoom, self.max_padded_bounds)
+            if source_rows_by_zoom is not None:
+                source_rows = source_rows_by_zoom[nominal_zoom]
+            else:
+                source_rows = self.fetch_fn(
+                    nominal_zoom, self.max_padded_bounds)
             feature_layers = convert_source_data_to_feature_layers(
                 source_rows, self.layer_data, self.unpadded_bounds, self.coord.zoom)
             feature_layers_by_zoom[nominal_zoom] = feature_layers
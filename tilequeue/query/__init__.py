@@ -18,18 +18,27 @@ __all__ = [
 
 def make_data_fetcher(cfg, layer_data, query_cfg, io_pool,
                       s3_role_arn=None,
-                      s3_role_session_duration_s=None):
+                      s3_role_session_duration_s=None,
+                      narrow_candidates=False,
+                      index_in_processors=False):
     """ Make data fetcher from RAWR store and PostgreSQL database.
         When s3_role_arn and s3_role_session_duration_s are available
         the RAWR store will use the s3_role_arn to access the RAWR S3 bucket
+        When narrow_candidates is set, RAWR tile pyramids are expected to be
+        fetched top-down, and each tile looks up its features from those of
+        its parent.
+        When index_in_processors is set, RAWR tiles are handed out unindexed
+        with the jobs which need them, to be fetched from in the processor
+        processes.
     """
     db_fetcher = make_db_data_fetcher(
         cfg.postgresql_conn_info, cfg.template_path, cfg.reload_templates,
-        query_cfg, io_pool)
+        query_cfg, io_pool, cfg.yml.get('postgresql-fetch'))
 
     if cfg.yml.get('use-rawr-tiles'):
         rawr_fetcher = _make_rawr_fetcher(
-            cfg, layer_data, s3_role_arn, s3_role_session_duration_s)
+            cfg, layer_data, s3_role_arn, s3_role_session_duration_s,
+            narrow_candidates, index_in_processors)
 
         group_by_zoom = cfg.yml.get('rawr').get('group-zoom')
         assert group_by_zoom is not None, 'Missing group-zoom rawr config'
@@ -63,7 +72,9 @@ class _NullRawrStorage(object):
 
 def _make_rawr_fetcher(cfg, layer_data,
                        s3_role_arn=None,
-                       s3_role_session_duration_s=None):
+                       s3_role_session_duration_s=None,
+                       narrow_candidates=False,
+                       index_in_processors=False):
     """
         When s3_role_arn and s3_role_session_duration_s are available
         the RAWR store will use the s3_role_arn to access the RAWR S3
@@ -138,6 +149,13 @@ def _make_rawr_fetcher(cfg, layer_data,
             s3_client, bucket, prefix, extension, table_sources, tile_key_gen,
             allow_missing_tiles)
 
+        # optionally keep a copy of RAWR tiles on local disk.
+        cache_yml = rawr_source_s3_yaml.get('cache')
+        if cache_yml:
+            from tilequeue.cache import make_disk_cache
+            from tilequeue.rawr import RawrCachedSource
+            storage = RawrCachedSource(storage, make_disk_cache(cache_yml))
+
     elif source_type == 'generate':
         from raw_tiles.source.conn import ConnectionContextManager
         from raw_tiles.source.osm import OsmSource
@@ -161,6 +179,34 @@ def _make_rawr_fetcher(cfg, layer_data,
         assert False, 'Source type %r not understood. ' \
             'Options are s3, generate and store.' % (source_type,)
 
+    # optionally read RAWR tiles in the background, as soon as the jobs which
+    # need them have been read from the queue.
+    prefetch_yaml = rawr_source_yaml.get('prefetch')
+    if prefetch_yaml:
+        assert source_type in ('s3', 'store'), \
+            'RAWR prefetch is only supported for s3 and store sources'
+        max_bytes = prefetch_yaml.get('max-bytes')
+        assert max_bytes, 'Missing rawr source prefetch max-bytes'
+        n_workers = prefetch_yaml.get('workers', 4)
+        assert n_workers > 0, 'rawr source prefetch workers should be positive'
+        max_in_flight = prefetch_yaml.get('max-in-flight', n_workers)
+        assert max_in_flight > 0, \
+            'rawr source prefetch max-in-flight should be positive'
+
+        from multiprocessing.pool import ThreadPool
+        from tilequeue.rawr import RawrPrefetcher
+        # with index-in-processors, the payloads are unpacked in the
+        # processors, otherwise they're unpacked in the background here.
+        storage = RawrPrefetcher(
+            storage, ThreadPool(n_workers), max_bytes, max_in_flight,
+            unpack_in_background=not index_in_processors)
+
+    # the processors need to unpack the payloads read by the fetch threads.
+    if index_in_processors:
+        assert source_type in ('s3', 'store'), \
+            'RAWR index-in-processors is only supported for s3 and store ' \
+            'sources'
+
     # TODO: this needs to be configurable, everywhere! this is a long term
     # refactor - it's hard-coded in a bunch of places :-(
     max_z = 16
@@ -169,7 +215,7 @@ def _make_rawr_fetcher(cfg, layer_data,
 
     return make_rawr_data_fetcher(
         group_by_zoom, max_z, storage, layers, indexes_cfg,
-        label_placement_layers)
+        label_placement_layers, narrow_candidates, index_in_processors)
 
 
 def _make_layer_info(layer_data, process_yaml_cfg):
@@ -0,0 +1,181 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from decimal import Decimal
+
+import msgpack
+
+
+# msgpack extension type used for numeric columns, which come back from the
+# database as Decimal.
+_DECIMAL_EXT_TYPE = 1
+
+
+def _pack_default(obj):
+    if isinstance(obj, Decimal):
+        return msgpack.ExtType(_DECIMAL_EXT_TYPE, str(obj))
+    raise TypeError('Cannot serialize %r' % (obj,))
+
+
+def _unpack_ext_hook(code, data):
+    if code == _DECIMAL_EXT_TYPE:
+        return Decimal(data)
+    return msgpack.ExtType(code, data)
+
+
+def pack_rows(rows):
+    # binary types keep str and unicode values apart, so that they come back
+    # as they went in.
+    return msgpack.packb(rows, use_bin_type=True, default=_pack_default)
+
+
+def unpack_rows(payload):
+    return msgpack.unpackb(payload, raw=False, ext_hook=_unpack_ext_hook)
+
+
+class DataVersion(object):
+
+    """
+    Version of the data in the database, used to invalidate cached results
+
+    This is either a fixed version from the config, which should be changed
+    when the data is updated, or the result of a query which returns a token
+    that changes when the data does, e.g. the time of the last import. The
+    query is run at most once every check_interval seconds.
+    """
+
+    def __init__(self, version=None, conn_pool=None, version_query=None,
+                 check_interval=60):
+        assert version is not None or version_query, \
+            'Missing data version or version query'
+        self.version = version
+        self.conn_pool = conn_pool
+        self.version_query = version_query
+        self.check_interval = check_interval
+        self.last_check = None
+        self.lock = threading.Lock()
+
+    def _query_version(self):
+        with self.conn_pool.get_conns(1) as conns:
+            cursor = conns[0].cursor()
+            cursor.execute(self.version_query)
+            row = cursor.fetchone()
+            cursor.close()
+        return str(row[0])
+
+    def __call__(self):
+        if not self.version_query:
+            return str(self.version)
+
+        with self.lock:
+            now = time.time()
+            if self.last_check is None or \
+               now - self.last_check >= self.check_interval:
+                self.version = self._query_version()
+                self.last_check = now
+            return self.version
+
+
+class QueryResultCache(object):
+
+    """
+    Cache of query results for low zooms
+
+    Results are cached for queries at max_zoom or below, keyed by the
+    rendered query, which covers the template, zoom and bounds, along with
+    the current data version. Results are kept serialized, in memory up to
+    memory_max_bytes, and optionally in a DiskCache behind that.
+    """
+
+    def __init__(self, max_zoom, data_version, memory_max_bytes,
+                 disk_cache=None):
+        self.max_zoom = max_zoom
+        self.data_version = data_version
+        self.memory_max_bytes = memory_max_bytes
+        self.disk_cache = disk_cache
+        # key -> (version, payload), from least to most recently used
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.lock = threading.Lock()
+
+    def _key(self, query):
+        # prepared queries are cached by statement and parameter values
+        if isinstance(query, basestring):
+            query_str = query
+        else:
+            query_str = '%s\n%r' % (query.sql, query.values)
+        if isinstance(query_str, unicode):
+            query_str = query_str.encode('utf-8')
+        return hashlib.sha1(query_str).hexdigest()
+
+    def _memory_put(self, key, version, payload):
+        with self.lock:
+            old = self.memory.pop(key, None)
+            if old is not None:
+                self.memory_bytes -= len(old[1])
+            self.memory[key] = version, payload
+            self.memory_bytes += len(payload)
+            while self.memory_bytes > self.memory_max_bytes and self.memory:
+                _, (_, evicted) = self.memory.popitem(last=False)
+                self.memory_bytes -= len(evicted)
+
+    def get(self, zoom, query):
+        """return the cached rows for the query, or None"""
+        if zoom > self.max_zoom:
+            return None
+
+        key = self._key(query)
+        version = self.data_version()
+
+        with self.lock:
+            cached = self.memory.pop(key, None)
+            if cached is not None:
+                # re-insert as the most recently used
+                self.memory[key] = cached
+
+        if cached is None and self.disk_cache is not None:
+            cached = self.disk_cache.get(key)
+            if cached is not None and cached[0] == version:
+                self._memory_put(key, version, cached[1])
+
+        if cached is None or cached[0] != version:
+            return None
+
+        return unpack_rows(cached[1])
+
+    def put(self, zoom, query, rows):
+        if zoom > self.max_zoom:
+            return
+
+        try:
+            payload = pack_rows(rows)
+        except TypeError:
+            # a column type which can't be serialized, leave it uncached.
+            return
+
+        key = self._key(query)
+        version = self.data_version()
+        self._memory_put(key, version, payload)
+        if self.disk_cache is not None:
+            self.disk_cache.put(key, version, payload)
+
+
+def make_query_result_cache(yml, conn_pool):
+    max_zoom = yml.get('max-zoom')
+    assert max_zoom is not None, 'Missing result-cache max-zoom'
+
+    data_version = DataVersion(
+        yml.get('data-version'), conn_pool, yml.get('version-query'),
+        yml.get('version-check-seconds', 60))
+
+    memory_max_bytes = yml.get('memory-max-bytes', 512 * 1024 * 1024)
+
+    disk_cache = None
+    disk_yml = yml.get('disk')
+    if disk_yml:
+        from tilequeue.cache import make_disk_cache
+        disk_cache = make_disk_cache(disk_yml)
+
+    return QueryResultCache(
+        max_zoom, data_version, memory_max_bytes, disk_cache)
@@ -1,20 +1,127 @@
 import random
 import threading
+import time
+from collections import defaultdict
+from collections import deque
+from contextlib import contextmanager
 from itertools import cycle
 from itertools import islice
 
 import psycopg2
 import ujson
+from psycopg2.extensions import QueryCanceledError
 from psycopg2.extras import register_hstore
 from psycopg2.extras import register_json
 
 
+class HostLatencyTracker(object):
+
+    """Track query latency and load for each database host
+
+    Keeps an exponentially weighted moving average of the query latency and
+    the number of queries in flight on each host, so that new connections
+    can be made to the least loaded host. Hosts which haven't been used yet
+    are preferred, so that each gets measured. A host where a query failed
+    is only used when there's no other until failure_backoff seconds have
+    passed, as a host which fails quickly would otherwise look the least
+    loaded.
+    """
+
+    def __init__(self, hosts, smoothing=0.2, failure_backoff=30):
+        self.hosts = list(hosts)
+        self.smoothing = smoothing
+        self.failure_backoff = failure_backoff
+        self.lock = threading.Lock()
+        self.latency = dict((host, None) for host in self.hosts)
+        self.in_flight = dict((host, 0) for host in self.hosts)
+        self.failed_until = dict((host, 0) for host in self.hosts)
+
+    def _sort_key(self, host, now, n_planned):
+        n_queries = self.in_flight[host] + n_planned
+        latency = self.latency[host] or 0
+        backing_off = self.failed_until[host] > now
+        return backing_off, (n_queries + 1) * latency, n_queries
+
+    def _choose(self, candidates, now, planned):
+        keys = dict((host, self._sort_key(host, now, planned[host]))
+                    for host in candidates)
+        min_key = min(keys.values())
+        return random.choice(
+            [host for host in candidates if keys[host] == min_key])
+
+    def choose(self, exclude=()):
+        """return the least loaded host, or None if all are excluded"""
+        with self.lock:
+            candidates = [host for host in self.hosts if host not in exclude]
+            if not candidates:
+                return None
+            return self._choose(candidates, time.time(), defaultdict(int))
+
+    def choose_many(self, n):
+        """
+        return hosts for n connections, counting each one chosen towards the
+        load, as their queries will run at the same time
+        """
+        with self.lock:
+            now = time.time()
+            planned = defaultdict(int)
+            hosts = []
+            for i in xrange(n):
+                host = self._choose(self.hosts, now, planned)
+                planned[host] += 1
+                hosts.append(host)
+            return hosts
+
+    def start(self, host):
+        with self.lock:
+            self.in_flight[host] += 1
+
+    def finish(self, host, elapsed, failed=False):
+        with self.lock:
+            self.in_flight[host] -= 1
+            if failed:
+                self.failed_until[host] = time.time() + self.failure_backoff
+            # queries which fail or are cancelled have elapsed None, and
+            # don't count towards the latency.
+            if elapsed is not None:
+                latency = self.latency[host]
+                if latency is None:
+                    self.latency[host] = elapsed
+                else:
+                    self.latency[host] = (
+                        latency + self.smoothing * (elapsed - latency))
+
+
+class LatencyPercentiles(object):
+
+    """Recent latencies by key, to estimate percentiles from"""
+
+    def __init__(self, max_samples=1000):
+        self.max_samples = max_samples
+        self.samples = defaultdict(lambda: deque(maxlen=self.max_samples))
+        self.lock = threading.Lock()
+
+    def add(self, key, elapsed):
+        with self.lock:
+            self.samples[key].append(elapsed)
+
+    def percentile(self, key, pct, min_samples):
+        """return the pct percentile for key, or None without enough data"""
+        with self.lock:
+            samples = sorted(self.samples[key])
+        if not samples or len(samples) < min_samples:
+            return None
+        index = min(len(samples) - 1, int(len(samples) * pct / 100.0))
+        return samples[index]
+
+
 class ConnectionsContextManager(object):
 
     """Handle automatically closing connections via with statement"""
 
-    def __init__(self, conns):
+    def __init__(self, conns, pool=None):
         self.conns = conns
+        self.pool = pool
 
     def __enter__(self):
         return self.conns
@@ -25,43 +132,195 @@ class ConnectionsContextManager(object):
                 conn.close()
             except Exception:
                 pass
+            if self.pool is not None:
+                self.pool.forget_conn(conn)
+        suppress_exception = False
+        return suppress_exception
+
+
+class ReusedConnectionsContextManager(object):
+
+    """Hand connections back to the pool for reuse via with statement"""
+
+    def __init__(self, pool, dbname_conns):
+        self.pool = pool
+        self.dbname_conns = dbname_conns
+
+    def __enter__(self):
+        return [conn for _, conn in self.dbname_conns]
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.pool.put_conns(self.dbname_conns)
         suppress_exception = False
         return suppress_exception
 
 
 class DBConnectionPool(object):
 
-    """Manage database connections with varying database names"""
+    """Manage database connections with varying database names
+
+    By default, new connections are made for each use and closed afterwards.
+    With reuse_conns, connections are kept open when they're handed back and
+    used again, which allows state such as prepared statements to be kept on
+    them. Connections which are closed while in use, e.g. after a query
+    error, are replaced.
 
-    def __init__(self, dbnames, conn_info, readonly=True):
+    When a list of hosts is configured, connections go to a random host,
+    unless a host_tracker is given. Then they go to the least loaded host,
+    as measured by the queries run with track_query.
+    """
+
+    def __init__(self, dbnames, conn_info, readonly=True, reuse_conns=False,
+                 host_tracker=None):
         self.dbnames = cycle(dbnames)
         self.conn_info = conn_info
         self.conn_mapping = {}
         self.lock = threading.Lock()
         self.readonly = readonly
+        self.reuse_conns = reuse_conns
+        # idle connections by database name, when reusing connections
+        self.idle_conns = defaultdict(list)
+        # names of the statements which have been prepared on each connection
+        self.conn_prepared_statements = {}
+        self.host_tracker = host_tracker
+        # database name and host of each connection, by connection id
+        self.conn_dbname_hosts = {}
 
-    def _make_conn(self, conn_info):
-        # if multiple hosts are provided, select one at random as a kind of
-        # simple load balancing.
-        host = conn_info.get('host')
+    def _choose_host(self, exclude_hosts=()):
+        host = self.conn_info.get('host')
         if host and isinstance(host, list):
-            host = random.choice(host)
-            conn_info = conn_info.copy()
-            conn_info['host'] = host
+            if self.host_tracker is not None:
+                host = self.host_tracker.choose(exclude_hosts)
+            else:
+                # if multiple hosts are provided, select one at random as a
+                # kind of simple load balancing.
+                host = random.choice(host)
+        return host
+
+    def _choose_hosts(self, n):
+        # the connections are used at the same time, so they're spread over
+        # the hosts rather than all going to the least loaded one.
+        host = self.conn_info.get('host')
+        if host and isinstance(host, list) and self.host_tracker is not None:
+            return self.host_tracker.choose_many(n)
+        return [self._choose_host() for i in xrange(n)]
 
+    def _connect(self, conn_info):
         conn = psycopg2.connect(**conn_info)
         conn.set_session(readonly=self.readonly, autocommit=True)
         register_hstore(conn)
         register_json(conn, loads=ujson.loads)
         return conn
 
+    def _make_conn(self, conn_info, host):
+        if host is not None:
+            conn_info = dict(conn_info, host=host)
+
+        conn = self._connect(conn_info)
+        with self.lock:
+            self.conn_dbname_hosts[id(conn)] = conn_info['dbname'], host
+        return conn
+
+    def _get_idle_conn(self, dbname, host):
+        with self.lock:
+            idle_conns = self.idle_conns[dbname]
+            for i in xrange(len(idle_conns) - 1, -1, -1):
+                _, conn_host = self.conn_dbname_hosts[id(idle_conns[i])]
+                if conn_host == host:
+                    return idle_conns.pop(i)
+        return None
+
+    def _get_conn(self, dbname, host):
+        conn = None
+        if self.reuse_conns:
+            conn = self._get_idle_conn(dbname, host)
+        if conn is None:
+            conn_info_with_db = dict(self.conn_info, dbname=dbname)
+            conn = self._make_conn(conn_info_with_db, host)
+        return conn
+
     def get_conns(self, n_conn):
         with self.lock:
             dbnames = list(islice(self.dbnames, n_conn))
         conns = []
-        for dbname in dbnames:
-            conn_info_with_db = dict(self.conn_info, dbname=dbname)
-            conn = self._make_conn(conn_info_with_db)
+        for dbname, host in zip(dbnames, self._choose_hosts(len(dbnames))):
+            conn = self._get_conn(dbname, host)
             conns.append(conn)
-        conns_ctx_mgr = ConnectionsContextManager(conns)
+        return self._conns_ctx_mgr(dbnames, conns)
+
+    def _conns_ctx_mgr(self, dbnames, conns):
+        if self.reuse_conns:
+            conns_ctx_mgr = ReusedConnectionsContextManager(
+                self, zip(dbnames, conns))
+        else:
+            conns_ctx_mgr = ConnectionsContextManager(conns, self)
         return conns_ctx_mgr
+
+    def get_alternate_conn(self, conn):
+        """
+        Return a connection context manager for a single connection to the
+        same database as conn, but on a different host, or None if there
+        isn't another host to use.
+        """
+        if self.host_tracker is None:
+            return None
+        with self.lock:
+            dbname, host = self.conn_dbname_hosts[id(conn)]
+        alternate_host = self._choose_host((host,))
+        if alternate_host is None:
+            return None
+        alternate_conn = self._get_conn(dbname, alternate_host)
+        return self._conns_ctx_mgr([dbname], [alternate_conn])
+
+    @contextmanager
+    def track_query(self, conn):
+        """
+        Record the latency of the query run in the with block against the
+        host of the connection.
+        """
+        with self.lock:
+            _, host = self.conn_dbname_hosts.get(id(conn), (None, None))
+        if self.host_tracker is None or host is None:
+            yield
+            return
+
+        self.host_tracker.start(host)
+        elapsed = None
+        failed = False
+        try:
+            start = time.time()
+            yield
+            elapsed = time.time() - start
+        except QueryCanceledError:
+            # cancelled in favour of a hedged query, which says nothing bad
+            # about the host.
+            raise
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self.host_tracker.finish(host, elapsed, failed)
+
+    def forget_conn(self, conn):
+        with self.lock:
+            self.conn_prepared_statements.pop(id(conn), None)
+            self.conn_dbname_hosts.pop(id(conn), None)
+
+    def put_conns(self, dbname_conns):
+        closed_conns = []
+        with self.lock:
+            for dbname, conn in dbname_conns:
+                if conn.closed:
+                    closed_conns.append(conn)
+                else:
+                    self.idle_conns[dbname].append(conn)
+        for conn in closed_conns:
+            self.forget_conn(conn)
+
+    def prepared_statements(self, conn):
+        """
+        Return the set of names of the statements prepared on the connection,
+        which the caller can add to.
+        """
+        with self.lock:
+            return self.conn_prepared_statements.setdefault(id(conn), set())
@@ -1,12 +1,21 @@
+import hashlib
 import sys
+import threading
+import time
+from collections import defaultdict
 from collections import namedtuple
+from Queue import Empty
+from Queue import Queue
 
+from jinja2 import contextfilter
 from jinja2 import Environment
 from jinja2 import FileSystemLoader
 from psycopg2.extras import RealDictCursor
 
 from tilequeue.query import DBConnectionPool
+from tilequeue.query.pool import LatencyPercentiles
 from tilequeue.transform import calculate_padded_bounds
+from tilequeue.twkb import twkb_precision
 
 
 TemplateSpec = namedtuple('TemplateSpec', 'template start_zoom end_zoom')
@@ -66,54 +75,191 @@ class SourcesQueriesGenerator(object):
     def __call__(self, zoom, bounds):
         queries = []
         for source in self.sources:
-            template_queries = []
-            for template_spec in source.template_specs:
-                # NOTE: end_zoom is exclusive
-                if template_spec.start_zoom <= zoom < template_spec.end_zoom:
-                    template_query = self.query_generator(
-                        template_spec.template, bounds, zoom)
-                    template_queries.append(template_query)
-            if template_queries:
-                source_query = '\nUNION ALL\n'.join(template_queries)
+            source_query = self._source_query(source, zoom, bounds)
+            if source_query:
                 queries.append(source_query)
         return queries
 
+    def _source_templates(self, source, zoom):
+        # NOTE: end_zoom is exclusive
+        return tuple(
+            template_spec.template for template_spec in source.template_specs
+            if template_spec.start_zoom <= zoom < template_spec.end_zoom)
+
+    def _source_query(self, source, zoom, bounds):
+        template_queries = []
+        for template in self._source_templates(source, zoom):
+            template_query = self.query_generator(template, bounds, zoom)
+            template_queries.append(template_query)
+        if template_queries:
+            return '\nUNION ALL\n'.join(template_queries)
+        return None
+
+    def zoom_band(self, zoom):
+        """
+        Return a key for the templates which are queried at zoom. It's the
+        same for all the zooms which query the same templates.
+        """
+        return tuple(
+            self._source_templates(source, zoom) for source in self.sources)
+
+
+class UnpreparableTemplate(Exception):
+    pass
+
+
+class BoundsParameters(object):
+
+    """
+    Stand-in for the bounds when rendering a template as a prepared statement
+
+    The bbox filters ask it for SQL parameter placeholders instead of
+    formatting the bounds into the query. It keeps track of which parameters
+    were used, so that their values can be calculated from the real bounds
+    when the statement is executed. Any other use of the bounds in a template
+    raises UnpreparableTemplate.
+    """
+
+    def __init__(self):
+        # the pad factor, or None for unpadded, of each group of four
+        # parameters.
+        self.pad_factors = []
+
+    def placeholders(self, pad_factor=None):
+        if pad_factor not in self.pad_factors:
+            self.pad_factors.append(pad_factor)
+        start = 4 * self.pad_factors.index(pad_factor) + 1
+        return tuple('$%d::float8' % i for i in xrange(start, start + 4))
+
+    def values(self, bounds):
+        values = []
+        for pad_factor in self.pad_factors:
+            if pad_factor is None:
+                values.extend(bounds)
+            else:
+                padded_bounds = calculate_padded_bounds(pad_factor, bounds)
+                values.extend(padded_bounds.bounds)
+        return values
+
+    def _unpreparable(self, *args):
+        raise UnpreparableTemplate('Bounds used outside of a bbox filter')
+
+    __getitem__ = __iter__ = __str__ = __unicode__ = __float__ = _unpreparable
+
+
+PreparedQuery = namedtuple('PreparedQuery', 'name sql values')
+
+
+class PreparedSourcesQueriesGenerator(SourcesQueriesGenerator):
+
+    """
+    Generate prepared statement queries for the sources
+
+    Each source's templates are rendered once per zoom, with the bounds as
+    statement parameters, rather than for every tile. The queries returned
+    are PreparedQuery objects with the parameter values for the bounds. If a
+    source's templates can't be rendered that way, then its query is rendered
+    with the bounds in it, as usual.
+    """
+
+    def __init__(self, sources, query_generator, cache_statements=True):
+        super(PreparedSourcesQueriesGenerator, self).__init__(
+            sources, query_generator)
+        self.cache_statements = cache_statements
+        self.statements = {}
+        self.lock = threading.Lock()
+
+    def _statement(self, source, zoom):
+        key = source.name, zoom
+        with self.lock:
+            if key in self.statements:
+                return self.statements[key]
+
+        statement = None
+        bounds_params = BoundsParameters()
+        try:
+            sql = super(PreparedSourcesQueriesGenerator, self)._source_query(
+                source, zoom, bounds_params)
+        except UnpreparableTemplate:
+            sql = None
+        if sql:
+            sql_hash = hashlib.md5(sql.encode('utf-8')).hexdigest()
+            name = 'tilequeue_%s' % sql_hash
+            statement = name, sql, bounds_params
+
+        if self.cache_statements:
+            with self.lock:
+                self.statements[key] = statement
+        return statement
+
+    def _source_query(self, source, zoom, bounds):
+        statement = self._statement(source, zoom)
+        if statement is None:
+            return super(PreparedSourcesQueriesGenerator, self)._source_query(
+                source, zoom, bounds)
+
+        name, sql, bounds_params = statement
+        return PreparedQuery(name, sql, bounds_params.values(bounds))
+
+
+def _bbox_coords(bounds, pad_factor=None):
+    if isinstance(bounds, BoundsParameters):
+        return bounds.placeholders(pad_factor)
+    if pad_factor is not None:
+        bounds = calculate_padded_bounds(pad_factor, bounds).bounds
+    return tuple('%.12f' % x for x in bounds)
+
+
+def _bbox_sql(coords, srid):
+    min_point = 'ST_MakePoint(%s, %s)' % (coords[0], coords[1])
+    max_point = 'ST_MakePoint(%s, %s)' % (coords[2], coords[3])
+    bbox_no_srid = 'ST_MakeBox2D(%s, %s)' % (min_point, max_point)
+    bbox = 'ST_SetSrid(%s, %d)' % (bbox_no_srid, srid)
+    return bbox
+
 
 def jinja_filter_geometry(value):
     return 'ST_AsBinary(%s)' % value
 
 
+def make_jinja_filter_compact_geometry(twkb_detail_zooms=None):
+    """
+    Return the filter for geometry columns which can be sent in a compact
+    encoding. This is WKB, as the geometry filter, unless twkb_detail_zooms
+    is set. Then it's TWKB, at a precision for the zoom of the query.
+    """
+    if twkb_detail_zooms is None:
+        return jinja_filter_geometry
+
+    @contextfilter
+    def jinja_filter_compact_geometry(context, value):
+        precision = twkb_precision(context['zoom'], twkb_detail_zooms)
+        return 'ST_AsTWKB(%s, %d)' % (value, precision)
+
+    return jinja_filter_compact_geometry
+
+
 def jinja_filter_bbox_filter(bounds, geometry_col_name, srid=3857):
-    min_point = 'ST_MakePoint(%.12f, %.12f)' % (bounds[0], bounds[1])
-    max_point = 'ST_MakePoint(%.12f, %.12f)' % (bounds[2], bounds[3])
-    bbox_no_srid = 'ST_MakeBox2D(%s, %s)' % (min_point, max_point)
-    bbox = 'ST_SetSrid(%s, %d)' % (bbox_no_srid, srid)
+    bbox = _bbox_sql(_bbox_coords(bounds), srid)
     bbox_filter = '%s && %s' % (geometry_col_name, bbox)
     return bbox_filter
 
 
 def jinja_filter_bbox_intersection(bounds, geometry_col_name, srid=3857):
-    min_point = 'ST_MakePoint(%.12f, %.12f)' % (bounds[0], bounds[1])
-    max_point = 'ST_MakePoint(%.12f, %.12f)' % (bounds[2], bounds[3])
-    bbox_no_srid = 'ST_MakeBox2D(%s, %s)' % (min_point, max_point)
-    bbox = 'ST_SetSrid(%s, %d)' % (bbox_no_srid, srid)
+    bbox = _bbox_sql(_bbox_coords(bounds), srid)
     bbox_intersection = 'st_intersection(%s, %s)' % (geometry_col_name, bbox)
     return bbox_intersection
 
 
 def jinja_filter_bbox_padded_intersection(
         bounds, geometry_col_name, pad_factor=1.1, srid=3857):
-    padded_bounds = calculate_padded_bounds(pad_factor, bounds)
-    return jinja_filter_bbox_intersection(
-        padded_bounds.bounds, geometry_col_name, srid)
+    bbox = _bbox_sql(_bbox_coords(bounds, pad_factor), srid)
+    bbox_intersection = 'st_intersection(%s, %s)' % (geometry_col_name, bbox)
+    return bbox_intersection
 
 
 def jinja_filter_bbox(bounds, srid=3857):
-    min_point = 'ST_MakePoint(%.12f, %.12f)' % (bounds[0], bounds[1])
-    max_point = 'ST_MakePoint(%.12f, %.12f)' % (bounds[2], bounds[3])
-    bbox_no_srid = 'ST_MakeBox2D(%s, %s)' % (min_point, max_point)
-    bbox = 'ST_SetSrid(%s, %d)' % (bbox_no_srid, srid)
-    return bbox
+    return _bbox_sql(_bbox_coords(bounds), srid)
 
 
 def jinja_filter_bbox_overlaps(bounds, geometry_col_name, srid=3857):
@@ -135,10 +281,7 @@ def jinja_filter_bbox_overlaps(bounds, geometry_col_name, srid=3857):
     boundaries which are completely within the bounding box.
     """
 
-    min_point = 'ST_MakePoint(%.12f, %.12f)' % (bounds[0], bounds[1])
-    max_point = 'ST_MakePoint(%.12f, %.12f)' % (bounds[2], bounds[3])
-    bbox_no_srid = 'ST_MakeBox2D(%s, %s)' % (min_point, max_point)
-    bbox = 'ST_SetSrid(%s, %d)' % (bbox_no_srid, srid)
+    bbox = _bbox_sql(_bbox_coords(bounds), srid)
     bbox_filter = \
         '((%(col)s && %(bbox)s) AND (' \
         '  st_overlaps(%(col)s, %(bbox)s) OR' \
@@ -169,6 +312,109 @@ def execute_query(conn, query):
         raise
 
 
+def _read_columns(description):
+    return list(enumerate(column[0] for column in description))
+
+
+def _read_row(columns, row):
+    # build the row in the shape the rest of the pipeline expects: keyed by
+    # column name, without nulls and with binary data as bytes.
+    read_row = {}
+    for i, name in columns:
+        v = row[i]
+        if v is not None:
+            if isinstance(v, buffer):
+                v = bytes(v)
+            read_row[name] = v
+    return read_row
+
+
+def execute_query_streaming(conn, query, batch_size):
+    """
+    Execute the query on a server-side cursor, reading batch_size rows at a
+    time and building each one as it arrives. This means that a large result
+    is never held in memory more than once, unlike fetching it all as dicts
+    in one go.
+    """
+    try:
+        # server-side cursors need to run inside a transaction, but the
+        # connections are made in autocommit mode, and other queries on them
+        # expect it, so it's put back afterwards.
+        conn.autocommit = False
+        try:
+            cursor = conn.cursor(name='tilequeue_fetch')
+            cursor.execute(query)
+
+            rows = []
+            columns = None
+            while True:
+                batch = cursor.fetchmany(batch_size)
+                if not batch:
+                    break
+                # the description isn't available until the first fetch
+                if columns is None:
+                    columns = _read_columns(cursor.description)
+                for row in batch:
+                    rows.append(_read_row(columns, row))
+
+            cursor.close()
+        finally:
+            # the transaction only read, so it's rolled back to end it
+            conn.rollback()
+            conn.autocommit = True
+        return rows
+    except Exception:
+        try:
+            conn.close()
+        except Exception:
+            pass
+        raise
+
+
+def execute_prepared_query(conn, query, prepared_statements):
+    """
+    Execute a PreparedQuery, first preparing its statement on the connection
+    if it isn't in prepared_statements, the set of statement names already
+    prepared there.
+    """
+    try:
+        cursor = conn.cursor()
+        if query.name not in prepared_statements:
+            cursor.execute('PREPARE %s AS %s' % (query.name, query.sql))
+            prepared_statements.add(query.name)
+
+        if query.values:
+            placeholders = ', '.join(['%s'] * len(query.values))
+            cursor.execute(
+                'EXECUTE %s (%s)' % (query.name, placeholders), query.values)
+        else:
+            cursor.execute('EXECUTE %s' % query.name)
+
+        columns = _read_columns(cursor.description)
+        rows = [_read_row(columns, row) for row in cursor.fetchall()]
+        cursor.close()
+        return rows
+    except Exception:
+        try:
+            conn.close()
+        except Exception:
+            pass
+        raise
+
+
+def _read_dict_rows(rows):
+    read_rows = []
+    for row in rows:
+        read_row = {}
+        for k, v in row.items():
+            if isinstance(v, buffer):
+                v = bytes(v)
+            if v is not None:
+                read_row[k] = v
+        read_rows.append(read_row)
+    return read_rows
+
+
 class DataFetchException(Exception):
 
     """Capture all exceptions when trying to read data"""
@@ -179,17 +425,142 @@ class DataFetchException(Exception):
         super(DataFetchException, self).__init__(msgs)
 
 
+class QueryHedger(object):
+
+    """
+    Run a query again on another host when it takes too long
+
+    Query latencies are recorded by key, e.g. the zoom. Once there are at
+    least min_samples for the key, a query which is still running after the
+    given percentile latency is started again on a connection to a different
+    host. The first to finish is used, and the other is cancelled.
+    """
+
+    def __init__(self, conn_pool, percentile, min_samples):
+        self.conn_pool = conn_pool
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.latencies = LatencyPercentiles()
+
+    def _start(self, run_query, conn, results):
+        def run():
+            try:
+                rows = run_query(conn)
+            except Exception as e:
+                results.put((conn, False, e))
+            else:
+                results.put((conn, True, rows))
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    def __call__(self, run_query, conn, key):
+        """
+        Return the result of run_query, which is called with a connection.
+        """
+        start = time.time()
+        delay = self.latencies.percentile(
+            key, self.percentile, self.min_samples)
+        if delay is None:
+            rows = run_query(conn)
+            self.latencies.add(key, time.time() - start)
+            return rows
+
+        results = Queue()
+        self._start(run_query, conn, results)
+        try:
+            result = results.get(timeout=delay)
+        except Empty:
+            result = self._hedge(run_query, conn, results)
+        self.latencies.add(key, time.time() - start)
+
+        _, ok, value = result
+        if not ok:
+            raise value
+        return value
+
+    def _hedge(self, run_query, conn, results):
+        alternate_conn_ctx = self.conn_pool.get_alternate_conn(conn)
+        if alternate_conn_ctx is None:
+            return results.get()
+
+        with alternate_conn_ctx as alternate_conns:
+            self._start(run_query, alternate_conns[0], results)
+            result = results.get()
+            _, ok, _ = result
+            if ok:
+                # cancel the query which is still running on the other
+                # connection, and wait for it to stop before the connection
+                # is used again.
+                loser_conn = conn
+                if result[0] is conn:
+                    loser_conn = alternate_conns[0]
+                try:
+                    loser_conn.cancel()
+                except Exception:
+                    pass
+                results.get()
+            else:
+                # the first failed, so see if the other one succeeds.
+                other_result = results.get()
+                if other_result[1]:
+                    result = other_result
+        return result
+
+
+def _min_zoom_visible(props, zoom):
+    # the same test as the queries make on the min_zoom of each feature.
+    # features without a min_zoom are kept.
+    min_zoom = props.get('min_zoom')
+    return min_zoom is None or min_zoom < zoom + 1
+
+
+def filter_rows_for_zoom(rows, zoom):
+    """
+    Return copies of the rows, queried at a higher zoom, with only the layer
+    properties of features which are visible at zoom. Rows which aren't in
+    any layer at zoom are dropped.
+    """
+    zoom_rows = []
+    for row in rows:
+        zoom_row = dict(row)
+        in_layer = False
+        for key, value in row.iteritems():
+            if value is None or not key.endswith('_properties__') or \
+               key == '__properties__':
+                continue
+            if _min_zoom_visible(value, zoom):
+                in_layer = True
+            else:
+                zoom_row[key] = None
+        if in_layer:
+            zoom_rows.append(zoom_row)
+    return zoom_rows
+
+
 class DataFetcher(object):
 
-    def __init__(self, conn_info, queries_generator, io_pool):
+    def __init__(self, conn_info, queries_generator, io_pool,
+                 stream_batch_size=None, reuse_conns=False,
+                 result_cache=None, host_tracker=None, hedge_percentile=None,
+                 hedge_min_samples=100, multi_zoom=False):
         self.conn_info = dict(conn_info)
         self.queries_generator = queries_generator
+        self.multi_zoom = multi_zoom
         self.io_pool = io_pool
+        self.stream_batch_size = stream_batch_size
+        self.result_cache = result_cache
 
         self.dbnames = self.conn_info.pop('dbnames')
         self.dbnames_query_index = 0
         self.sql_conn_pool = DBConnectionPool(
-            self.dbnames, self.conn_info)
+            self.dbnames, self.conn_info, reuse_conns=reuse_conns,
+            host_tracker=host_tracker)
+
+        self.hedger = None
+        if hedge_percentile is not None:
+            self.hedger = QueryHedger(
+                self.sql_conn_pool, hedge_percentile, hedge_min_samples)
 
     def fetch_tiles(self, all_data):
         # postgres data fetcher doesn't need this kind of session management,
@@ -199,18 +570,30 @@ class DataFetcher(object):
 
     def __call__(self, zoom, unpadded_bounds):
         queries = self.queries_generator(zoom, unpadded_bounds)
+        assert queries, 'no queries'
+
+        all_source_rows = []
+        if self.result_cache is not None:
+            uncached_queries = []
+            for query in queries:
+                source_rows = self.result_cache.get(zoom, query)
+                if source_rows is None:
+                    uncached_queries.append(query)
+                else:
+                    all_source_rows.extend(source_rows)
+            queries = uncached_queries
 
-        n_conns = len(queries)
-        assert n_conns, 'no queries'
+            if not queries:
+                return all_source_rows
 
+        n_conns = len(queries)
         with self.sql_conn_pool.get_conns(n_conns) as sql_conns:
             async_results = []
             for query, conn in zip(queries, sql_conns):
                 async_result = self.io_pool.apply_async(
-                    execute_query, (conn, query))
+                    self._execute, (conn, query, zoom))
                 async_results.append(async_result)
 
-            all_source_rows = []
             async_exceptions = []
             for async_result in async_results:
                 try:
@@ -227,22 +610,66 @@ class DataFetcher(object):
             if async_exceptions:
                 raise DataFetchException(async_exceptions)
 
-        read_rows = []
-        for row in all_source_rows:
-            read_row = {}
-            for k, v in row.items():
-                if isinstance(v, buffer):
-                    v = bytes(v)
-                if v is not None:
-                    read_row[k] = v
-            read_rows.append(read_row)
-
-        return read_rows
+        return all_source_rows
+
+    def fetch_zooms(self, zooms, unpadded_bounds):
+        """
+        Return a dict of zoom to the rows for each of the zooms.
+
+        With multi_zoom, the zooms which query the same templates are
+        fetched once, at the highest of them, and the rows for the others are
+        filtered from those by their min_zoom.
+        """
+        if not self.multi_zoom:
+            return dict(
+                (zoom, self(zoom, unpadded_bounds)) for zoom in zooms)
+
+        zooms_by_band = defaultdict(list)
+        for zoom in zooms:
+            zoom_band = self.queries_generator.zoom_band(zoom)
+            zooms_by_band[zoom_band].append(zoom)
+
+        rows_by_zoom = {}
+        for band_zooms in zooms_by_band.itervalues():
+            max_zoom = max(band_zooms)
+            rows = self(max_zoom, unpadded_bounds)
+            for zoom in band_zooms:
+                if zoom != max_zoom:
+                    rows_by_zoom[zoom] = filter_rows_for_zoom(rows, zoom)
+            rows_by_zoom[max_zoom] = rows
+        return rows_by_zoom
+
+    def _run_query(self, conn, query):
+        # returns the rows with binary data as bytes and without nulls.
+        with self.sql_conn_pool.track_query(conn):
+            if isinstance(query, PreparedQuery):
+                prepared_statements = \
+                    self.sql_conn_pool.prepared_statements(conn)
+                return execute_prepared_query(
+                    conn, query, prepared_statements)
+            elif self.stream_batch_size:
+                return execute_query_streaming(
+                    conn, query, self.stream_batch_size)
+            else:
+                return _read_dict_rows(execute_query(conn, query))
+
+    def _execute(self, conn, query, zoom):
+        if self.hedger is not None:
+            rows = self.hedger(
+                lambda run_conn: self._run_query(run_conn, query), conn, zoom)
+        else:
+            rows = self._run_query(conn, query)
+
+        if self.result_cache is not None:
+            self.result_cache.put(zoom, query, rows)
+        return rows
 
 
-def make_jinja_environment(template_path):
+def make_jinja_environment(template_path, twkb_detail_zooms=None):
     environment = Environment(loader=FileSystemLoader(template_path))
     environment.filters['geometry'] = jinja_filter_geometry
+    environment.filters['compact_geometry'] = (
+        make_jinja_filter_compact_geometry(twkb_detail_zooms))
     environment.filters['bbox_filter'] = jinja_filter_bbox_filter
     environment.filters['bbox_intersection'] = jinja_filter_bbox_intersection
     environment.filters['bbox_padded_intersection'] = (
@@ -252,12 +679,18 @@ def make_jinja_environment(template_path):
     return environment
 
 
-def make_queries_generator(sources, template_path, reload_templates):
-    jinja_environment = make_jinja_environment(template_path)
+def make_queries_generator(sources, template_path, reload_templates,
+                           prepare_statements=False, twkb_detail_zooms=None):
+    jinja_environment = make_jinja_environment(
+        template_path, twkb_detail_zooms)
     cache_templates = not reload_templates
     template_finder = TemplateFinder(jinja_environment, cache_templates)
     query_generator = TemplateQueryGenerator(template_finder)
-    queries_generator = SourcesQueriesGenerator(sources, query_generator)
+    if prepare_statements:
+        queries_generator = PreparedSourcesQueriesGenerator(
+            sources, query_generator, cache_templates)
+    else:
+        queries_generator = SourcesQueriesGenerator(sources, query_generator)
     return queries_generator
 
 
@@ -279,14 +712,76 @@ def parse_source_data(queries_cfg):
 
 
 def make_db_data_fetcher(postgresql_conn_info, template_path, reload_templates,
-                         query_cfg, io_pool):
+                         query_cfg, io_pool, fetch_cfg=None):
     """
     Returns an object which is callable with the zoom and unpadded bounds and
     which returns a list of rows.
+
+    The optional fetch_cfg is the postgresql-fetch config section, which
+    controls how queries are run.
     """
 
+    if fetch_cfg is None:
+        fetch_cfg = {}
+
+    stream_batch_size = fetch_cfg.get('stream-batch-size')
+    if stream_batch_size is not None:
+        assert stream_batch_size > 0, \
+            'postgresql-fetch stream-batch-size should be positive'
+
+    # prepared statements only last as long as the connection, so keep the
+    # connections open to make use of them.
+    prepare_statements = fetch_cfg.get('prepared-statements', False)
+
+    # with several replica hosts, route queries to the least loaded one and
+    # optionally hedge slow queries by running them on a second replica.
+    host_tracker = None
+    hosts = postgresql_conn_info.get('host')
+    if fetch_cfg.get('replica-routing') and isinstance(hosts, list):
+        from tilequeue.query.pool import HostLatencyTracker
+        host_tracker = HostLatencyTracker(hosts)
+    hedge_yml = fetch_cfg.get('hedge')
+    hedge_percentile = None
+    hedge_min_samples = None
+    if hedge_yml:
+        assert fetch_cfg.get('replica-routing'), \
+            'postgresql-fetch hedge requires replica-routing'
+        hedge_percentile = hedge_yml.get('percentile', 95)
+        assert 0 < hedge_percentile < 100, \
+            'postgresql-fetch hedge percentile should be between 0 and 100'
+        hedge_min_samples = hedge_yml.get('min-samples', 100)
+
+    # geometry columns which use the compact_geometry filter can be sent as
+    # TWKB, rounded to a precision suitable for the zoom.
+    twkb_detail_zooms = None
+    geometry_encoding_yml = fetch_cfg.get('geometry-encoding')
+    if geometry_encoding_yml:
+        encoding_format = geometry_encoding_yml.get('format', 'wkb')
+        assert encoding_format in ('wkb', 'twkb'), \
+            'Unknown postgresql-fetch geometry-encoding format: %s' % \
+            encoding_format
+        if encoding_format == 'twkb':
+            twkb_detail_zooms = geometry_encoding_yml.get('detail-zooms', 0)
+
+    result_cache = None
+    result_cache_yml = fetch_cfg.get('result-cache')
+    if result_cache_yml:
+        from tilequeue.query.cache import make_query_result_cache
+        # the version query gets its own pool, so that it doesn't hold on
+        # to the fetcher's connections.
+        conn_info = dict(postgresql_conn_info)
+        dbnames = conn_info.pop('dbnames')
+        version_conn_pool = DBConnectionPool(dbnames, conn_info)
+        result_cache = make_query_result_cache(
+            result_cache_yml, version_conn_pool)
+
     sources = parse_source_data(query_cfg)
     queries_generator = make_queries_generator(
-        sources, template_path, reload_templates)
+        sources, template_path, reload_templates, prepare_statements,
+        twkb_detail_zooms)
     return DataFetcher(
-        postgresql_conn_info, queries_generator, io_pool)
+        postgresql_conn_info, queries_generator, io_pool, stream_batch_size,
+        reuse_conns=prepare_statements, result_cache=result_cache,
+        host_tracker=host_tracker, hedge_percentile=hedge_percentile,
+        hedge_min_samples=hedge_min_samples,
+        multi_zoom=fetch_cfg.get('multi-zoom', False))
@@ -280,6 +280,19 @@ def _tiles(zoom, unpadded_bounds):
 # include the min zoom for each layer, reducing the memory footprint.
 _Feature = namedtuple('_Feature', 'fid shape properties layer_min_zooms')
 
+# a feature which might appear in a tile, along with the range of zooms that
+# it was indexed at and its bounds.
+_Candidate = namedtuple('_Candidate', 'source feature min_z max_z bounds')
+
+
+def _bounds_intersect(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def _bounds_contain(outer, inner):
+    return outer[0] <= inner[0] and outer[1] <= inner[1] and \
+        outer[2] >= inner[2] and outer[3] >= inner[3]
+
 
 class _LazyShape(object):
     """
@@ -666,18 +679,28 @@ def _orient(shape):
 class RawrTile(object):
 
     def __init__(self, layers, tables, tile_pyramid, label_placement_layers,
-                 indexes_cfg):
+                 indexes_cfg, narrow_candidates=False):
         """
         Expect layers to be a dict of layer name to LayerInfo (see fixture.py).
         Tables should be a callable which returns a Table object (namedtuple
         of a source and iterator over the rows in the table) when called with
         that table's name.
+
+        With narrow_candidates, features are looked up from the candidates
+        of an earlier call with bounds containing the new bounds, if there is
+        one, rather than from the index. This is much faster when the tiles
+        of a pyramid are fetched top-down and depth first, with each tile
+        before its children.
         """
 
         self.layers = layers
         self.tile_pyramid = tile_pyramid
         self.label_placement_layers = label_placement_layers
         self.osm = None
+        self.narrow_candidates = narrow_candidates
+        # (bounds, candidates) of the previous calls which contain each
+        # other, from the outermost to the innermost.
+        self.candidates_stack = []
 
         indexes = []
         for index_cfg in indexes_cfg:
@@ -710,7 +733,53 @@ class RawrTile(object):
                 return layer_name
         return None
 
+    def _all_candidates(self):
+        # every feature in any of the indexes, with the range of zooms that
+        # it's indexed at.
+        candidates = {}
+        for index in self.indexes:
+            for tile, features in index.tile_index.iteritems():
+                for feature in features:
+                    candidate = candidates.get(id(feature))
+                    if candidate is None:
+                        candidates[id(feature)] = [
+                            index.source, feature, tile.z, tile.z]
+                    else:
+                        candidate[2] = min(candidate[2], tile.z)
+                        candidate[3] = max(candidate[3], tile.z)
+
+        return [_Candidate(source, feature, min_z, max_z,
+                           feature.shape.bounds)
+                for source, feature, min_z, max_z in candidates.itervalues()]
+
+    def _narrowed_candidates(self, bounds):
+        # drop previous candidates which don't contain these bounds, e.g.
+        # siblings of the parent tile, leaving the closest ancestor on top.
+        stack = self.candidates_stack
+        while stack and not _bounds_contain(stack[-1][0], bounds):
+            stack.pop()
+
+        if stack:
+            parent_candidates = stack[-1][1]
+        else:
+            parent_candidates = self._all_candidates()
+
+        candidates = [c for c in parent_candidates
+                      if _bounds_intersect(c.bounds, bounds)]
+        stack.append((bounds, candidates))
+        return candidates
+
+    def _lookup_candidates(self, zoom, bounds):
+        source_features = defaultdict(list)
+        for candidate in self._narrowed_candidates(bounds):
+            if candidate.min_z <= zoom <= candidate.max_z:
+                source_features[candidate.source].append(candidate.feature)
+        return source_features.iteritems()
+
     def _lookup(self, zoom, unpadded_bounds):
+        if self.narrow_candidates:
+            return self._lookup_candidates(zoom, unpadded_bounds)
+
         source_features = defaultdict(list)
         seen_ids = set()
 
@@ -859,16 +928,48 @@ class RawrTile(object):
         return read_row
 
 
+class DeferredRawrTile(object):
+
+    """
+    A RAWR tile which has been read, but not unpacked or indexed
+
+    In place of a fetcher, this is handed out with the list of jobs which
+    need the tile, so that the whole group can be sent to another process.
+    There, DataFetcher.fetch_deferred makes the fetcher, so the indexing and
+    row extraction happen in that process, rather than the one reading the
+    tile.
+    """
+
+    deferred = True
+
+    def __init__(self, top_coord, payload):
+        self.top_coord = top_coord
+        self.payload = payload
+
+
 class DataFetcher(object):
 
     def __init__(self, min_z, max_z, storage, layers, indexes_cfg,
-                 label_placement_layers):
+                 label_placement_layers, narrow_candidates=False,
+                 index_in_processors=False):
         self.min_z = min_z
         self.max_z = max_z
         self.storage = storage
         self.layers = layers
         self.indexes_cfg = indexes_cfg
         self.label_placement_layers = label_placement_layers
+        self.narrow_candidates = narrow_candidates
+        self.index_in_processors = index_in_processors
+
+    def _tile_pyramid(self, top_coord):
+        return TilePyramid(
+            self.min_z, int(top_coord.column), int(top_coord.row),
+            self.max_z)
+
+    def _fetcher(self, tile_pyramid, tables):
+        return RawrTile(self.layers, tables, tile_pyramid,
+                        self.label_placement_layers, self.indexes_cfg,
+                        self.narrow_candidates)
 
     def fetch_tiles(self, all_data):
         # group all coords by the "unit of work" zoom, i.e: z10 for
@@ -882,18 +983,39 @@ class DataFetcher(object):
         # tile, which allows DataFetcher to take advantage of any common
         # locality.
         for top_coord, coord_group in coords_by_parent:
-            tile_pyramid = TilePyramid(
-                self.min_z, int(top_coord.column), int(top_coord.row),
-                self.max_z)
+            tile_pyramid = self._tile_pyramid(top_coord)
 
-            tables = self.storage(tile_pyramid.tile())
+            if self.index_in_processors:
+                payload = self.storage.read_payload(tile_pyramid.tile())
+                yield (DeferredRawrTile(top_coord, payload),
+                       [data for _, data in coord_group])
+                continue
 
-            fetcher = RawrTile(self.layers, tables, tile_pyramid,
-                               self.label_placement_layers, self.indexes_cfg)
+            tables = self.storage(tile_pyramid.tile())
+            fetcher = self._fetcher(tile_pyramid, tables)
 
             for coord, data in coord_group:
                 yield fetcher, data
 
+    def fetch_deferred(self, deferred):
+        """return the fetcher for a DeferredRawrTile from fetch_tiles"""
+        tile_pyramid = self._tile_pyramid(deferred.top_coord)
+        tables = self.storage.unpack(deferred.payload)
+        return self._fetcher(tile_pyramid, tables)
+
+    def prefetch(self, coord):
+        """
+        Start reading the RAWR tile that the coordinate will need, if the
+        storage supports reading ahead. Returns whether a read was started.
+        """
+        prefetch = getattr(self.storage, 'prefetch', None)
+        if prefetch is None or coord.zoom < self.min_z:
+            return False
+
+        top_coord = coord.zoomTo(self.min_z).container()
+        tile_pyramid = self._tile_pyramid(top_coord)
+        return prefetch(tile_pyramid.tile())
+
 
 # Make a RAWR tile data fetcher given:
 #
@@ -912,7 +1034,18 @@ class DataFetcher(object):
 #             set (or other in-supporting collection) of layer names.
 #             Geometries of that type in that layer will have a label
 #             placement generated for them.
+#  - narrow_candidates:
+#             Look up the features for each tile from those of its parent,
+#             when the tiles are fetched top-down (see RawrTile).
+#  - index_in_processors:
+#             Hand out each RAWR tile unindexed, along with the jobs which need
+#             it, for them to be indexed and fetched in the processor
+#             processes (see DeferredRawrTile). The storage must provide
+#             read_payload and unpack.
 def make_rawr_data_fetcher(min_z, max_z, storage, layers, indexes_cfg,
-                           label_placement_layers={}):
+                           label_placement_layers={},
+                           narrow_candidates=False,
+                           index_in_processors=False):
     return DataFetcher(min_z, max_z, storage, layers, indexes_cfg,
-                       label_placement_layers)
+                       label_placement_layers, narrow_candidates,
+                       index_in_processors)
@@ -30,6 +30,21 @@ class DataFetcher(object):
         return chain(self.above_fetcher.fetch_tiles(above_data),
                      self.below_fetcher.fetch_tiles(below_data))
 
+    def fetch_deferred(self, deferred):
+        # only RAWR tiles, above the split, are ever deferred.
+        return self.above_fetcher.fetch_deferred(deferred)
+
+    def prefetch(self, coord):
+        if coord.zoom < self.split_zoom:
+            fetcher = self.below_fetcher
+        else:
+            fetcher = self.above_fetcher
+
+        prefetch = getattr(fetcher, 'prefetch', None)
+        if prefetch is None:
+            return False
+        return prefetch(coord)
+
 
 def make_split_data_fetcher(split_zoom, below_fetcher, above_fetcher):
     return DataFetcher(split_zoom, below_fetcher, above_fetcher)
@@ -0,0 +1,223 @@
+# scheduling of reads across the queues of a queue mapper. by default the
+# queues are read in strict priority order, but they can instead share the
+# reads by weight, so that a busy high priority queue, eg one being seeded,
+# can't starve the others.
+import threading
+import time
+from operator import attrgetter
+from operator import itemgetter
+
+from tilequeue.utils import format_stacktrace_one_line
+
+
+class PriorityQueueScheduler(object):
+
+    """
+    Reads from the first queue, in priority order, which has messages
+    """
+
+    def __init__(self, queue_mapper, tile_proc_logger):
+        self.queue_mapper = queue_mapper
+        self.tile_proc_logger = tile_proc_logger
+
+    def read(self):
+        """return the queue_id and message handles read, if any"""
+        for queue_id, tile_queue in (
+                self.queue_mapper.queues_in_priority_order()):
+            try:
+                msg_handles = tile_queue.read()
+            except Exception as e:
+                stacktrace = format_stacktrace_one_line()
+                self.tile_proc_logger.error('Queue read error', e, stacktrace)
+                continue
+            if msg_handles:
+                return queue_id, msg_handles
+        return None, ()
+
+    def close(self):
+        pass
+
+
+class QueueShare(object):
+
+    """
+    How a queue shares the reads with the others
+
+    latency_target is in seconds, and None means the queue is never aged.
+    """
+
+    def __init__(self, weight=1, latency_target=None):
+        assert weight > 0, 'Invalid queue weight: %s' % weight
+        self.weight = weight
+        self.latency_target = latency_target
+
+
+class _QueueState(object):
+
+    def __init__(self, queue_id, tile_queue, share):
+        self.queue_id = queue_id
+        self.tile_queue = tile_queue
+        self.share = share
+        self.virtual_time = 0.0
+        # the batch read and waiting to be scheduled, and the time its oldest
+        # message was sent.
+        self.msg_handles = None
+        self.oldest_time = None
+
+
+def _oldest_sent_time(msg_handles, read_time):
+    # queues which don't say when a message was sent only give a lower bound
+    # on its age, from when it was read.
+    oldest_time = read_time
+    for msg_handle in msg_handles:
+        if msg_handle.metadata:
+            timestamp = msg_handle.metadata.get('timestamp')
+            if timestamp is not None:
+                oldest_time = min(oldest_time, timestamp / 1000.0)
+    return oldest_time
+
+
+class FairQueueScheduler(object):
+
+    """
+    Shares the reads between the queues in proportion to their weights
+
+    Each queue is read by its own thread, so that a long poll of an empty
+    queue doesn't hold up the others, and holds at most one batch of messages
+    until it's scheduled. Note that the visibility timeout of a held batch is
+    already running.
+
+    Of the queues with a batch waiting, the one which has been given the
+    fewest messages for its weight is chosen, as in weighted fair queueing,
+    with ties going to the higher priority queue. A queue which has been idle
+    doesn't bank credit for later, and restarts level with the others.
+
+    Aging overrides the weights: if the oldest message waiting in any queue,
+    by its SentTimestamp where the queue gives one, is past the queue's
+    latency target, then the queue furthest past its target is chosen.
+    """
+
+    def __init__(self, queue_mapper, tile_proc_logger, shares=(),
+                 read_wait_seconds=1, empty_wait_seconds=0.1):
+        self.queue_mapper = queue_mapper
+        self.tile_proc_logger = tile_proc_logger
+        self.read_wait_seconds = read_wait_seconds
+        self.empty_wait_seconds = empty_wait_seconds
+        # shares are given in queue priority order
+        self.states = []
+        for i, (queue_id, tile_queue) in enumerate(
+                queue_mapper.queues_in_priority_order()):
+            share = shares[i] if i < len(shares) else None
+            self.states.append(
+                _QueueState(queue_id, tile_queue, share or QueueShare()))
+        self.virtual_time = 0.0
+        self.cond = threading.Condition()
+        self.stop = threading.Event()
+        self.threads = None
+
+    def _start(self):
+        # the threads are started on first use, so that the scheduler can be
+        # made before the worker processes are forked.
+        if self.threads is not None:
+            return
+        self.threads = []
+        for state in self.states:
+            thread = threading.Thread(target=self._read_queue, args=(state,))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _read_queue(self, state):
+        while not self.stop.is_set():
+            with self.cond:
+                while state.msg_handles is not None and \
+                        not self.stop.is_set():
+                    self.cond.wait(self.read_wait_seconds)
+            if self.stop.is_set():
+                break
+
+            try:
+                msg_handles = state.tile_queue.read()
+            except Exception as e:
+                stacktrace = format_stacktrace_one_line()
+                self.tile_proc_logger.error('Queue read error', e, stacktrace)
+                self.stop.wait(self.empty_wait_seconds)
+                continue
+            if not msg_handles:
+                self.stop.wait(self.empty_wait_seconds)
+                continue
+
+            with self.cond:
+                state.msg_handles = msg_handles
+                state.oldest_time = _oldest_sent_time(msg_handles, time.time())
+                state.virtual_time = max(state.virtual_time, self.virtual_time)
+                self.cond.notify_all()
+
+    def _choose(self, now):
+        ready = [state for state in self.states
+                 if state.msg_handles is not None]
+        if not ready:
+            return None
+
+        overdue = []
+        for state in ready:
+            latency_target = state.share.latency_target
+            if latency_target:
+                lateness = (now - state.oldest_time) / float(latency_target)
+                if lateness > 1:
+                    overdue.append((lateness, state))
+        if overdue:
+            return max(overdue, key=itemgetter(0))[1]
+
+        return min(ready, key=attrgetter('virtual_time'))
+
+    def read(self):
+        """
+        return the queue_id and message handles of the next batch, waiting up
+        to read_wait_seconds for one
+        """
+        self._start()
+        deadline = time.time() + self.read_wait_seconds
+        with self.cond:
+            while True:
+                state = self._choose(time.time())
+                if state is not None:
+                    break
+                wait_seconds = deadline - time.time()
+                if wait_seconds <= 0 or self.stop.is_set():
+                    return None, ()
+                self.cond.wait(wait_seconds)
+
+            msg_handles = state.msg_handles
+            state.msg_handles = None
+            self.virtual_time = state.virtual_time
+            state.virtual_time += len(msg_handles) / float(state.share.weight)
+            self.cond.notify_all()
+
+        return state.queue_id, msg_handles
+
+    def close(self):
+        """stop reading, waiting for any reads in progress to finish"""
+        self.stop.set()
+        with self.cond:
+            self.cond.notify_all()
+        for thread in self.threads or ():
+            thread.join()
+
+
+def make_queue_scheduler(yml, queue_mapper, tile_proc_logger):
+    yml = yml or {}
+    scheduler_type = yml.get('type', 'priority')
+    if scheduler_type == 'priority':
+        return PriorityQueueScheduler(queue_mapper, tile_proc_logger)
+    elif scheduler_type == 'fair':
+        shares = []
+        for share_yml in yml.get('queues') or ():
+            share_yml = share_yml or {}
+            shares.append(QueueShare(
+                share_yml.get('weight', 1), share_yml.get('latency-target')))
+        return FairQueueScheduler(
+            queue_mapper, tile_proc_logger, shares,
+            yml.get('read-wait-seconds', 1))
+    else:
+        assert 0, 'Unknown queue scheduler type: %s' % scheduler_type
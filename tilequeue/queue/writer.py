@@ -22,11 +22,14 @@ class InFlightCounter(object):
 class QueueWriter(object):
 
     def __init__(self, queue_mapper, msg_marshaller, inflight_mgr,
-                 enqueue_batch_size):
+                 enqueue_batch_size, order_fn=None):
         self.queue_mapper = queue_mapper
         self.msg_marshaller = msg_marshaller
         self.inflight_mgr = inflight_mgr
         self.enqueue_batch_size = enqueue_batch_size
+        # optionally reorders the coord groups before they're sent, eg along
+        # a space-filling curve.
+        self.order_fn = order_fn
 
     def _enqueue_batch(self, queue_id, coords_chunks):
         queue = self.queue_mapper.get_queue(queue_id)
@@ -44,6 +47,8 @@ class QueueWriter(object):
         inflight_ctr = InFlightCounter(self.inflight_mgr)
         coords = inflight_ctr.filter(coords)
         coord_groups = self.queue_mapper.group(coords)
+        if self.order_fn is not None:
+            coord_groups = self.order_fn(coord_groups)
 
         # buffer the coords to send out per queue
         queue_send_buffer = defaultdict(list)
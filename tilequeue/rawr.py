@@ -1,7 +1,10 @@
+import threading
 import zipfile
 from collections import defaultdict
 from collections import namedtuple
+from collections import OrderedDict
 from contextlib import closing
+from contextlib import contextmanager
 from cStringIO import StringIO
 from itertools import imap
 from time import gmtime
@@ -25,6 +28,10 @@ from tilequeue.utils import grouper
 from tilequeue.utils import time_block
 
 
+# how long blocking waits in the rawr pipeline last before checking again
+timeout_seconds = 5
+
+
 class SqsQueue(object):
 
     def __init__(self, sqs_client, queue_url, recv_wait_time_seconds):
@@ -141,13 +148,15 @@ class RawrEnqueuer(object):
 
     def __init__(
             self, rawr_queue, toi_intersector, msg_marshaller, group_by_zoom,
-            logger, stats_handler):
+            logger, stats_handler, locality_curve=None):
         self.rawr_queue = rawr_queue
         self.toi_intersector = toi_intersector
         self.msg_marshaller = msg_marshaller
         self.group_by_zoom = group_by_zoom
         self.logger = logger
         self.stats_handler = stats_handler
+        # optionally send the groups in order along a space-filling curve
+        self.locality_curve = locality_curve
 
     def __call__(self, coords):
         # this will produce the intersected list of coordinates with the toi,
@@ -167,9 +176,18 @@ class RawrEnqueuer(object):
                 coord_int = coord_marshall_int(coord)
                 low_zoom_coord_ints.add(coord_int)
 
+        parent_coord_ints = grouped_by_zoom.keys()
+        if self.locality_curve:
+            from tilequeue.locality import locality_key_fn
+            locality_key = locality_key_fn(self.locality_curve)
+            parent_coord_ints.sort(
+                key=lambda coord_int: locality_key(
+                    coord_unmarshall_int(coord_int)))
+
         n_coords = 0
         payloads = []
-        for _, coords in grouped_by_zoom.iteritems():
+        for parent_coord_int in parent_coord_ints:
+            coords = grouped_by_zoom[parent_coord_int]
             payload = self.msg_marshaller.marshall(coords)
             payloads.append(payload)
             n_coords += len(coords)
@@ -401,6 +419,10 @@ class RawrAllWithParentsIntersector(object):
         return coords, metrics, timing
 
 
+RawrJob = namedtuple(
+    'RawrJob', 'msg_handle coords parent rawr_tile_coord timing')
+
+
 class RawrTileGenerationPipeline(object):
 
     """Entry point for rawr process command"""
@@ -426,108 +448,249 @@ class RawrTileGenerationPipeline(object):
         atexit.register(self._atexit_log)
 
         while True:
-            timing = {}
-
-            try:
-                # NOTE: it's ok if reading from the queue takes a long time
-                with time_block(timing, 'queue_read'):
-                    msg_handle = self.rawr_queue.read()
-            except Exception as e:
-                self.log_exception(e, 'queue read')
+            job = self.read_job()
+            if job is None:
                 continue
 
-            if not msg_handle:
-                # this gets triggered when no messages are returned
-                continue
+            if job.rawr_tile_coord is not None:
+                if not self.generate(job):
+                    continue
 
-            try:
-                coords = self.msg_marshaller.unmarshall(msg_handle.payload)
-            except Exception as e:
-                self.log_exception(e, 'unmarshall payload')
-                continue
+            self.finish(job)
 
-            # split coordinates into group by zoom and higher and low zoom
-            # the message payload is either coordinates that are at group by
-            # zoom and higher, or all below the group by zoom
-            is_low_zoom = False
-            did_rawr_tile_gen = False
-            for coord in coords:
-                if coord.zoom < self.group_by_zoom:
-                    is_low_zoom = True
-                else:
-                    assert not is_low_zoom, \
-                        'Mix of low/high zoom coords in payload'
-
-            # check if we need to generate the rawr tile
-            # proceed directly to enqueueing the coordinates if not
-            if not is_low_zoom:
-                did_rawr_tile_gen = True
-                try:
-                    parent = common_parent(coords, self.group_by_zoom)
-                except Exception as e:
-                    self.log_exception(e, 'find parent')
-                    continue
+    def read_job(self):
+        """
+        Read the next message from the queue and unpack it into a job
 
-                try:
-                    rawr_tile_coord = convert_coord_object(parent)
-                except Exception as e:
-                    self.log_exception(e, 'convert coord', parent)
-                    continue
+        Returns None if there was no message, or if it couldn't be unpacked.
+        The job's rawr_tile_coord is None when the message contains low zoom
+        coordinates, which don't need a rawr tile generated.
+        """
+        timing = {}
 
-                try:
-                    rawr_gen_timing = {}
-                    with time_block(rawr_gen_timing, 'total'):
-                        # grab connection
-                        with self.conn_ctx() as conn:
-                            # commit transaction
-                            with conn as conn:
-                                # cleanup cursor resources
-                                with conn.cursor() as cur:
-                                    table_reader = TableReader(cur)
-
-                                    rawr_gen_specific_timing = self.rawr_gen(
-                                        table_reader, rawr_tile_coord)
-
-                    rawr_gen_timing.update(rawr_gen_specific_timing)
-                    timing['rawr_gen'] = rawr_gen_timing
+        try:
+            # NOTE: it's ok if reading from the queue takes a long time
+            with time_block(timing, 'queue_read'):
+                msg_handle = self.rawr_queue.read()
+        except Exception as e:
+            self.log_exception(e, 'queue read')
+            return None
 
-                except Exception as e:
-                    self.log_exception(e, 'rawr tile gen', parent)
-                    continue
+        if not msg_handle:
+            # this gets triggered when no messages are returned
+            return None
 
-            try:
-                with time_block(timing, 'queue_write'):
-                    n_enqueued, n_inflight = \
-                        self.queue_writer.enqueue_batch(coords)
-            except Exception as e:
-                self.log_exception(e, 'queue write', parent)
-                continue
+        try:
+            coords = self.msg_marshaller.unmarshall(msg_handle.payload)
+        except Exception as e:
+            self.log_exception(e, 'unmarshall payload')
+            return None
 
+        # split coordinates into group by zoom and higher and low zoom
+        # the message payload is either coordinates that are at group by
+        # zoom and higher, or all below the group by zoom
+        is_low_zoom = False
+        for coord in coords:
+            if coord.zoom < self.group_by_zoom:
+                is_low_zoom = True
+            else:
+                assert not is_low_zoom, \
+                    'Mix of low/high zoom coords in payload'
+
+        # check if we need to generate the rawr tile
+        # proceed directly to enqueueing the coordinates if not
+        parent = None
+        rawr_tile_coord = None
+        if not is_low_zoom:
             try:
-                with time_block(timing, 'queue_done'):
-                    self.rawr_queue.done(msg_handle)
+                parent = common_parent(coords, self.group_by_zoom)
             except Exception as e:
-                self.log_exception(e, 'queue done', parent)
-                continue
+                self.log_exception(e, 'find parent')
+                return None
 
             try:
-                self.rawr_proc_logger.processed(
-                    n_enqueued, n_inflight, did_rawr_tile_gen, timing, parent)
+                rawr_tile_coord = convert_coord_object(parent)
             except Exception as e:
-                self.log_exception(e, 'log', parent)
-                continue
+                self.log_exception(e, 'convert coord', parent)
+                return None
 
-            try:
-                self.stats_handler(
-                    n_enqueued, n_inflight, did_rawr_tile_gen, timing)
-            except Exception as e:
-                self.log_exception(e, 'stats', parent)
+        return RawrJob(msg_handle, coords, parent, rawr_tile_coord, timing)
+
+    def generate(self, job):
+        """generate the rawr tile for the job, returning whether it worked"""
+        try:
+            rawr_gen_timing = {}
+            with time_block(rawr_gen_timing, 'total'):
+                # grab connection
+                with self.conn_ctx() as conn:
+                    # commit transaction
+                    with conn as conn:
+                        # cleanup cursor resources
+                        with conn.cursor() as cur:
+                            table_reader = TableReader(cur)
+
+                            rawr_gen_specific_timing = self.rawr_gen(
+                                table_reader, job.rawr_tile_coord)
+
+            rawr_gen_timing.update(rawr_gen_specific_timing)
+            job.timing['rawr_gen'] = rawr_gen_timing
+
+        except Exception as e:
+            self.log_exception(e, 'rawr tile gen', job.parent)
+            return False
+
+        return True
+
+    def finish(self, job):
+        """enqueue the job's coordinates and acknowledge its message"""
+        timing = job.timing
+        parent = job.parent
+        did_rawr_tile_gen = job.rawr_tile_coord is not None
+
+        try:
+            with time_block(timing, 'queue_write'):
+                n_enqueued, n_inflight = \
+                    self.queue_writer.enqueue_batch(job.coords)
+        except Exception as e:
+            self.log_exception(e, 'queue write', parent)
+            return
+
+        try:
+            with time_block(timing, 'queue_done'):
+                self.rawr_queue.done(job.msg_handle)
+        except Exception as e:
+            self.log_exception(e, 'queue done', parent)
+            return
+
+        try:
+            self.rawr_proc_logger.processed(
+                n_enqueued, n_inflight, did_rawr_tile_gen, timing, parent)
+        except Exception as e:
+            self.log_exception(e, 'log', parent)
+            return
+
+        try:
+            self.stats_handler(
+                n_enqueued, n_inflight, did_rawr_tile_gen, timing)
+        except Exception as e:
+            self.log_exception(e, 'stats', parent)
 
     def log_exception(self, exception, msg, parent_coord=None):
         stacktrace = format_stacktrace_one_line()
         self.rawr_proc_logger.error(msg, exception, stacktrace, parent_coord)
 
 
+class ConcurrentRawrTileGenerationPipeline(RawrTileGenerationPipeline):
+
+    """
+    Rawr process pipeline which generates several tiles at once
+
+    A reader thread reads messages ahead of the workers, up to `prefetch_size`
+    of them. Each of the `n_workers` threads generates a rawr tile at a time,
+    using a connection from `conn_ctx`, which should be shared between them,
+    e.g. a RawrConnectionPool. If the generator writes to a RawrAsyncSink,
+    then a worker moves on to the next tile as soon as the previous one has
+    been formatted, and the upload is waited on before the coordinates are
+    enqueued and the message acknowledged. Enqueueing and acknowledging
+    happens on the calling thread.
+    """
+
+    def __init__(
+            self, rawr_queue, msg_marshaller, group_by_zoom, rawr_gen,
+            queue_writer, stats_handler, rawr_proc_logger, conn_ctx,
+            n_workers, prefetch_size, async_sink=None):
+        super(ConcurrentRawrTileGenerationPipeline, self).__init__(
+            rawr_queue, msg_marshaller, group_by_zoom, rawr_gen,
+            queue_writer, stats_handler, rawr_proc_logger, conn_ctx)
+        self.n_workers = n_workers
+        self.prefetch_size = prefetch_size
+        self.async_sink = async_sink
+
+    def _read_jobs(self, job_queue):
+        try:
+            while True:
+                job = self.read_job()
+                if job is not None:
+                    job_queue.put(job)
+        except SystemExit as e:
+            # the file backed queue exits when it runs out of jobs. that only
+            # stops this thread, so pass it along once all the work is done.
+            self.exit_exception = e
+        finally:
+            for _ in xrange(self.n_workers):
+                job_queue.put(None)
+
+    def _generate_jobs(self, job_queue, done_queue):
+        while True:
+            job = job_queue.get()
+            if job is None:
+                done_queue.put(None)
+                break
+
+            pending_upload = None
+            if job.rawr_tile_coord is not None:
+                ok = self.generate(job)
+                if self.async_sink:
+                    pending_upload = self.async_sink.take_pending()
+                if not ok:
+                    continue
+
+            done_queue.put((job, pending_upload))
+
+    def __call__(self):
+        self.rawr_proc_logger.lifecycle('Processing started')
+        import atexit
+        atexit.register(self._atexit_log)
+
+        from Queue import Empty
+        from Queue import Queue
+        from threading import Thread
+
+        self.exit_exception = None
+        job_queue = Queue(self.prefetch_size)
+        done_queue = Queue(self.n_workers)
+
+        threads = [Thread(target=self._read_jobs, args=(job_queue,))]
+        for _ in xrange(self.n_workers):
+            threads.append(Thread(
+                target=self._generate_jobs, args=(job_queue, done_queue)))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        # in python 2, blocking without a timeout can't be interrupted by
+        # signals, so the waits here poll.
+        n_workers_running = self.n_workers
+        while n_workers_running > 0:
+            try:
+                item = done_queue.get(timeout=timeout_seconds)
+            except Empty:
+                continue
+            if item is None:
+                n_workers_running -= 1
+                continue
+
+            job, pending_upload = item
+            if pending_upload is not None:
+                try:
+                    with time_block(job.timing, 'upload_wait'):
+                        while not pending_upload.ready():
+                            pending_upload.wait(timeout_seconds)
+                        upload_timing = pending_upload.get()
+                except Exception as e:
+                    self.log_exception(e, 'rawr tile upload', job.parent)
+                    continue
+                job.timing['rawr_gen'].update(upload_timing)
+
+            self.finish(job)
+
+        for thread in threads:
+            thread.join()
+
+        if self.exit_exception is not None:
+            raise self.exit_exception
+
+
 def make_rawr_zip_payload(rawr_tile, date_time=None):
     """make a zip file from the rawr tile formatted data"""
     if date_time is None:
@@ -565,10 +728,10 @@ def unpack_rawr_zip_payload(table_sources, payload):
 
 def make_rawr_enqueuer(
         rawr_queue, toi_intersector, msg_marshaller, group_by_zoom, logger,
-        stats_handler):
+        stats_handler, locality_curve=None):
     return RawrEnqueuer(
         rawr_queue, toi_intersector, msg_marshaller, group_by_zoom, logger,
-        stats_handler)
+        stats_handler, locality_curve)
 
 
 class RawrS3Sink(object):
@@ -619,6 +782,86 @@ class RawrStoreSink(object):
         self.store.write_tile(payload, coord, format)
 
 
+class RawrAsyncSink(object):
+
+    """
+    Rawr sink which writes to another sink in the background
+
+    Writes are handed to `io_pool`, so the caller can get on with generating
+    the next tile. The pending write for the last tile each thread generated
+    can be picked up with `take_pending`, and its `get` method returns the
+    upload timing, or raises if the write failed.
+    """
+
+    def __init__(self, sink, io_pool):
+        self.sink = sink
+        self.io_pool = io_pool
+        self.local = threading.local()
+
+    def _write(self, rawr_tile):
+        timing = {}
+        with time_block(timing, 'upload'):
+            self.sink(rawr_tile)
+        return timing
+
+    def __call__(self, rawr_tile):
+        self.local.pending = self.io_pool.apply_async(
+            self._write, (rawr_tile,))
+
+    def take_pending(self):
+        pending = getattr(self.local, 'pending', None)
+        self.local.pending = None
+        return pending
+
+
+class RawrConnectionPool(object):
+
+    """
+    Share database connections between rawr generation workers
+
+    Has the same interface as the connection context manager it wraps, but
+    keeps up to `max_idle` connections open between uses instead of
+    connecting for every tile. A connection that was in use when an
+    exception was raised is closed rather than reused.
+    """
+
+    def __init__(self, conn_ctx, max_idle):
+        self.conn_ctx = conn_ctx
+        self.max_idle = max_idle
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def _acquire(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        ctx = self.conn_ctx()
+        conn = ctx.__enter__()
+        return ctx, conn
+
+    def _release(self, ctx_conn, reuse):
+        ctx, conn = ctx_conn
+        if reuse and not getattr(conn, 'closed', False):
+            with self.lock:
+                if len(self.idle) < self.max_idle:
+                    self.idle.append(ctx_conn)
+                    return
+        try:
+            ctx.__exit__(None, None, None)
+        except Exception:
+            pass
+
+    @contextmanager
+    def __call__(self):
+        ctx_conn = self._acquire()
+        try:
+            yield ctx_conn[1]
+        except Exception:
+            self._release(ctx_conn, reuse=False)
+            raise
+        self._release(ctx_conn, reuse=True)
+
+
 # implement the "get_table" interface, but always return an empty list. this
 # allows us to fake an empty tile that might not be backed by any real data.
 def _empty_table(table_name):
@@ -639,39 +882,77 @@ class RawrS3Source(object):
         self.tile_key_gen = tile_key_gen
         self.allow_missing_tiles = allow_missing_tiles
 
-    def _get_object(self, tile):
+    def _get_object(self, tile, etag=None):
         coord = unconvert_coord_object(tile)
         key = self.tile_key_gen(self.prefix, coord, self.extension)
+        get_options = dict(
+            Bucket=self.bucket,
+            Key=key,
+        )
+        if etag:
+            get_options['IfNoneMatch'] = etag
         try:
-            response = self.s3_client.get_object(
-                Bucket=self.bucket,
-                Key=key,
-            )
+            response = self.s3_client.get_object(**get_options)
         except Exception, e:
-            # if we allow missing tiles, then translate a 404 exception into a
-            # value response. this is useful for local or dev environments
-            # where we might not have a global build, but don't want the lack
-            # of RAWR tiles to kill jobs.
-            if self.allow_missing_tiles and isinstance(e, ClientError):
-                if e.response['ResponseMetadata']['HTTPStatusCode'] == 404:
+            if isinstance(e, ClientError):
+                status_code = e.response['ResponseMetadata']['HTTPStatusCode']
+                # boto3 client treats 304 responses as exceptions
+                if etag and status_code == 304:
+                    return e.response
+                # if we allow missing tiles, then translate a 404 exception
+                # into a value response. this is useful for local or dev
+                # environments where we might not have a global build, but
+                # don't want the lack of RAWR tiles to kill jobs.
+                if self.allow_missing_tiles and status_code == 404:
                     return None
             raise
 
         return response
 
-    def __call__(self, tile):
+    def read_payload(self, tile):
+        """read the zip payload for tile, or None if it's allowed missing"""
         # throws an exception if the object is missing - RAWR tiles
         response = self._get_object(tile)
 
         if response is None:
-            return _empty_table
+            return None
 
         # check that the response isn't a delete marker.
         assert 'DeleteMarker' not in response
 
         with closing(response['Body']) as body_fp:
             body = body_fp.read()
-        return unpack_rawr_zip_payload(self.table_sources, body)
+        return body
+
+    def read_payload_if_changed(self, tile, etag):
+        """
+        Read the zip payload for tile, unless its ETag still matches `etag`
+
+        Returns None if the tile hasn't changed, otherwise a tuple of the
+        payload and its ETag.
+        """
+        response = self._get_object(tile, etag)
+
+        if response is None:
+            return None, None
+
+        if response['ResponseMetadata']['HTTPStatusCode'] == 304:
+            return None
+
+        assert 'DeleteMarker' not in response
+
+        with closing(response['Body']) as body_fp:
+            body = body_fp.read()
+        return body, response.get('ETag')
+
+    def unpack(self, payload):
+        if payload is None:
+            return _empty_table
+        return unpack_rawr_zip_payload(self.table_sources, payload)
+
+    def __call__(self, tile):
+        payload = self.read_payload(tile)
+        return self.unpack(payload)
 
 
 class RawrStoreSource(object):
@@ -688,10 +969,196 @@ class RawrStoreSource(object):
         payload = self.store.read_tile(coord, format)
         return payload
 
-    def __call__(self, tile):
-        payload = self._get_object(tile)
+    def read_payload(self, tile):
+        return self._get_object(tile)
+
+    def read_payload_if_changed(self, tile, etag):
+        coord = unconvert_coord_object(tile)
+        return self.store.read_tile_if_changed(coord, zip_format, etag)
+
+    def unpack(self, payload):
         return unpack_rawr_zip_payload(self.table_sources, payload)
 
+    def __call__(self, tile):
+        payload = self.read_payload(tile)
+        return self.unpack(payload)
+
+
+class RawrCachedSource(object):
+
+    """
+    Rawr source which reads through a local DiskCache.
+
+    Cached payloads are validated against the wrapped source on every read,
+    so it must provide `read_payload_if_changed`, as RawrS3Source does.
+    """
+
+    def __init__(self, source, cache):
+        self.source = source
+        self.cache = cache
+
+    def read_payload(self, tile):
+        def read_if_changed(etag):
+            return self.source.read_payload_if_changed(tile, etag)
+        key = '%d/%d/%d' % (tile.z, tile.x, tile.y)
+        return self.cache.read(key, read_if_changed)
+
+    def unpack(self, payload):
+        return self.source.unpack(payload)
+
+    def __call__(self, tile):
+        payload = self.read_payload(tile)
+        return self.unpack(payload)
+
+
+class RawrPrefetcher(object):
+
+    """
+    Read RAWR tiles from a source ahead of when they are needed
+
+    Calling `prefetch` starts reading the tile in the background on
+    `io_pool`. A later call for the same tile takes the result, waiting for
+    it if it hasn't arrived yet, and tiles which weren't prefetched, or
+    failed to be, are read from the source directly. The source must provide
+    `read_payload` and `unpack`, like RawrS3Source and RawrStoreSource.
+
+    Tiles are unpacked in the background too, unless `unpack_in_background`
+    is false, when the payloads are kept for callers of `read_payload` to
+    unpack themselves, eg in the processors with index-in-processors.
+
+    The payloads held, along with those still being read, are kept within
+    `max_bytes`. Reads in progress are counted at the mean size of the
+    payloads read so far, and no more than `max_in_flight` are started at
+    once. No new prefetches are started while over the budget, and if a
+    download turns out bigger than expected, the newest unclaimed payloads
+    are dropped, as they're the ones which will be needed last.
+    """
+
+    class Prefetch(object):
+        def __init__(self):
+            self.result = None
+            # set once the payload has been read
+            self.n_bytes = None
+
+    def __init__(self, source, io_pool, max_bytes, max_in_flight=4,
+                 unpack_in_background=True):
+        self.source = source
+        self.io_pool = io_pool
+        self.max_bytes = max_bytes
+        self.max_in_flight = max_in_flight
+        self.unpack_in_background = unpack_in_background
+        self.lock = threading.Lock()
+        self.prefetches = OrderedDict()
+        self.n_bytes = 0
+        self.n_in_flight = 0
+        # to estimate the size of payloads being read
+        self.n_read = 0
+        self.n_read_bytes = 0
+
+    def _key(self, tile):
+        return tile.z, tile.x, tile.y
+
+    def _read(self, key, tile, prefetch):
+        try:
+            payload = self.source.read_payload(tile)
+            result = payload
+            if self.unpack_in_background:
+                result = self.source.unpack(payload)
+        except Exception:
+            with self.lock:
+                self.n_in_flight -= 1
+            raise
+
+        with self.lock:
+            self.n_in_flight -= 1
+            n_bytes = len(payload) if payload else 0
+            self.n_read += 1
+            self.n_read_bytes += n_bytes
+            # only account for the payload if it's still waiting to be
+            # claimed, otherwise it's already been handed over.
+            if self.prefetches.get(key) is prefetch:
+                prefetch.n_bytes = n_bytes
+                self.n_bytes += n_bytes
+                self._evict()
+
+        return result
+
+    def _reserved_bytes(self):
+        mean_bytes = 0
+        if self.n_read:
+            mean_bytes = self.n_read_bytes / self.n_read
+        return self.n_bytes + self.n_in_flight * mean_bytes
+
+    def _evict(self):
+        for key in reversed(self.prefetches.keys()):
+            if self.n_bytes <= self.max_bytes:
+                break
+            prefetch = self.prefetches[key]
+            if prefetch.n_bytes is None:
+                continue
+            del self.prefetches[key]
+            self.n_bytes -= prefetch.n_bytes
+
+    def prefetch(self, tile):
+        """
+        start reading the tile in the background, returning whether a read of
+        it is in progress, or False if there's no room for it
+        """
+        key = self._key(tile)
+        with self.lock:
+            if key in self.prefetches:
+                return True
+            if self.n_in_flight >= self.max_in_flight or \
+                    self._reserved_bytes() >= self.max_bytes:
+                return False
+            prefetch = self.Prefetch()
+            self.prefetches[key] = prefetch
+            self.n_in_flight += 1
+            try:
+                prefetch.result = self.io_pool.apply_async(
+                    self._read, (key, tile, prefetch))
+            except Exception:
+                del self.prefetches[key]
+                self.n_in_flight -= 1
+                raise
+        return True
+
+    def _claim(self, tile):
+        key = self._key(tile)
+        with self.lock:
+            prefetch = self.prefetches.pop(key, None)
+            if prefetch is not None and prefetch.n_bytes is not None:
+                self.n_bytes -= prefetch.n_bytes
+        return prefetch
+
+    def read_payload(self, tile):
+        assert not self.unpack_in_background, \
+            'RawrPrefetcher only keeps payloads when not unpacking them'
+        prefetch = self._claim(tile)
+        if prefetch is not None:
+            try:
+                return prefetch.result.get()
+            except Exception:
+                # a failed prefetch is just read again, as if it hadn't been
+                # prefetched, so that the job only fails if that does too.
+                pass
+        return self.source.read_payload(tile)
+
+    def unpack(self, payload):
+        return self.source.unpack(payload)
+
+    def __call__(self, tile):
+        prefetch = self._claim(tile)
+        if prefetch is None:
+            return self.source(tile)
+        try:
+            result = prefetch.result.get()
+        except Exception:
+            return self.source(tile)
+        if not self.unpack_in_background:
+            result = self.unpack(result)
+        return result
+
 
 def make_rawr_queue(name, region, wait_time_secs):
     import boto3
@@ -806,6 +1273,11 @@ def make_rawr_enqueuer_from_cfg(cfg, logger, stats_handler, msg_marshaller,
         else:
             assert 0, 'Invalid rawr intersect type: %s' % intersect_type
 
+    enqueue_order_yaml = cfg.yml.get('enqueue-order') or {}
+    locality_curve = None
+    if enqueue_order_yaml:
+        locality_curve = enqueue_order_yaml.get('curve', 'hilbert')
+
     return make_rawr_enqueuer(
         rawr_queue, rawr_toi_intersector, msg_marshaller, group_by_zoom,
-        logger, stats_handler)
+        logger, stats_handler, locality_curve)
@@ -20,6 +20,8 @@ class TileProcessingStatsHandler(object):
                       coord_proc_data.store_info['stored'])
             pipe.incr('process.storage.skipped',
                       coord_proc_data.store_info['not_stored'])
+            pipe.incr('process.storage.unchanged',
+                      coord_proc_data.store_info.get('unchanged', 0))
 
     def processed_pyramid(self, parent_tile,
                           start_time, stop_time):
@@ -32,6 +34,25 @@ class TileProcessingStatsHandler(object):
     def proc_error(self):
         self.stats.incr('process.errors.process', 1)
 
+    def coalesced_coord(self):
+        self.stats.incr('process.coalesced', 1)
+
+    def queue_budget(self, queue_name, budget):
+        prefix = 'process.queue.%s' % queue_name
+        with self.stats.pipeline() as pipe:
+            pipe.gauge(prefix + '.bytes', budget.used())
+            pipe.gauge(prefix + '.utilization',
+                       int(budget.utilization() * 100))
+
+    def io_pool(self, pool_name, pool_stats):
+        prefix = 'process.io.%s' % pool_name
+        with self.stats.pipeline() as pipe:
+            pipe.gauge(prefix + '.pending', pool_stats.n_pending)
+            pipe.gauge(prefix + '.utilization',
+                       int(pool_stats.utilization * 100))
+            pipe.timing(prefix + '.wait',
+                        int(pool_stats.wait_seconds * 1000))
+
 
 def emit_time_dict(pipe, timing, prefix):
     for timing_label, value in timing.items():
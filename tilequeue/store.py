@@ -3,12 +3,14 @@ import json
 import md5
 import os
 import random
+import sys
 import threading
 import time
 from cStringIO import StringIO
 from urllib import urlencode
 
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 from builtins import range
 from enum import Enum
@@ -17,9 +19,24 @@ from ModestMaps.Core import Coordinate
 
 from tilequeue.format import zip_format
 from tilequeue.metatile import metatiles_are_equal
+from tilequeue.tile import serialize_coord
 from tilequeue.utils import AwsSessionHelper
 
 
+class TileChangedError(Exception):
+    """
+    Raised when a tile is read expecting a given ETag, but it has changed.
+    """
+    pass
+
+
+class TileNotModifiedError(Exception):
+    """
+    Raised when a tile is read unless it has a given ETag, and it still does.
+    """
+    pass
+
+
 def calc_hash(s):
     m = md5.new()
     m.update(s)
@@ -228,6 +245,93 @@ class S3(object):
 
         return None
 
+    def read_tile_if_changed(self, coord, format, etag):
+        """
+        Read the tile, unless its ETag still matches `etag`
+
+        Returns None if the tile hasn't changed, otherwise a tuple of the tile
+        data, or None if the tile is missing, and its ETag.
+        """
+        key_name = self.tile_key_gen(
+            self.date_prefix, coord, format.extension)
+
+        get_options = dict(
+            Bucket=self.bucket_name,
+            Key=key_name,
+        )
+        if etag:
+            get_options['IfNoneMatch'] = etag
+        try:
+            resp = self.s3_client.get_object(**get_options)
+        except ClientError as e:
+            # boto3 client treats 304 responses as exceptions
+            code = e.response['Error']['Code']
+            if code == '304':
+                return None
+            if code not in ('404', 'NoSuchKey'):
+                raise
+            return None, None
+
+        body = resp['Body']
+        try:
+            tile_data = body.read()
+        finally:
+            body.close()
+        return tile_data, resp.get('ETag')
+
+    def read_tile_range(self, coord, format, offset, length=None, etag=None,
+                        unless_etag=None):
+        """
+        Read part of a tile. A negative offset reads the last -offset bytes,
+        otherwise length bytes are read from offset. If etag is given, the
+        read fails with TileChangedError unless the tile still has that ETag.
+        If unless_etag is given, the read fails with TileNotModifiedError if
+        the tile still has that ETag.
+
+        Returns a tuple of the data read, the tile's ETag and its total size,
+        or None if the tile is missing.
+        """
+        key_name = self.tile_key_gen(
+            self.date_prefix, coord, format.extension)
+
+        if offset < 0:
+            byte_range = 'bytes=%d' % offset
+        else:
+            byte_range = 'bytes=%d-%d' % (offset, offset + length - 1)
+        get_options = dict(
+            Bucket=self.bucket_name,
+            Key=key_name,
+            Range=byte_range,
+        )
+        if etag:
+            get_options['IfMatch'] = etag
+        if unless_etag:
+            get_options['IfNoneMatch'] = unless_etag
+        try:
+            resp = self.s3_client.get_object(**get_options)
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            if code in ('412', 'PreconditionFailed'):
+                raise TileChangedError(key_name)
+            if code == '304':
+                raise TileNotModifiedError(key_name)
+            if code not in ('404', 'NoSuchKey'):
+                raise
+            return None
+
+        body = resp['Body']
+        try:
+            data = body.read()
+        finally:
+            body.close()
+        # the total size is after the slash in "bytes 0-99/1234"
+        content_range = resp.get('ContentRange')
+        if content_range:
+            size = int(content_range.rsplit('/', 1)[1])
+        else:
+            size = len(data)
+        return data, resp.get('ETag'), size
+
     def delete_tiles(self, coords, format):
         key_names = [
             self.tile_key_gen(
@@ -414,6 +518,26 @@ class TileDirectory(object):
         except IOError:
             return None
 
+    def read_tile_range(self, coord, format, offset, length=None, etag=None,
+                        unless_etag=None):
+        file_path = make_file_path(self.base_path, coord, format.extension)
+        try:
+            with open(file_path, 'r') as tile_fp:
+                stat = os.fstat(tile_fp.fileno())
+                # stands in for an ETag, changing whenever the file does
+                file_etag = '%d-%d' % (stat.st_mtime * 1000000, stat.st_size)
+                if etag and etag != file_etag:
+                    raise TileChangedError(file_path)
+                if unless_etag and unless_etag == file_etag:
+                    raise TileNotModifiedError(file_path)
+                if offset < 0:
+                    offset = max(0, stat.st_size + offset)
+                    length = stat.st_size - offset
+                tile_fp.seek(offset)
+                return tile_fp.read(length), file_etag, stat.st_size
+        except IOError:
+            return None
+
     def delete_tiles(self, coords, format):
         delete_count = 0
         for coord in coords:
@@ -462,6 +586,30 @@ class Memory(object):
         return [self.data] if self.data else []
 
 
+class _StoreHealth(object):
+    """
+    How quickly a store has been answering reads, and whether it's failing.
+    """
+
+    # weight of the latest read in the moving average of read times
+    alpha = 0.2
+
+    def __init__(self, retry_interval):
+        self.retry_interval = retry_interval
+        self.read_seconds = 0.0
+        self.failed_until = 0
+
+    def read_ok(self, seconds):
+        self.read_seconds += self.alpha * (seconds - self.read_seconds)
+        self.failed_until = 0
+
+    def read_failed(self):
+        self.failed_until = time.time() + self.retry_interval
+
+    def sort_key(self, now):
+        return (self.failed_until > now, self.read_seconds)
+
+
 class MultiStore(object):
     """
     MultiStore writes to multiple stores for redundancy.
@@ -479,18 +627,148 @@ class MultiStore(object):
 
     There's an optimisation we could make later, by checking the first tile if
     the last doesn't exist and copying it to the other stores if it does.
+
+    Optionally, with `parallel`, the stores are written at the same time, so
+    that a write takes as long as the slowest store rather than all of them
+    added up. Every store is written even if some fail. The write fails if any
+    store failed or, when a `primary` store index is given, only if that store
+    failed, with failures of the other stores being logged. Because the
+    stores aren't written in order, the crash behaviour above doesn't hold.
+
+    With `fastest_read`, tiles are read from the store which has been quickest
+    to answer, falling back to the others if it fails. A failed store is
+    tried last until `retry_interval` seconds have passed. Note that the
+    store read from might have a tile which another store is missing, so
+    `write_tile_if_changed` checks the last store, which is written last, or
+    when writing in parallel, checks and writes each store separately.
     """
 
-    def __init__(self, stores):
+    def __init__(self, stores, parallel=False, primary=None,
+                 fastest_read=False, n_write_workers=None, logger=None,
+                 retry_interval=60):
         assert len(stores) > 0
+        assert primary is None or 0 <= primary < len(stores), \
+            'Invalid primary store: %r' % (primary,)
         self.stores = stores
+        self.parallel = parallel
+        self.primary = primary
+        self.fastest_read = fastest_read
+        self.logger = logger
+        self.health = [_StoreHealth(retry_interval) for store in stores]
+        if n_write_workers is None:
+            n_write_workers = 10 * (len(stores) - 1)
+        self.n_write_workers = max(1, n_write_workers)
+        self.write_pool = None
+        self.write_pool_lock = threading.Lock()
+
+    def _get_write_pool(self):
+        # created when first used, as the store is made before the worker
+        # processes are forked.
+        with self.write_pool_lock:
+            if self.write_pool is None:
+                from multiprocessing.pool import ThreadPool
+                self.write_pool = ThreadPool(self.n_write_workers)
+            return self.write_pool
 
     def write_tile(self, tile_data, coord, format):
-        for store in self.stores:
-            store.write_tile(tile_data, coord, format)
+        if not self.parallel:
+            for store in self.stores:
+                store.write_tile(tile_data, coord, format)
+            return
+
+        self._parallel(
+            lambda store: store.write_tile(tile_data, coord, format),
+            coord, format)
+
+    def write_tile_if_changed(self, tile_data, coord, format):
+        """
+        Write the tile to the stores where it's different or missing,
+        returning whether it was written to any of them.
+        """
+        if not self.parallel:
+            # the last store is written last, so if it has the tile then the
+            # others should too.
+            existing_data = self.stores[-1].read_tile(coord, format)
+            if existing_data and \
+                    tiles_are_equal(existing_data, tile_data, format):
+                return False
+            self.write_tile(tile_data, coord, format)
+            return True
+
+        # a store which failed to write the tile before can be missing it
+        # even though the others have it, so each is checked.
+        results = self._parallel(
+            lambda store: write_tile_if_changed(
+                store, tile_data, coord, format),
+            coord, format)
+        return any(results)
+
+    def _parallel(self, write_fn, coord, format):
+        # the calling thread writes to the last store while the pool writes
+        # to the others. returns the result for each store, or None where it
+        # failed.
+        pool = self._get_write_pool()
+        async_results = [
+            pool.apply_async(write_fn, (store,))
+            for store in self.stores[:-1]]
+        results = [None] * len(self.stores)
+        errors = []
+        try:
+            results[-1] = write_fn(self.stores[-1])
+        except Exception:
+            errors.append((len(self.stores) - 1, sys.exc_info()))
+        for i, async_result in enumerate(async_results):
+            try:
+                results[i] = async_result.get()
+            except Exception:
+                errors.append((i, sys.exc_info()))
+
+        fatal_exc_info = None
+        for i, exc_info in errors:
+            if self.primary is None or i == self.primary:
+                fatal_exc_info = exc_info
+            elif self.logger:
+                self.logger.warning(
+                    'Failed to write %s tile %s to store %d: %s' % (
+                        format.extension, serialize_coord(coord), i,
+                        exc_info[1]))
+        if fatal_exc_info:
+            raise fatal_exc_info[0], fatal_exc_info[1], fatal_exc_info[2]
+        return results
+
+    def _read(self, read_fn):
+        if not self.fastest_read:
+            return read_fn(self.stores[-1])
+
+        now = time.time()
+        order = sorted(range(len(self.stores)),
+                       key=lambda i: self.health[i].sort_key(now))
+        exc_info = None
+        for i in order:
+            start = time.time()
+            try:
+                result = read_fn(self.stores[i])
+            except Exception:
+                exc_info = sys.exc_info()
+                self.health[i].read_failed()
+                continue
+            self.health[i].read_ok(time.time() - start)
+            return result
+        raise exc_info[0], exc_info[1], exc_info[2]
 
     def read_tile(self, coord, format):
-        return self.stores[-1].read_tile(coord, format)
+        return self._read(lambda store: store.read_tile(coord, format))
+
+    def read_tile_if_changed(self, coord, format, etag):
+        return self._read(
+            lambda store: store.read_tile_if_changed(coord, format, etag))
+
+    def read_tile_range(self, coord, format, offset, length=None, etag=None,
+                        unless_etag=None):
+        # an ETag only matches the store it came from, so the parts of a tile
+        # are always read from the same store.
+        return self.stores[-1].read_tile_range(
+            coord, format, offset, length, etag, unless_etag)
 
     def delete_tiles(self, coords, format):
         num = 0
@@ -502,10 +780,72 @@ class MultiStore(object):
         return num
 
     def list_tiles(self, format):
-        return self.stores[-1].list_tiles(self, format)
+        return self.stores[-1].list_tiles(format)
 
 
-def _make_s3_store(cfg_name, constructor):
+class CachedStore(object):
+    """
+    CachedStore reads tiles through a local DiskCache.
+
+    Cached tiles are validated against the wrapped store on every read, so
+    the store must provide `read_tile_if_changed`, as S3 does. Tiles written
+    or deleted through this store are dropped from the cache.
+    """
+
+    def __init__(self, store, cache):
+        self.store = store
+        self.cache = cache
+
+    def _cache_key(self, coord, format):
+        return '%d/%d/%d.%s' % (
+            coord.zoom, coord.column, coord.row, format.extension)
+
+    def write_tile(self, tile_data, coord, format):
+        self.store.write_tile(tile_data, coord, format)
+        self.cache.delete(self._cache_key(coord, format))
+
+    def read_tile(self, coord, format):
+        def read_if_changed(etag):
+            return self.store.read_tile_if_changed(coord, format, etag)
+        return self.cache.read(self._cache_key(coord, format), read_if_changed)
+
+    def read_tile_if_changed(self, coord, format, etag):
+        return self.store.read_tile_if_changed(coord, format, etag)
+
+    def read_tile_range(self, coord, format, offset, length=None, etag=None,
+                        unless_etag=None):
+        return self.store.read_tile_range(
+            coord, format, offset, length, etag, unless_etag)
+
+    def delete_tiles(self, coords, format):
+        for coord in coords:
+            self.cache.delete(self._cache_key(coord, format))
+        return self.store.delete_tiles(coords, format)
+
+    def list_tiles(self, format):
+        return self.store.list_tiles(format)
+
+
+def _make_multi_store(stores, multi_cfg, n_write_workers=None, logger=None):
+    multi_cfg = multi_cfg or {}
+    read = multi_cfg.get('read', 'last')
+    assert read in ('last', 'fastest'), 'Invalid multi store read: %r' % read
+    n_write_workers = multi_cfg.get('write-workers', n_write_workers)
+    if n_write_workers is not None:
+        # the calling thread writes to the last store itself.
+        n_write_workers *= len(stores) - 1
+    return MultiStore(
+        stores,
+        parallel=multi_cfg.get('parallel', False),
+        primary=multi_cfg.get('primary'),
+        fastest_read=(read == 'fastest'),
+        n_write_workers=n_write_workers,
+        logger=logger,
+        retry_interval=multi_cfg.get('retry-interval', 60))
+
+
+def _make_s3_store(cfg_name, constructor, multi_cfg=None,
+                   n_write_workers=None, logger=None):
     # if buckets are given as a list, then write to each of them and read from
     # the last one. this behaviour is captured in MultiStore.
     if isinstance(cfg_name, list):
@@ -514,7 +854,8 @@ def _make_s3_store(cfg_name, constructor):
             s3_store = constructor(bucket)
             s3_stores.append(s3_store)
 
-        s3_store = MultiStore(s3_stores)
+        s3_store = _make_multi_store(
+            s3_stores, multi_cfg, n_write_workers, logger)
 
     else:
         s3_store = constructor(cfg_name)
@@ -527,7 +868,14 @@ def make_s3_store(cfg_name, tile_key_gen,
                   s3_role_session_duration_s=None,
                   reduced_redundancy=False, date_prefix='',
                   delete_retry_interval=60, logger=None,
-                  object_acl='public-read', tags=None):
+                  object_acl='public-read', tags=None,
+                  max_pool_connections=None, multi_cfg=None):
+    # botocore keeps 10 connections by default, which should be at least the
+    # number of threads uploading, or they end up waiting on each other.
+    client_config = None
+    if max_pool_connections:
+        client_config = Config(max_pool_connections=max_pool_connections)
+
     if s3_role_arn:
         # use provided role to access S3
         assert s3_role_session_duration_s, \
@@ -536,10 +884,10 @@ def make_s3_store(cfg_name, tile_key_gen,
                                       s3_role_arn,
                                       'us-east-1',
                                       s3_role_session_duration_s)
-        s3 = aws_helper.get_client('s3')
+        s3 = aws_helper.get_client('s3', config=client_config)
     else:
         # use the credentials created from default config chain to access S3
-        s3 = boto3.client('s3')
+        s3 = boto3.client('s3', config=client_config)
 
     # extract out the construction of the bucket, so that it can be abstracted
     # from the the logic of interpreting the configuration file.
@@ -548,7 +896,8 @@ def make_s3_store(cfg_name, tile_key_gen,
             s3, bucket_name, date_prefix, reduced_redundancy,
             delete_retry_interval, logger, object_acl, tags, tile_key_gen)
 
-    return _make_s3_store(cfg_name, _construct)
+    return _make_s3_store(
+        cfg_name, _construct, multi_cfg, max_pool_connections, logger)
 
 
 def tiles_are_equal(tile_data_1, tile_data_2, fmt):
@@ -574,6 +923,11 @@ def write_tile_if_changed(store, tile_data, coord, format):
     data matches, don't write. Returns whether the tile was written.
     """
 
+    # stores made of others, such as MultiStore, decide which of them to check
+    store_write_if_changed = getattr(store, 'write_tile_if_changed', None)
+    if store_write_if_changed is not None:
+        return store_write_if_changed(tile_data, coord, format)
+
     existing_data = store.read_tile(coord, format)
     if not existing_data or \
        not tiles_are_equal(existing_data, tile_data, format):
@@ -601,11 +955,13 @@ def make_s3_tile_key_generator(yml_cfg):
 def make_store(yml,
                s3_role_arn=None,
                s3_role_session_duration_s=None,
-               logger=None):
+               logger=None,
+               max_pool_connections=None):
     """ Make a store object.
     If the type is S3, optionally a s3_role_arn and s3_role_session_duration_s
     can be provided to explicitly specify which role(and how long)
-    to assume to access the S3 """
+    to assume to access the S3, and max_pool_connections to size the S3
+    client's connection pool to the number of threads using it """
     store_type = yml.get('type')
 
     if store_type == 'directory':
@@ -613,6 +969,14 @@ def make_store(yml,
         name = yml.get('name')
         return make_tile_file_store(path or name)
 
+    elif store_type == 'archive':
+        from tilequeue.archive import make_archive_store
+        return make_archive_store(yml)
+
+    elif store_type == 'mbtiles':
+        from tilequeue.mbtiles import make_mbtiles_store
+        return make_mbtiles_store(yml)
+
     elif store_type == 's3':
         bucket = yml.get('name')
         reduced_redundancy = yml.get('reduced-redundancy')
@@ -622,14 +986,24 @@ def make_store(yml,
         tags = yml.get('tags')
         tile_key_gen = make_s3_tile_key_generator(yml)
 
-        return make_s3_store(
+        store = make_s3_store(
             bucket, tile_key_gen,
             s3_role_arn=s3_role_arn,
             s3_role_session_duration_s=s3_role_session_duration_s,
             reduced_redundancy=reduced_redundancy,
             date_prefix=date_prefix,
             delete_retry_interval=delete_retry_interval, logger=logger,
-            object_acl=object_acl, tags=tags)
+            object_acl=object_acl, tags=tags,
+            max_pool_connections=max_pool_connections,
+            multi_cfg=yml.get('multi'))
+
+        # optionally keep a copy of tiles read from S3 on local disk.
+        cache_yml = yml.get('cache')
+        if cache_yml:
+            from tilequeue.cache import make_disk_cache
+            store = CachedStore(store, make_disk_cache(cache_yml))
+
+        return store
 
     else:
         raise ValueError('Unrecognized store type: `{}`'.format(store_type))
@@ -265,6 +265,50 @@ def coord_unmarshall_int(coord_int):
     return Coordinate(column=column, row=row, zoom=zoom)
 
 
+def hilbert_index(zoom, column, row):
+    """
+    Return the distance along the Hilbert curve through all the tiles at
+    zoom to the tile at column, row. Tiles close together on the curve are
+    close together on the map.
+    """
+    n = 1 << zoom
+    x, y = column, row
+    d = 0
+    s = n >> 1
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        d += s * s * ((3 * rx) ^ ry)
+        # rotate the quadrant, so the curve joins up
+        if ry == 0:
+            if rx == 1:
+                x = n - 1 - x
+                y = n - 1 - y
+            x, y = y, x
+        s >>= 1
+    return d
+
+
+def hilbert_coord(zoom, d):
+    """inverse of hilbert_index, returning the (column, row) at distance d"""
+    n = 1 << zoom
+    x = y = 0
+    s = 1
+    while s < n:
+        rx = 1 & (d >> 1)
+        ry = 1 & (d ^ rx)
+        if ry == 0:
+            if rx == 1:
+                x = s - 1 - x
+                y = s - 1 - y
+            x, y = y, x
+        x += s * rx
+        y += s * ry
+        d >>= 2
+        s <<= 1
+    return x, y
+
+
 # perform an efficient zoom up operation via the integer directly
 def coord_int_zoom_up(coord_int):
     # First we'll update the row/col values both simultaneously by
@@ -319,6 +363,21 @@ def coord_children_subrange(coord, zoom_start, zoom_until):
         children_to_process = next_children
 
 
+def coord_children_preorder(coord, zoom_until):
+    """
+    Yield the descendants of coord down to zoom_until, depth first, so that
+    each coord comes before its own children and after its parent.
+    """
+    assert zoom_until > coord.zoom, 'zoom_until (%r) must be > coord.zoom ' \
+        '(%r)' % (zoom_until, coord)
+    stack = list(reversed(coord_children(coord)))
+    while stack:
+        child = stack.pop()
+        yield child
+        if child.zoom < zoom_until:
+            stack.extend(reversed(coord_children(child)))
+
+
 tolerances = [6378137 * 2 * math.pi / (2 ** (zoom + 8)) for zoom in range(22)]
 
 
@@ -0,0 +1,242 @@
+# decoding of geometries in Tiny Well-Known Binary (TWKB), the compact
+# format that PostGIS returns from ST_AsTWKB. see
+# https://github.com/TWKB/Specification/blob/master/twkb.md
+import math
+
+import shapely.wkb
+from shapely.geometry import GeometryCollection
+from shapely.geometry import LineString
+from shapely.geometry import MultiLineString
+from shapely.geometry import MultiPoint
+from shapely.geometry import MultiPolygon
+from shapely.geometry import Point
+from shapely.geometry import Polygon
+
+from tilequeue.tile import earth_circum
+
+
+POINT = 1
+LINESTRING = 2
+POLYGON = 3
+MULTIPOINT = 4
+MULTILINESTRING = 5
+MULTIPOLYGON = 6
+COLLECTION = 7
+
+# flags in the metadata header byte
+_BBOX = 0x01
+_SIZE = 0x02
+_IDLIST = 0x04
+_EXTENDED_DIMS = 0x08
+_EMPTY = 0x10
+
+_EMPTY_GEOMETRIES = {
+    POINT: Point,
+    LINESTRING: LineString,
+    POLYGON: Polygon,
+    MULTIPOINT: MultiPoint,
+    MULTILINESTRING: MultiLineString,
+    MULTIPOLYGON: MultiPolygon,
+    COLLECTION: GeometryCollection,
+}
+
+# TWKB precision can only be between -8 and 7 decimal digits
+_MIN_PRECISION = -8
+_MAX_PRECISION = 7
+
+
+def twkb_precision(zoom, detail_zooms=0, extent=4096):
+    """
+    Return the TWKB precision, in decimal digits of mercator meters, to
+    encode the geometries queried at zoom with.
+
+    Coordinates are kept to a tenth of a pixel of a tile with the given
+    extent, detail_zooms beyond the query zoom, so that metatiles and tiles
+    which are made from the same query at higher zooms keep their detail.
+    A precision of zero is never used, which keeps the first byte of TWKB
+    distinct from the byte order marker of WKB.
+    """
+    tile_size = earth_circum / (2 ** (zoom + detail_zooms))
+    resolution = tile_size / extent / 10.0
+    precision = int(math.ceil(-math.log10(resolution)))
+    precision = max(_MIN_PRECISION, min(_MAX_PRECISION, precision))
+    if precision == 0:
+        precision = 1
+    return precision
+
+
+class _Reader(object):
+
+    def __init__(self, data):
+        self.data = bytearray(data)
+        self.pos = 0
+
+    def byte(self):
+        value = self.data[self.pos]
+        self.pos += 1
+        return value
+
+    def varint(self):
+        data = self.data
+        pos = self.pos
+        value = 0
+        shift = 0
+        while True:
+            b = data[pos]
+            pos += 1
+            value |= (b & 0x7f) << shift
+            if b < 0x80:
+                break
+            shift += 7
+        self.pos = pos
+        return value
+
+    def svarint(self):
+        value = self.varint()
+        # zigzag decoding
+        return (value >> 1) ^ -(value & 1)
+
+
+class _Decoder(object):
+
+    def __init__(self, reader):
+        self.reader = reader
+
+    def _coords(self, n_points):
+        # coordinates are deltas from the previous point, through all the
+        # parts of the geometry.
+        svarint = self.reader.svarint
+        n_dims = self.n_dims
+        last = self.last
+        coords = []
+        for _ in xrange(n_points):
+            for i in xrange(n_dims):
+                last[i] += svarint()
+            coords.append(tuple(
+                last[i] * self.scales[i] for i in self.output_dims))
+        return coords
+
+    def _line(self):
+        return self._coords(self.reader.varint())
+
+    def _polygon(self):
+        rings = []
+        for _ in xrange(self.reader.varint()):
+            ring = self._line()
+            # rings may have collapsed at a low precision
+            if len(ring) >= 3:
+                rings.append(ring)
+        return rings
+
+    def _skip_idlist(self, has_idlist, n_parts):
+        if has_idlist:
+            for _ in xrange(n_parts):
+                self.reader.svarint()
+
+    def decode(self):
+        reader = self.reader
+        header = reader.byte()
+        geom_type = header & 0x0f
+        precision = (header >> 4 >> 1) ^ -((header >> 4) & 1)
+        metadata = reader.byte()
+
+        has_z = has_m = False
+        z_precision = m_precision = 0
+        if metadata & _EXTENDED_DIMS:
+            dims = reader.byte()
+            has_z = bool(dims & 0x01)
+            has_m = bool(dims & 0x02)
+            z_precision = (dims >> 2) & 0x07
+            m_precision = (dims >> 5) & 0x07
+
+        if metadata & _SIZE:
+            reader.varint()
+
+        if metadata & _EMPTY:
+            return _EMPTY_GEOMETRIES[geom_type]()
+
+        self.n_dims = 2 + has_z + has_m
+        if metadata & _BBOX:
+            for _ in xrange(self.n_dims * 2):
+                reader.svarint()
+
+        xy_scale = 10.0 ** -precision
+        self.scales = [xy_scale, xy_scale]
+        self.output_dims = [0, 1]
+        if has_z:
+            self.scales.append(10.0 ** -z_precision)
+            self.output_dims.append(2)
+        if has_m:
+            # shapely doesn't have measures, so they're dropped
+            self.scales.append(10.0 ** -m_precision)
+        self.last = [0] * self.n_dims
+
+        has_idlist = metadata & _IDLIST
+        if geom_type == POINT:
+            return Point(self._coords(1)[0])
+
+        elif geom_type == LINESTRING:
+            coords = self._line()
+            if len(coords) < 2:
+                return LineString()
+            return LineString(coords)
+
+        elif geom_type == POLYGON:
+            rings = self._polygon()
+            if not rings:
+                return Polygon()
+            return Polygon(rings[0], rings[1:])
+
+        elif geom_type == MULTIPOINT:
+            n_points = reader.varint()
+            self._skip_idlist(has_idlist, n_points)
+            return MultiPoint(self._coords(n_points))
+
+        elif geom_type == MULTILINESTRING:
+            n_lines = reader.varint()
+            self._skip_idlist(has_idlist, n_lines)
+            lines = [self._line() for _ in xrange(n_lines)]
+            return MultiLineString([line for line in lines if len(line) >= 2])
+
+        elif geom_type == MULTIPOLYGON:
+            n_polygons = reader.varint()
+            self._skip_idlist(has_idlist, n_polygons)
+            polygons = []
+            for _ in xrange(n_polygons):
+                rings = self._polygon()
+                if rings:
+                    polygons.append((rings[0], rings[1:]))
+            return MultiPolygon(polygons)
+
+        elif geom_type == COLLECTION:
+            n_geoms = reader.varint()
+            self._skip_idlist(has_idlist, n_geoms)
+            # each member is a complete TWKB geometry, with its own header.
+            return GeometryCollection(
+                [_Decoder(reader).decode() for _ in xrange(n_geoms)])
+
+        raise ValueError('Unknown TWKB geometry type: %d' % geom_type)
+
+
+def loads(data):
+    """Return the shapely geometry for TWKB data"""
+    return _Decoder(_Reader(data)).decode()
+
+
+def load_geometry(data):
+    """
+    Return the shapely geometry for either WKB or TWKB data
+
+    WKB starts with a byte order marker of 0 or 1. TWKB encoded with a
+    non-zero precision, as twkb_precision returns, never does.
+
+    Rounding to the TWKB precision can make thin polygons invalid, where
+    the original was valid, so those are repaired rather than left to be
+    dropped.
+    """
+    if ord(data[0]) in (0, 1):
+        return shapely.wkb.loads(data)
+    shape = loads(data)
+    if shape.type in ('Polygon', 'MultiPolygon') and not shape.is_valid:
+        shape = shape.buffer(0)
+    return shape
@@ -156,13 +156,14 @@ class AwsSessionHelper:
         aws_session.set_config_variable('region', region)
         self.aws_session = boto3.Session(botocore_session=aws_session)
 
-    def get_client(self, service):
+    def get_client(self, service, config=None):
         """ Returns boto3.client with the refreshable session
 
             service: str; String of what service to create a client for
             (e.g. 'sqs', 's3')
+            config: botocore.config.Config; optional client configuration
         """
-        return self.aws_session.client(service)
+        return self.aws_session.client(service, config=config)
 
     def get_session(self):
         """ Returns the raw refreshable aws session
@@ -1,6 +1,7 @@
 import Queue
 import signal
 import sys
+import threading
 import time
 from collections import namedtuple
 from itertools import izip
@@ -15,6 +16,7 @@ from tilequeue.process import convert_source_data_to_feature_layers
 from tilequeue.process import process_coord
 from tilequeue.queue import JobProgressException
 from tilequeue.queue.message import QueueHandle
+from tilequeue.queue.scheduler import PriorityQueueScheduler
 from tilequeue.store import write_tile_if_changed
 from tilequeue.tile import coord_children_subrange
 from tilequeue.tile import coord_to_mercator_bounds
@@ -89,6 +91,149 @@ class OutputQueue(object):
         return False
 
 
+def _affinity_coord(data):
+    deferred = data.get('deferred_fetch')
+    if deferred is not None:
+        return deferred.top_coord
+    return data['coord']
+
+
+class AffinityQueues(object):
+
+    """
+    A queue made of a queue per consumer, which keeps related jobs together
+
+    Jobs for coordinates at or below affinity_zoom go to the queue of the
+    consumer chosen by their ancestor at that zoom, e.g. all the jobs from
+    the same RAWR tile. Jobs for lower zoom coordinates go by their ancestor
+    low_zoom_levels further up, so that nearby tiles are kept together.
+    This means that consumers can get hits from process-local caches.
+
+    Consumers read from their own queue using `consumer(i)`, and steal from
+    the others when theirs is empty, to keep them all busy. Sentinels are
+    put to each queue in turn, so that putting one per consumer reaches
+    each of them.
+    """
+
+    def __init__(self, queues, affinity_zoom, low_zoom_levels=2,
+                 steal_interval_seconds=0.1):
+        self.queues = queues
+        self.affinity_zoom = affinity_zoom
+        self.low_zoom_levels = low_zoom_levels
+        self.steal_interval_seconds = steal_interval_seconds
+        self.n_sentinels = 0
+        self.sentinel_lock = threading.Lock()
+
+    def queue_index(self, coord):
+        if coord.zoom >= self.affinity_zoom:
+            zoom = self.affinity_zoom
+        else:
+            zoom = max(0, coord.zoom - self.low_zoom_levels)
+        parent = coord.zoomTo(zoom).container()
+        key = (parent.zoom, int(parent.column), int(parent.row))
+        return hash(key) % len(self.queues)
+
+    def put(self, data, block=True, timeout=None):
+        if data is None:
+            with self.sentinel_lock:
+                index = self.n_sentinels % len(self.queues)
+                self.n_sentinels += 1
+        else:
+            index = self.queue_index(_affinity_coord(data))
+        self.queues[index].put(data, block, timeout)
+
+    def consumer(self, index):
+        return AffinityConsumer(self, index)
+
+    def qsize(self):
+        return sum(q.qsize() for q in self.queues)
+
+    def empty(self):
+        return all(q.empty() for q in self.queues)
+
+    def full(self):
+        return all(q.full() for q in self.queues)
+
+    def close(self):
+        for q in self.queues:
+            q.close()
+
+    def join_thread(self):
+        for q in self.queues:
+            q.join_thread()
+
+
+class AffinityConsumer(object):
+
+    """
+    Reads from one of the AffinityQueues, stealing from the others
+
+    A sentinel stolen from another queue is put back for its consumer
+    without blocking, as that queue may be full and its consumer may be
+    stealing from this one in turn. If it doesn't fit, it's held and tried
+    again on each later pass, and put back for certain before this
+    consumer's own sentinel is returned.
+    """
+
+    def __init__(self, affinity_queues, index):
+        self.affinity_queues = affinity_queues
+        self.index = index
+        queues = affinity_queues.queues
+        # steal from the others in turn, starting after this one.
+        self.own_queue = queues[index]
+        self.other_queues = queues[index + 1:] + queues[:index]
+        # the queues which we hold a stolen sentinel for
+        self.held_sentinels = []
+
+    def _return_sentinels(self, block=False):
+        held = self.held_sentinels
+        self.held_sentinels = []
+        for q in held:
+            try:
+                q.put(None, block)
+            except Queue.Full:
+                self.held_sentinels.append(q)
+
+    def _steal(self):
+        self._return_sentinels()
+        for q in self.other_queues:
+            try:
+                data = q.get_nowait()
+            except Queue.Empty:
+                continue
+            if data is None:
+                # that's another consumer's sentinel, put it back for them.
+                try:
+                    q.put_nowait(None)
+                except Queue.Full:
+                    self.held_sentinels.append(q)
+                continue
+            return data
+        return None
+
+    def get(self, block=True, timeout=None):
+        interval = self.affinity_queues.steal_interval_seconds
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            try:
+                data = self.own_queue.get(block, interval)
+            except Queue.Empty:
+                pass
+            else:
+                if data is None:
+                    # the other consumers carry on, and need their sentinels.
+                    self._return_sentinels(block=True)
+                return data
+            data = self._steal()
+            if data is not None:
+                return data
+            if not block or (deadline is not None and
+                             time.time() >= deadline):
+                raise Queue.Empty
+
+
 def _ack_coord_handle(
         coord, coord_handle, queue_mapper, msg_tracker, timing_state,
         tile_proc_logger, stats_handler):
@@ -166,7 +311,8 @@ class TileQueueReader(object):
 
     def __init__(
             self, queue_mapper, msg_marshaller, msg_tracker, output_queue,
-            tile_proc_logger, stats_handler, stop, max_zoom, group_by_zoom):
+            tile_proc_logger, stats_handler, stop, max_zoom, group_by_zoom,
+            prefetch_fn=None, scheduler=None, coalescer=None):
         self.queue_mapper = queue_mapper
         self.msg_marshaller = msg_marshaller
         self.msg_tracker = msg_tracker
@@ -176,23 +322,21 @@ class TileQueueReader(object):
         self.stop = stop
         self.max_zoom = max_zoom
         self.group_by_zoom = group_by_zoom
+        # optionally called with the parent tile of each group of
+        # coordinates, so that the data for it can be fetched ahead of time.
+        self.prefetch_fn = prefetch_fn
+        # chooses which queue to read the next messages from
+        if scheduler is None:
+            scheduler = PriorityQueueScheduler(queue_mapper, tile_proc_logger)
+        self.scheduler = scheduler
+        # optionally attaches duplicates of jobs in flight to them, rather
+        # than rendering them again
+        self.coalescer = coalescer
 
     def __call__(self):
         while not self.stop.is_set():
 
-            msg_handles = ()
-
-            for queue_id, tile_queue in (
-                    self.queue_mapper.queues_in_priority_order()):
-                try:
-                    msg_handles = tile_queue.read()
-                except Exception as e:
-                    stacktrace = format_stacktrace_one_line()
-                    self.tile_proc_logger.error(
-                        'Queue read error', e, stacktrace)
-                    continue
-                if msg_handles:
-                    break
+            queue_id, msg_handles = self.scheduler.read()
 
             if not msg_handles:
                 continue
@@ -236,6 +380,15 @@ class TileQueueReader(object):
                         self._reject_coord(coord, coord_handle, timing_state)
                         continue
 
+                    coalesce_id = None
+                    if self.coalescer is not None:
+                        coalesce_id = self.coalescer.add(
+                            coord, coord_handle, timing_state)
+                        if coalesce_id is None:
+                            # acknowledged when the job in flight is done
+                            self.stats_handler.coalesced_coord()
+                            continue
+
                     metadata = dict(
                         # the timing is just what will be filled out later
                         timing=dict(
@@ -248,6 +401,7 @@ class TileQueueReader(object):
                         # determine timing information
                         timing_state=timing_state,
                         coord_handle=coord_handle,
+                        coalesce_id=coalesce_id,
                     )
                     data = dict(
                         metadata=metadata,
@@ -260,6 +414,15 @@ class TileQueueReader(object):
                 # coordinates. in which case, there's nothing to do anyway, as
                 # the _reject_coord method will have marked the job as done.
                 if all_coords_data:
+                    if self.prefetch_fn is not None and \
+                            self._prefetch(parent_tile) and \
+                            self.coalescer is not None:
+                        # the prefetch reads the data, so duplicates from
+                        # now on might need newer data than it.
+                        for data in all_coords_data:
+                            self.coalescer.fetching(
+                                data['metadata']['coalesce_id'])
+
                     coord_input_spec = all_coords_data, parent_tile
                     msg = 'group of %d tiles below %s' \
                           % (len(all_coords_data),
@@ -267,10 +430,23 @@ class TileQueueReader(object):
                     if self.output(msg, coord_input_spec):
                         break
 
+        self.scheduler.close()
         for _, tile_queue in self.queue_mapper.queues_in_priority_order():
             tile_queue.close()
         self.tile_proc_logger.lifecycle('tile queue reader stopped')
 
+    def _prefetch(self, parent_tile):
+        # returns whether a read of the data was started.
+        try:
+            return self.prefetch_fn(parent_tile)
+        except Exception as e:
+            # the data will be fetched when it's needed instead, so this isn't
+            # fatal for the job.
+            stacktrace = format_stacktrace_one_line()
+            self.tile_proc_logger.error(
+                'Prefetch error', e, stacktrace, parent_tile)
+            return False
+
     def _reject_coord(self, coord, coord_handle, timing_state):
         self.tile_proc_logger.log(
             LogLevel.WARNING,
@@ -309,7 +485,7 @@ class DataFetch(object):
     def __init__(
             self, fetcher, input_queue, output_queue, io_pool,
             tile_proc_logger, stats_handler, metatile_zoom, max_zoom,
-            metatile_start_zoom=0):
+            metatile_start_zoom=0, coalescer=None):
         self.fetcher = fetcher
         self.input_queue = input_queue
         self.output_queue = output_queue
@@ -319,6 +495,7 @@ class DataFetch(object):
         self.metatile_zoom = metatile_zoom
         self.max_zoom = max_zoom
         self.metatile_start_zoom = metatile_start_zoom
+        self.coalescer = coalescer
 
     def __call__(self, stop):
         saw_sentinel = False
@@ -338,7 +515,22 @@ class DataFetch(object):
             parent = None
             try:
                 all_data, parent = coord_input_spec
+                if self.coalescer is not None:
+                    # duplicates which arrive from now on might need newer
+                    # data than is about to be fetched.
+                    for data in all_data:
+                        self.coalescer.fetching(
+                            data['metadata']['coalesce_id'])
                 for fetch, data in self.fetcher.fetch_tiles(all_data):
+                    if getattr(fetch, 'deferred', False):
+                        # the data is the list of jobs which need the
+                        # deferred fetch. they're sent on together, to be
+                        # fetched by the processor.
+                        coord = fetch.top_coord
+                        if self._defer_and_output(fetch, data, output):
+                            break
+                        continue
+
                     metadata = data['metadata']
                     coord = data['coord']
                     if self._fetch_and_output(fetch, coord, metadata, output):
@@ -357,9 +549,14 @@ class DataFetch(object):
         data = self._fetch(fetch, coord, metadata)
         return output(coord, data)
 
+    def _defer_and_output(self, deferred, all_data, output):
+        jobs = [self._job_data(data['coord'], data['metadata'], None)
+                for data in all_data]
+        data = dict(deferred_fetch=deferred, jobs=jobs)
+        return output(deferred.top_coord, data)
+
     def _fetch(self, fetch, coord, metadata):
         nominal_zoom = coord.zoom + self.metatile_zoom
-        start_zoom = coord.zoom + self.metatile_start_zoom
         unpadded_bounds = coord_to_mercator_bounds(coord)
 
         start = time.time()
@@ -369,6 +566,13 @@ class DataFetch(object):
         metadata['timing']['fetch'] = convert_seconds_to_millis(
             time.time() - start)
 
+        return self._job_data(coord, metadata, source_rows)
+
+    def _job_data(self, coord, metadata, source_rows):
+        nominal_zoom = coord.zoom + self.metatile_zoom
+        start_zoom = coord.zoom + self.metatile_start_zoom
+        unpadded_bounds = coord_to_mercator_bounds(coord)
+
         # every tile job that we get from the queue is a "parent" tile
         # and its four children to cut from it. at zoom 15, this may
         # also include a whole bunch of other children below the max
@@ -392,7 +596,8 @@ class ProcessAndFormatData(object):
 
     def __init__(self, post_process_data, formats, input_queue,
                  output_queue, buffer_cfg, output_calc_mapping, layer_data,
-                 tile_proc_logger, stats_handler):
+                 tile_proc_logger, stats_handler, fingerprinter=None,
+                 fetcher=None):
         formats.sort(key=attrgetter('sort_key'))
         self.post_process_data = post_process_data
         self.formats = formats
@@ -403,75 +608,162 @@ class ProcessAndFormatData(object):
         self.layer_data = layer_data
         self.tile_proc_logger = tile_proc_logger
         self.stats_handler = stats_handler
+        self.fingerprinter = fingerprinter
+        # only needed for the deferred fetches of jobs, see DataFetch.
+        self.fetcher = fetcher
 
-    def __call__(self, stop):
-        # ignore ctrl-c interrupts when run from terminal
-        signal.signal(signal.SIGINT, signal.SIG_IGN)
-
-        output = OutputQueue(self.output_queue, self.tile_proc_logger, stop)
-
-        saw_sentinel = False
-        while not stop.is_set():
-            try:
-                data = self.input_queue.get(timeout=timeout_seconds)
-            except Queue.Empty:
-                continue
-            if data is None:
-                saw_sentinel = True
-                break
-
-            coord = data['coord']
-            unpadded_bounds = data['unpadded_bounds']
-            cut_coords = data['cut_coords']
-            nominal_zoom = data['nominal_zoom']
-            source_rows = data['source_rows']
+    def _fingerprint(self, coord, source_rows, nominal_zoom):
+        # returns the fingerprint of the job's input, and whether the stored
+        # tiles were made from the same input. this has to happen before the
+        # rows are converted to features, which consumes them.
+        if self.fingerprinter is None:
+            return None, False
+        try:
+            fingerprint = self.fingerprinter(source_rows, nominal_zoom)
+            unchanged = self.fingerprinter.unchanged(coord, fingerprint)
+        except Exception as e:
+            # a fingerprint is only an optimisation, so process the job as
+            # normal if the index can't be read.
+            stacktrace = format_stacktrace_one_line()
+            self.tile_proc_logger.error(
+                'Fingerprint error', e, stacktrace, coord)
+            return None, False
+        return fingerprint, unchanged
+
+    def _fetch_deferred(self, data):
+        # generates the jobs which share a deferred fetch, e.g. an unindexed
+        # RAWR tile, with their rows fetched. this is CPU heavy, which is
+        # why it's done here rather than in the fetch threads.
+        deferred = data['deferred_fetch']
+        try:
+            fetch = self.fetcher.fetch_deferred(deferred)
+        except Exception as e:
+            stacktrace = format_stacktrace_one_line()
+            self.tile_proc_logger.fetch_error(
+                e, stacktrace, None, deferred.top_coord)
+            self.stats_handler.fetch_error()
+            return
 
+        for job in data['jobs']:
             start = time.time()
-
             try:
-                feature_layers = convert_source_data_to_feature_layers(
-                    source_rows, self.layer_data, unpadded_bounds,
-                    nominal_zoom)
-                formatted_tiles, extra_data = process_coord(
-                    coord, nominal_zoom, feature_layers,
-                    self.post_process_data, self.formats, unpadded_bounds,
-                    cut_coords, self.buffer_cfg, self.output_calc_mapping)
+                job['source_rows'] = fetch(
+                    job['nominal_zoom'], job['unpadded_bounds'])
             except Exception as e:
                 stacktrace = format_stacktrace_one_line()
-                self.tile_proc_logger.error(
-                    'Processing error', e, stacktrace, coord)
-                self.stats_handler.proc_error()
+                self.tile_proc_logger.fetch_error(
+                    e, stacktrace, job['coord'], deferred.top_coord)
+                self.stats_handler.fetch_error()
                 continue
+            job['metadata']['timing']['fetch'] = convert_seconds_to_millis(
+                time.time() - start)
+            yield job
+
+    def _process(self, data):
+        # returns the data to output for the job, or None if it failed.
+        coord = data['coord']
+        unpadded_bounds = data['unpadded_bounds']
+        cut_coords = data['cut_coords']
+        nominal_zoom = data['nominal_zoom']
+        source_rows = data['source_rows']
 
+        start = time.time()
+
+        fingerprint, unchanged = self._fingerprint(
+            coord, source_rows, nominal_zoom)
+        if unchanged:
+            # the stored tiles were made from the same input, so they
+            # would come out the same. skip straight to acking the job.
             metadata = data['metadata']
             metadata['timing']['process'] = convert_seconds_to_millis(
                 time.time() - start)
-            metadata['layers'] = extra_data
-
-            data = dict(
+            metadata['layers'] = dict(size={})
+            return dict(
                 metadata=metadata,
                 coord=coord,
-                formatted_tiles=formatted_tiles,
+                formatted_tiles=[],
+                unchanged=True,
             )
 
-            if output(coord, data):
+        try:
+            feature_layers = convert_source_data_to_feature_layers(
+                source_rows, self.layer_data, unpadded_bounds,
+                nominal_zoom)
+            formatted_tiles, extra_data = process_coord(
+                coord, nominal_zoom, feature_layers,
+                self.post_process_data, self.formats, unpadded_bounds,
+                cut_coords, self.buffer_cfg, self.output_calc_mapping)
+        except Exception as e:
+            stacktrace = format_stacktrace_one_line()
+            self.tile_proc_logger.error(
+                'Processing error', e, stacktrace, coord)
+            self.stats_handler.proc_error()
+            return None
+
+        metadata = data['metadata']
+        metadata['timing']['process'] = convert_seconds_to_millis(
+            time.time() - start)
+        metadata['layers'] = extra_data
+
+        return dict(
+            metadata=metadata,
+            coord=coord,
+            formatted_tiles=formatted_tiles,
+            fingerprint=fingerprint,
+        )
+
+    def __call__(self, stop, input_queue=None):
+        # ignore ctrl-c interrupts when run from terminal
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        # each processor can be given its own input queue, e.g. a consumer
+        # of AffinityQueues.
+        if input_queue is None:
+            input_queue = self.input_queue
+
+        output = OutputQueue(self.output_queue, self.tile_proc_logger, stop)
+
+        saw_sentinel = False
+        while not stop.is_set():
+            try:
+                data = input_queue.get(timeout=timeout_seconds)
+            except Queue.Empty:
+                continue
+            if data is None:
+                saw_sentinel = True
+                break
+
+            if 'deferred_fetch' in data:
+                jobs = self._fetch_deferred(data)
+            else:
+                jobs = [data]
+
+            stopped = False
+            for job in jobs:
+                processed = self._process(job)
+                if processed is not None and \
+                   output(processed['coord'], processed):
+                    stopped = True
+                    break
+            if stopped:
                 break
 
         if not saw_sentinel:
-            _force_empty_queue(self.input_queue)
+            _force_empty_queue(input_queue)
         self.tile_proc_logger.lifecycle('processor stopped')
 
 
 class S3Storage(object):
 
     def __init__(self, input_queue, output_queue, io_pool, store,
-                 tile_proc_logger, metatile_size):
+                 tile_proc_logger, metatile_size, fingerprinter=None):
         self.input_queue = input_queue
         self.output_queue = output_queue
         self.io_pool = io_pool
         self.store = store
         self.tile_proc_logger = tile_proc_logger
         self.metatile_size = metatile_size
+        self.fingerprinter = fingerprinter
 
     def __call__(self, stop):
         saw_sentinel = False
@@ -502,7 +794,6 @@ class S3Storage(object):
                 continue
 
             async_exc_info = None
-            e = None
             n_stored = 0
             n_not_stored = 0
             for async_job in async_jobs:
@@ -512,32 +803,18 @@ class S3Storage(object):
                         n_stored += 1
                     else:
                         n_not_stored += 1
-                except Exception as e:
+                except Exception:
                     # it's important to wait for all async jobs to
                     # complete but we just keep a reference to the last
                     # exception it's unlikely that we would receive multiple
                     # different exceptions when uploading to s3
                     async_exc_info = sys.exc_info()
 
-            if async_exc_info:
-                stacktrace = format_stacktrace_one_line(async_exc_info)
-                self.tile_proc_logger.error(
-                    'Store error', e, stacktrace, coord)
+            data = self._stored(
+                data, start, n_stored, n_not_stored, async_exc_info)
+            if data is None:
                 continue
 
-            metadata = data['metadata']
-            metadata['timing']['s3'] = convert_seconds_to_millis(
-                time.time() - start)
-            metadata['store'] = dict(
-                stored=n_stored,
-                not_stored=n_not_stored,
-            )
-
-            data = dict(
-                coord=coord,
-                metadata=metadata,
-            )
-
             if queue_output(coord, data):
                 break
 
@@ -545,29 +822,246 @@ class S3Storage(object):
             _force_empty_queue(self.input_queue)
         self.tile_proc_logger.lifecycle('s3 storage stopped')
 
-    def save_tiles(self, tiles):
-        async_jobs = []
+    def _stored(self, data, start, n_stored, n_not_stored, exc_info):
+        """
+        Return the data to output once the tiles of a job have been stored,
+        or None if storing them failed.
+        """
+        coord = data['coord']
+        if exc_info:
+            stacktrace = format_stacktrace_one_line(exc_info)
+            self.tile_proc_logger.error(
+                'Store error', exc_info[1], stacktrace, coord)
+            return None
+
+        fingerprint = data.get('fingerprint')
+        if self.fingerprinter is not None and fingerprint is not None:
+            # only now that the tiles are stored do they match the input
+            try:
+                self.fingerprinter.record(coord, fingerprint)
+            except Exception as e:
+                stacktrace = format_stacktrace_one_line()
+                self.tile_proc_logger.error(
+                    'Fingerprint error', e, stacktrace, coord)
 
+        metadata = data['metadata']
+        metadata['timing']['s3'] = convert_seconds_to_millis(
+            time.time() - start)
+        metadata['store'] = dict(
+            stored=n_stored,
+            not_stored=n_not_stored,
+            unchanged=int(data.get('unchanged', False)),
+        )
+
+        return dict(
+            coord=coord,
+            metadata=metadata,
+        )
+
+    def _tile_writes(self, tiles):
         if self.metatile_size:
             tiles = make_metatiles(self.metatile_size, tiles)
 
+        writes = []
         for tile in tiles:
+            writes.append((
+                self.store,
+                tile['tile'],
+                # important to use the coord from the
+                # formatted tile here, because we could have
+                # cut children tiles that have separate zooms
+                # too
+                tile['coord'],
+                tile['format']))
+        return writes
 
+    def save_tiles(self, tiles):
+        async_jobs = []
+        for write_args in self._tile_writes(tiles):
             async_result = self.io_pool.apply_async(
-                write_tile_if_changed, (
-                    self.store,
-                    tile['tile'],
-                    # important to use the coord from the
-                    # formatted tile here, because we could have
-                    # cut children tiles that have separate zooms
-                    # too
-                    tile['coord'],
-                    tile['format']))
+                write_tile_if_changed, write_args)
             async_jobs.append(async_result)
-
         return async_jobs
 
 
+def _capture_result(fn, args):
+    # run fn, returning the exception info rather than raising it, so that a
+    # pool callback is called whether it succeeded or not.
+    try:
+        return None, fn(*args)
+    except Exception:
+        return sys.exc_info(), None
+
+
+def _acquire_or_stop(semaphore, stop):
+    # acquire the semaphore, returning False instead if asked to stop while
+    # waiting for it.
+    while not semaphore.acquire(False):
+        if stop.is_set():
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class _PendingStore(object):
+
+    """
+    The tiles of a job which are still being written to the store
+
+    Each write is counted with `submitting_write` before it's submitted, as
+    its callback could run straight away, and the job is complete once
+    `all_submitted` has been called and every write has reported back.
+    """
+
+    def __init__(self, data, start, completed_queue):
+        self.data = data
+        self.start = start
+        # the one is for the submission itself, so that the job can't
+        # complete before all its writes have been submitted.
+        self.n_remaining = 1
+        self.completed_queue = completed_queue
+        self.lock = threading.Lock()
+        self.n_stored = 0
+        self.n_not_stored = 0
+        self.exc_info = None
+
+    def _done_with(self, n):
+        self.n_remaining -= n
+        return self.n_remaining == 0
+
+    def tile_written(self, result):
+        exc_info, did_store = result
+        with self.lock:
+            if exc_info:
+                # as with waiting on each write, keep the last exception
+                self.exc_info = exc_info
+            elif did_store:
+                self.n_stored += 1
+            else:
+                self.n_not_stored += 1
+            done = self._done_with(1)
+        if done:
+            self.completed_queue.put(self)
+
+    def submitting_write(self):
+        with self.lock:
+            self.n_remaining += 1
+
+    def write_not_submitted(self, exc_info):
+        with self.lock:
+            self.exc_info = exc_info
+            self.n_remaining -= 1
+
+    def all_submitted(self):
+        with self.lock:
+            done = self._done_with(1)
+        if done:
+            self.completed_queue.put(self)
+
+
+class PipelinedS3Storage(S3Storage):
+
+    """
+    Stores tiles without a thread waiting on each job's writes
+
+    Each worker is a pair of threads: one takes jobs off the input queue and
+    hands their writes to the io pool, and the other outputs each job once
+    the pool reports that all of its writes are done. Up to max_in_flight
+    jobs can be waiting on their writes at once per worker, so a couple of
+    threads can keep as many uploads going as the io pool allows.
+    """
+
+    def __init__(self, input_queue, output_queue, io_pool, store,
+                 tile_proc_logger, metatile_size, fingerprinter=None,
+                 max_in_flight=64):
+        super(PipelinedS3Storage, self).__init__(
+            input_queue, output_queue, io_pool, store, tile_proc_logger,
+            metatile_size, fingerprinter)
+        self.max_in_flight = max_in_flight
+
+    def __call__(self, stop):
+        saw_sentinel = False
+        completed_queue = Queue.Queue()
+        in_flight = threading.BoundedSemaphore(self.max_in_flight)
+
+        finisher = threading.Thread(
+            target=self._finish, args=(stop, completed_queue, in_flight))
+        finisher.start()
+
+        while not stop.is_set():
+            try:
+                data = self.input_queue.get(timeout=timeout_seconds)
+            except Queue.Empty:
+                continue
+            if data is None:
+                saw_sentinel = True
+                break
+
+            if not _acquire_or_stop(in_flight, stop):
+                break
+            if not self._submit(data, completed_queue):
+                in_flight.release()
+
+        if not saw_sentinel:
+            _force_empty_queue(self.input_queue)
+
+        # wait for the jobs already submitted to be finished before stopping
+        # the finisher.
+        for i in range(self.max_in_flight):
+            in_flight.acquire()
+        completed_queue.put(None)
+        finisher.join()
+        self.tile_proc_logger.lifecycle('s3 storage stopped')
+
+    def _submit(self, data, completed_queue):
+        """
+        Submit the writes of a job, returning whether it'll be passed to the
+        finisher, which then frees its in-flight slot.
+        """
+        start = time.time()
+        try:
+            writes = self._tile_writes(data['formatted_tiles'])
+        except Exception as e:
+            stacktrace = format_stacktrace_one_line()
+            self.tile_proc_logger.error(
+                'Save error', e, stacktrace, data['coord'])
+            return False
+
+        # if submitting fails part way, the job completes once the writes
+        # already submitted have, and the finisher logs the failure as the
+        # job's store error.
+        pending = _PendingStore(data, start, completed_queue)
+        for write_args in writes:
+            pending.submitting_write()
+            try:
+                self.io_pool.apply_async(
+                    _capture_result, (write_tile_if_changed, write_args),
+                    callback=pending.tile_written)
+            except Exception:
+                pending.write_not_submitted(sys.exc_info())
+                break
+        pending.all_submitted()
+
+        return True
+
+    def _finish(self, stop, completed_queue, in_flight):
+        queue_output = OutputQueue(
+            self.output_queue, self.tile_proc_logger, stop)
+        stopping = False
+
+        while True:
+            pending = completed_queue.get()
+            if pending is None:
+                break
+            if not stopping:
+                data = self._stored(
+                    pending.data, pending.start, pending.n_stored,
+                    pending.n_not_stored, pending.exc_info)
+                if data is not None:
+                    stopping = queue_output(data['coord'], data)
+            in_flight.release()
+
+
 CoordProcessData = namedtuple(
     'CoordProcessData',
     ('coord', 'timing', 'size', 'store_info',),
@@ -578,7 +1072,7 @@ class TileQueueWriter(object):
 
     def __init__(
             self, queue_mapper, input_queue, inflight_mgr, msg_tracker,
-            tile_proc_logger, stats_handler, stop):
+            tile_proc_logger, stats_handler, stop, coalescer=None):
         self.queue_mapper = queue_mapper
         self.input_queue = input_queue
         self.inflight_mgr = inflight_mgr
@@ -586,6 +1080,7 @@ class TileQueueWriter(object):
         self.tile_proc_logger = tile_proc_logger
         self.stats_handler = stats_handler
         self.stop = stop
+        self.coalescer = coalescer
 
     def __call__(self):
         saw_sentinel = False
@@ -613,6 +1108,9 @@ class TileQueueWriter(object):
                     'Unmarking in-flight error', e, stacktrace, coord)
                 continue
 
+            if self.coalescer is not None:
+                self._ack_coalesced(coord, metadata['coalesce_id'])
+
             queue_handle, err = _ack_coord_handle(
                 coord, coord_handle, self.queue_mapper, self.msg_tracker,
                 timing_state, self.tile_proc_logger, self.stats_handler)
@@ -647,14 +1145,25 @@ class TileQueueWriter(object):
             _force_empty_queue(self.input_queue)
         self.tile_proc_logger.lifecycle('tile queue writer stopped')
 
+    def _ack_coalesced(self, coord, coalesce_id):
+        # the jobs which were attached to this one are done too. errors are
+        # logged by _ack_coord_handle, and don't affect the others.
+        for coord_handle, timing_state in self.coalescer.done(coalesce_id):
+            _ack_coord_handle(
+                coord, coord_handle, self.queue_mapper, self.msg_tracker,
+                timing_state, self.tile_proc_logger, self.stats_handler)
+
 
 class QueuePrint(object):
 
-    def __init__(self, interval_seconds, queue_info, tile_proc_logger, stop):
+    def __init__(self, interval_seconds, queue_info, tile_proc_logger, stop,
+                 stats_handler=None, io_pools=()):
         self.interval_seconds = interval_seconds
         self.queue_info = queue_info
         self.tile_proc_logger = tile_proc_logger
         self.stop = stop
+        self.stats_handler = stats_handler
+        self.io_pools = io_pools
 
     def __call__(self):
         # sleep in smaller increments, so that when we're asked to
@@ -674,4 +1183,202 @@ class QueuePrint(object):
 
             self.tile_proc_logger.log_queue_sizes(self.queue_info)
 
+            if self.stats_handler is not None:
+                for queue, queue_name in self.queue_info:
+                    budget = getattr(queue, 'budget', None)
+                    if budget is not None:
+                        self.stats_handler.queue_budget(queue_name, budget)
+
+            if self.io_pools:
+                pool_stats = [(pool.name, pool.sample())
+                              for pool in self.io_pools]
+                self.tile_proc_logger.log_io_pools(pool_stats)
+                if self.stats_handler is not None:
+                    for pool_name, stats in pool_stats:
+                        self.stats_handler.io_pool(pool_name, stats)
+
         self.tile_proc_logger.lifecycle('queue printer stopped')
+
+
+class WorkerThreads(object):
+
+    """
+    A group of worker threads reading from the same queue, which can grow
+    and shrink while running
+
+    Each worker is called with its own stop event. A worker is retired by
+    putting a sentinel on the input queue, so it finishes after the jobs
+    ahead of it, without emptying the queue.
+    """
+
+    def __init__(self, name, worker_fn, input_queue):
+        self.name = name
+        self.worker_fn = worker_fn
+        self.input_queue = input_queue
+        self.lock = threading.Lock()
+        self.threads = []
+        self.stops = []
+        # the number of workers which haven't been retired
+        self.n_workers = 0
+
+    def grow(self):
+        with self.lock:
+            stop = threading.Event()
+            thread = threading.Thread(target=self.worker_fn, args=(stop,))
+            thread.start()
+            self.threads.append(thread)
+            self.stops.append(stop)
+            self.n_workers += 1
+
+    def shrink(self):
+        with self.lock:
+            self.n_workers -= 1
+        self.input_queue.put(None)
+
+    def start(self, n_workers):
+        for i in range(n_workers):
+            self.grow()
+
+    def stop(self):
+        with self.lock:
+            for stop in self.stops:
+                stop.set()
+
+    def put_sentinels(self):
+        # retired workers have a sentinel waiting for them already.
+        with self.lock:
+            for i in range(self.n_workers):
+                self.input_queue.put(None)
+
+    def join(self):
+        with self.lock:
+            threads = list(self.threads)
+        for thread in threads:
+            thread.join()
+
+
+class QueueSampler(object):
+
+    """Fraction of the samples taken in which a queue was empty or full"""
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.reset()
+
+    def reset(self):
+        self.n_samples = 0
+        self.n_empty = 0
+        self.n_full = 0
+
+    def sample(self):
+        self.n_samples += 1
+        if self.queue.empty():
+            self.n_empty += 1
+        elif self.queue.full():
+            self.n_full += 1
+
+    def empty_fraction(self):
+        return float(self.n_empty) / max(1, self.n_samples)
+
+    def full_fraction(self):
+        return float(self.n_full) / max(1, self.n_samples)
+
+
+class ConcurrencyTuner(object):
+
+    """
+    Adjust the number of fetch and storage workers to keep the processors busy
+
+    The queues around each stage are sampled every sample_seconds, and every
+    interval_seconds each stage may grow or shrink by one worker, within its
+    bounds:
+
+     * fetch workers grow while the processors are waiting for data and jobs
+       are waiting to be fetched, and shrink while the processors can't keep
+       up with the data already fetched.
+     * storage workers grow while formatted tiles are backing up, waiting to
+       be stored, and shrink while there's almost never any to store.
+
+    Queue depth is used rather than the time each worker is busy, as workers
+    block on their queues when they have nothing to do.
+    """
+
+    # fraction of samples for the queue to be in a state to act on it.
+    act_fraction = 0.5
+    idle_fraction = 0.9
+
+    def __init__(self, fetch_workers, fetch_bounds, storage_workers,
+                 storage_bounds, input_queue, fetched_queue, processed_queue,
+                 tile_proc_logger, stop, interval_seconds=30,
+                 sample_seconds=1):
+        self.fetch_workers = fetch_workers
+        self.fetch_bounds = fetch_bounds
+        self.storage_workers = storage_workers
+        self.storage_bounds = storage_bounds
+        self.input_sampler = QueueSampler(input_queue)
+        self.fetched_sampler = QueueSampler(fetched_queue)
+        self.processed_sampler = QueueSampler(processed_queue)
+        self.tile_proc_logger = tile_proc_logger
+        self.stop = stop
+        self.interval_seconds = interval_seconds
+        self.sample_seconds = sample_seconds
+
+    def _resize(self, workers, bounds, grow, reason):
+        min_workers, max_workers = bounds
+        n_workers = workers.n_workers
+        if grow and n_workers < max_workers:
+            workers.grow()
+        elif not grow and n_workers > min_workers:
+            workers.shrink()
+        else:
+            return
+        self.tile_proc_logger.lifecycle(
+            'autotune %s workers %d -> %d: %s' % (
+                workers.name, n_workers, workers.n_workers, reason))
+
+    def tune(self):
+        fetched_empty = self.fetched_sampler.empty_fraction()
+        fetched_full = self.fetched_sampler.full_fraction()
+        input_waiting = 1.0 - self.input_sampler.empty_fraction()
+        if fetched_empty >= self.act_fraction and \
+           input_waiting >= self.act_fraction:
+            self._resize(
+                self.fetch_workers, self.fetch_bounds, True,
+                'processors waiting for data %d%% of the time, jobs waiting '
+                'to be fetched %d%%' % (fetched_empty * 100,
+                                        input_waiting * 100))
+        elif fetched_full >= self.act_fraction:
+            self._resize(
+                self.fetch_workers, self.fetch_bounds, False,
+                'fetched data queue full %d%% of the time' % (
+                    fetched_full * 100))
+
+        processed_empty = self.processed_sampler.empty_fraction()
+        processed_full = self.processed_sampler.full_fraction()
+        if processed_full >= self.act_fraction:
+            self._resize(
+                self.storage_workers, self.storage_bounds, True,
+                'processed tiles queue full %d%% of the time' % (
+                    processed_full * 100))
+        elif processed_empty >= self.idle_fraction:
+            self._resize(
+                self.storage_workers, self.storage_bounds, False,
+                'processed tiles queue empty %d%% of the time' % (
+                    processed_empty * 100))
+
+        for sampler in (self.input_sampler, self.fetched_sampler,
+                        self.processed_sampler):
+            sampler.reset()
+
+    def __call__(self):
+        elapsed = 0
+        while not self.stop.wait(self.sample_seconds):
+            for sampler in (self.input_sampler, self.fetched_sampler,
+                            self.processed_sampler):
+                sampler.sample()
+            elapsed += self.sample_seconds
+            if elapsed >= self.interval_seconds:
+                self.tune()
+                elapsed = 0
+
+        self.tile_proc_logger.lifecycle('concurrency tuner stopped')